@@ -82,43 +82,52 @@ class TreeModel(QtCore.QAbstractItemModel):
 
         if not self.research:
             self.research = "."
-        search_result = vaultSearch(self.research, 
+        # Customers and machines may come back in several pages
+        customers = {}
+        machines = {}
+        for search_result in vaultSearchPages(self.research,
                                         {"groups": self.groups_ids,
                                          "machines": [],
                                          "customers": [],
-                                        })
-        for custoid, custo in search_result["results"].items():
-            it = TreeItem([custo["name"],
-                           "c#" + custoid],
-                          Qicons("customer"),
-                          parents[-1])
-            parents[-1].appendChild(it)
-            parents.append(parents[-1].child(parents[-1].childCount() - 1))
-
-            for machineid, machine in custo["machines"].items():
-                it = TreeItem(["%s (%s - %s)" % (machine["name"],
-                                                 machine["fqdn"],
-                                                 machine["ip"]),
-                               "m#" + machineid],
-                              Qicons("machine"),
-                              parents[-1])
-                parents[-1].appendChild(it)
-                parents.append(parents[-1].child(parents[-1].childCount() - 1))
-
-                for serviceid, service in machine["services"].items():
-                    if not service["url"]:
-                        continue
-                    else:
-                        protocol = service["url"].split(":")[0]
-                        it = TreeItem([service["url"],
-                                       "s#" + serviceid],
-                                      Qicons(protocol, "service"),
+                                        }):
+            for custoid, custo in search_result["results"].items():
+                if custoid not in customers:
+                    it = TreeItem([custo["name"],
+                                   "c#" + custoid],
+                                  Qicons("customer"),
+                                  parents[-1])
+                    parents[-1].appendChild(it)
+                    customers[custoid] = it
+                parents.append(customers[custoid])
+
+                for machineid, machine in custo["machines"].items():
+                    if machineid not in machines:
+                        it = TreeItem(["%s (%s - %s)" % (machine["name"],
+                                                         machine["fqdn"],
+                                                         machine["ip"]),
+                                       "m#" + machineid],
+                                      Qicons("machine"),
                                       parents[-1])
                         parents[-1].appendChild(it)
+                        machines[machineid] = it
+                    parents.append(machines[machineid])
+
+                    for serviceid, service in machine["services"].items():
+                        if not service["url"]:
+                            continue
+                        else:
+                            protocol = service["url"].split(":")[0]
+                            it = TreeItem([service["url"],
+                                           "s#" + serviceid],
+                                          Qicons(protocol, "service"),
+                                          parents[-1])
+                            parents[-1].appendChild(it)
+
+                    parents.pop()
 
                 parents.pop()
-
-            parents.pop()
+            # Stay responsive while the next page comes
+            QtGui.QApplication.processEvents()
 
     def columnCount(self, parent):
         if parent.isValid():
@@ -234,12 +234,26 @@ def getCustomer(id):
 
 @try_connect
 @reauth
-def vaultSearch(pattern, filters={}):
+def vaultSearch(pattern, filters={}, limit=0, cursor=''):
     global client
     result = client.vault.search(client.authtok, pattern,
-                                filters.get('groups'), False, filters)
+                                filters.get('groups'), False, filters,
+                                limit, cursor)
     return result
 
+def vaultSearchPages(pattern, filters={}, limit=500):
+    """ Search by pages of `limit` services, yielding each page's result
+    """
+    cursor = ''
+    while True:
+        result = vaultSearch(pattern, filters, limit, cursor)
+        if not result or result["error"]:
+            return
+        yield result
+        if not result.get("has_more"):
+            return
+        cursor = result["cursor"]
+
 @return_element("plaintext")
 @try_connect
 @reauth
@@ -0,0 +1,301 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""sflvault-agent: holds the decrypted keys of a user, à-la ssh-agent.
+
+The agent asks for the passphrase once, keeps the ElGamal private key and
+the group keys it decrypts, and answers the SFLvaultClient over a Unix
+domain socket, whose path is given to the clients in SFLVAULT_AUTH_SOCK:
+
+  $ eval `sflvault-agent -t 3600`
+  $ sflvault show s#123
+
+The private key never leaves the agent: clients send it ciphertexts.
+
+The protocol is one JSON object per line, in both directions:
+
+  -> {"op": "symkey", "group_id": 1, "cryptgroupkey": "...", ...}
+  <- {"result": "..."}   or   {"error": "message"}
+"""
+
+from base64 import b64encode, b64decode
+import json
+import optparse
+import os
+import shutil
+import signal
+import socket
+import SocketServer
+import sys
+import tempfile
+import threading
+import time
+
+from Crypto import Random
+from Crypto.PublicKey import ElGamal
+
+from sflvault.common.crypto import *
+from sflvault.client.utils import AgentError
+from sflvault.client.groupkeys import GroupKeyCache
+
+
+AGENT_SOCK_ENV = 'SFLVAULT_AUTH_SOCK'
+
+
+class AgentRequestHandler(SocketServer.StreamRequestHandler):
+    """Answers the requests of one client connection"""
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            try:
+                req = json.loads(line)
+                op = getattr(self.server, 'op_%s' % req.pop('op'))
+                reply = {'result': op(**req)}
+            except Exception, e:
+                reply = {'error': '%s: %s' % (e.__class__.__name__, e)}
+            self.wfile.write(json.dumps(reply) + '\n')
+            self.wfile.flush()
+
+
+class SFLvaultAgent(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """The agent server, holding the keys for `lifetime` seconds (0 to keep
+    them until it's killed)"""
+
+    daemon_threads = True
+
+    def __init__(self, path, privkey, lifetime=0):
+        SocketServer.UnixStreamServer.__init__(self, path, AgentRequestHandler)
+        os.chmod(path, 0600)
+        self.path = path
+        self.privkey = privkey
+        self.expires = time.time() + lifetime if lifetime else None
+        self.lock = threading.Lock()
+        # Kept until the agent's lifetime is over
+        self.groupkeys = GroupKeyCache(size=256, ttl=None)
+        # {(url, username): (authtok, expires)}
+        self.authtoks = {}
+
+    def run(self):
+        """Serve until the lifetime is over, then wipe the keys"""
+        try:
+            while self.expires is None or time.time() < self.expires:
+                if self.expires is not None:
+                    self.timeout = self.expires - time.time()
+                self.handle_request()
+        finally:
+            self.wipe()
+            self.server_close()
+            os.unlink(self.path)
+
+    def wipe(self):
+        self.groupkeys.wipe()
+        with self.lock:
+            self.authtoks.clear()
+            self.privkey = None
+
+    def _groupkey(self, group_id, cryptgroupkey):
+        """Return the group's ElGamal obj, decrypting it only once"""
+        return self.groupkeys.decrypt(group_id, cryptgroupkey, self.privkey)
+
+    #
+    # Operations, called op_<op> with the request's other members.
+    #
+    def op_ping(self):
+        return True
+
+    def op_decrypt(self, message):
+        """Decrypt a serialized ElGamal message, return it b64 encoded"""
+        return b64encode(elgamal_decrypt(self.privkey,
+                                         unserial_elgamal_msg(message)))
+
+    def op_groupkey(self, group_id, cryptgroupkey):
+        """Return the serialized group privkey"""
+        eg = self._groupkey(group_id, cryptgroupkey)
+        return serial_elgamal_privkey(elgamal_bothkeys(eg))
+
+    def op_symkey(self, group_id, cryptgroupkey, cryptsymkey):
+        """Return the service's symkey, decrypted with the group's key"""
+        return decrypt_longmsg(self._groupkey(group_id, cryptgroupkey),
+                               cryptsymkey)
+
+    def op_authtok_get(self, url, username):
+        with self.lock:
+            return self.authtoks.get((url, username))
+
+    def op_authtok_set(self, url, username, authtok, expires):
+        with self.lock:
+            if authtok:
+                self.authtoks[(url, username)] = (authtok, expires)
+            else:
+                self.authtoks.pop((url, username), None)
+
+
+class AgentClient(object):
+    """Talks to the agent listening at `path`"""
+
+    def __init__(self, path):
+        self.path = path
+        self.sock = None
+
+    def _call(self, op, **kwargs):
+        kwargs['op'] = op
+        try:
+            if self.sock is None:
+                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.sock.connect(self.path)
+                self.rfile = self.sock.makefile('r')
+            self.sock.sendall(json.dumps(kwargs) + '\n')
+            line = self.rfile.readline()
+        except socket.error, e:
+            self.close()
+            raise AgentError("Unable to talk to the agent at %s: %s" %
+                             (self.path, e))
+        if not line:
+            self.close()
+            raise AgentError("The agent at %s closed the connection" %
+                             self.path)
+        reply = json.loads(line)
+        if 'error' in reply:
+            raise AgentError("Agent error: %s" % reply['error'])
+        return reply['result']
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def ping(self):
+        return self._call('ping')
+
+    def decrypt(self, message):
+        """Decrypt a serialized ElGamal message with the user's privkey"""
+        return b64decode(self._call('decrypt', message=message))
+
+    def groupkey(self, group_id, cryptgroupkey):
+        """Return the serialized group privkey, as decrypt_longmsg would"""
+        return str(self._call('groupkey', group_id=group_id,
+                              cryptgroupkey=cryptgroupkey))
+
+    def symkey(self, group_id, cryptgroupkey, cryptsymkey):
+        return str(self._call('symkey', group_id=group_id,
+                              cryptgroupkey=cryptgroupkey,
+                              cryptsymkey=cryptsymkey))
+
+    def authtok_get(self, url, username):
+        """Return (authtok, expires), or None"""
+        ret = self._call('authtok_get', url=url, username=username)
+        return (str(ret[0]), ret[1]) if ret else None
+
+    def authtok_set(self, url, username, authtok, expires):
+        self._call('authtok_set', url=url, username=username,
+                   authtok=authtok, expires=expires)
+
+    @property
+    def privkey(self):
+        """Stands for the ElGamal privkey, in decrypt_longmsg and for the
+        authentication challenge"""
+        return AgentPrivkey(self)
+
+
+class AgentPrivkey(object):
+    """Has the decrypt() method of an ElGamal obj, done by the agent"""
+
+    def __init__(self, agent):
+        self.agent = agent
+
+    def decrypt(self, ciphertext):
+        return self.agent.decrypt(serial_elgamal_msg(ciphertext))
+
+
+def main():
+    from sflvault.client.client import SFLvaultConfig, AskPassMethods
+    from sflvault.client.commands import CONFIG_FILE, CONFIG_FILE_ENV
+
+    parser = optparse.OptionParser(usage="%prog [-c config] [-t lifetime] "
+                                         "[-a socket] [-d]")
+    parser.add_option('-c', '--config', dest="config",
+                      default=os.environ.get(CONFIG_FILE_ENV, CONFIG_FILE),
+                      help="SFLvault config file holding your private key")
+    parser.add_option('-t', '--lifetime', dest="lifetime", type="int",
+                      default=0,
+                      help="Forget the keys and exit after LIFETIME seconds")
+    parser.add_option('-a', '--socket', dest="socket",
+                      help="Bind the agent to this Unix socket")
+    parser.add_option('-d', '--debug', dest="debug", action="store_true",
+                      default=False, help="Stay in the foreground")
+    opts, args = parser.parse_args()
+
+    cfg = SFLvaultConfig(opts.config)
+    try:
+        privkey_enc = cfg.get('SFLvault', 'key')
+    except:
+        print >>sys.stderr, "No private key in %s" % cfg.config_file
+        sys.exit(1)
+    try:
+        privpass = AskPassMethods(cfg).getpass()
+        privkey_packed = decrypt_privkey(privkey_enc, privpass)
+        del(privpass)
+    except DecryptError, e:
+        print >>sys.stderr, "[SFLvault] Invalid passphrase"
+        sys.exit(1)
+    except KeyboardInterrupt, e:
+        print >>sys.stderr, "[aborted]"
+        sys.exit(1)
+    eg = ElGamal.ElGamalobj()
+    (eg.p, eg.x, eg.g, eg.y) = unserial_elgamal_privkey(privkey_packed)
+
+    sockdir = None
+    path = opts.socket
+    if not path:
+        sockdir = tempfile.mkdtemp(prefix='sflvault-')
+        path = os.path.join(sockdir, 'agent.%d' % os.getpid())
+    agent = SFLvaultAgent(path, eg, opts.lifetime)
+    del(eg)
+
+    if not opts.debug:
+        pid = os.fork()
+        if pid:
+            print "%s=%s; export %s;" % (AGENT_SOCK_ENV, path, AGENT_SOCK_ENV)
+            print "echo Agent pid %d;" % pid
+            os._exit(0)
+        Random.atfork()
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+    else:
+        print "%s=%s; export %s;" % (AGENT_SOCK_ENV, path, AGENT_SOCK_ENV)
+
+    def stop(signum, frame):
+        raise SystemExit
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGHUP, stop)
+
+    try:
+        agent.run()
+    except (SystemExit, KeyboardInterrupt):
+        pass
+    finally:
+        if sockdir:
+            shutil.rmtree(sockdir, True)
@@ -21,6 +21,8 @@
 
 import pkg_resources as pkgres
 from ConfigParser import ConfigParser, NoSectionError
+import csv
+import json
 import xmlrpclib
 import getpass
 import sys
@@ -37,6 +39,8 @@ from sflvault.common import VaultError
 from sflvault.common.crypto import *
 from sflvault.client.utils import *
 from sflvault.client import remoting
+from sflvault.client.agent import AgentClient, AGENT_SOCK_ENV
+from sflvault.client.groupkeys import GroupKeyCache
 
 
 
@@ -58,54 +62,103 @@ def vaultReply(rep, errmsg="Error"):
 #
 # authenticate decorator
 #
+class SessionRejected(Exception):
+    """Raised by SessionCheckedProxy when the vault refuses our authtok"""
+    pass
+
+
+class SessionCheckedProxy(object):
+    """Wraps the vault's XML-RPC proxy, to raise SessionRejected when a call
+    is refused because the authtok isn't valid anymore."""
+
+    def __init__(self, proxy):
+        self._proxy = proxy
+
+    def __getattr__(self, name):
+        method = getattr(self._proxy, name)
+        def call(*args):
+            retval = method(*args)
+            if isinstance(retval, dict) and retval.get('error') and \
+               retval.get('message', '').startswith('Permission denied (session'):
+                raise SessionRejected(retval['message'])
+            return retval
+        return call
+
+
+def _load_privkey(self, keep_privkey):
+    """Return the ElGamal private key, decrypting it if it isn't cached.
+
+    Returns None if it couldn't be decrypted.
+    """
+    # The sflvault-agent keeps it for us
+    if self.agent:
+        return self.agent.privkey
+
+    # Check if we've cached the decrypted private key
+    if hasattr(self, 'privkey'):
+        # Use cached private key.
+        return self.privkey
+
+    try:
+        privkey_enc = self.cfg.get('SFLvault', 'key')
+    except:
+        raise VaultConfigurationError("No private key in local config, init with: user-setup username vault-url")
+
+    try:
+        privpass = self.getpassfunc()
+        privkey_packed = decrypt_privkey(privkey_enc, privpass)
+        del(privpass)
+        eg = ElGamal.ElGamalobj()
+        (eg.p, eg.x, eg.g, eg.y) = unserial_elgamal_privkey(privkey_packed)
+        privkey = eg
+
+    except DecryptError, e:
+        print "[SFLvault] Invalid passphrase"
+        return None
+    except TypeError, e:
+        print "[SFLvault] Could not retrieve passphrase, please resync your Keyring using the 'wallet' command."
+        return None
+    except KeyboardInterrupt, e:
+        print "[aborted]"
+        return None
+
+    # When we ask to keep the privkey, keep the ElGamal obj.
+    if keep_privkey or self.shell_mode:
+        self.privkey = privkey
+    return privkey
+
+
 def authenticate(keep_privkey=False):
     def do_authenticate(func, self, *args, **kwargs):
         """Login decorator
         
         self is there because it's called on class elements.
-        """
-
-        username = self.cfg.get('SFLvault', 'username')
-        privkey = None
 
-        # Check if we've cached the decrypted private key
-        if hasattr(self, 'privkey'):
-            # Use cached private key.
-            privkey = self.privkey
-
-        else:
+        While the last authtok is known to be valid (see authtok_set), the
+        method is called right away. The login/authenticate roundtrip is
+        only done when there is no such authtok, or when the vault
+        rejects it.
+        """
 
-            try:
-                privkey_enc = self.cfg.get('SFLvault', 'key')
-            except:
-                raise VaultConfigurationError("No private key in local config, init with: user-setup username vault-url")
-        
-            try:
-                privpass = self.getpassfunc()
-                privkey_packed = decrypt_privkey(privkey_enc, privpass)
-                del(privpass)
-                eg = ElGamal.ElGamalobj()
-                (eg.p, eg.x, eg.g, eg.y) = unserial_elgamal_privkey(privkey_packed)
-                privkey = eg
-
-            except DecryptError, e:
-                print "[SFLvault] Invalid passphrase"
+        if self.authtok_valid():
+            if keep_privkey and not _load_privkey(self, keep_privkey):
                 return False
-            except TypeError, e:
-                print "[SFLvault] Could not retrieve passphrase, please resync your Keyring using the 'wallet' command."
-                return False
-            except KeyboardInterrupt, e:
-                print "[aborted]"
-                return False
-
-            # When we ask to keep the privkey, keep the ElGamal obj.
-            if keep_privkey or self.shell_mode:
-                self.privkey = privkey
+            vault = self.vault
+            self.vault = SessionCheckedProxy(vault)
+            try:
+                return func(self, *args, **kwargs)
+            except SessionRejected, e:
+                print e
+                self.authtok_forget()
+            finally:
+                self.vault = vault
 
-       # Go for the login/authenticate roundtrip
+        username = self.cfg.get('SFLvault', 'username')
+        privkey = _load_privkey(self, keep_privkey)
+        if not privkey:
+            return False
 
-        # TODO: check also is the privkey (ElGamal obj) has been cached
-        #       in self.privkey (when invoked with keep_privkey)
+        # Go for the login/authenticate roundtrip
         retval = self.vault.login(username, pkgres.get_distribution('SFLvault_client').version)
         self.authret = retval
         if not retval['error']:
@@ -114,7 +167,8 @@ def authenticate(keep_privkey=False):
             if retval2['error']:
                 print retval2['message']
                 # decrypt token.
-                cryptok = privkey.decrypt(unserial_elgamal_msg(retval['cryptok']))
+                cryptok = elgamal_decrypt(privkey,
+                                          unserial_elgamal_msg(retval['cryptok']))
                 retval3 = self.vault.authenticate(username, b64encode(cryptok))
                 self.authret = retval3
 
@@ -124,11 +178,11 @@ def authenticate(keep_privkey=False):
                     raise AuthenticationError("Authentication failed: %s" % \
                                               retval3['message'])
                 else:
-                    self.authtok = retval3['authtok']
+                    self.authtok_set(retval3)
                     print retval3['message']
 
             else:
-                self.authtok = retval2['authtok']
+                self.authtok_set(retval2)
                 print retval2['message']
         else:
             raise AuthenticationError("Authentication failed: %s" % \
@@ -393,6 +447,41 @@ class SFLvaultConfig(object):
                                (name, add))
         return True
 
+###
+### Bulk import files, see SFLvaultClient.bulk_import
+###
+def read_import_file(filename, format=None):
+    """Yield the records of a bulk import file, as dicts for bulk_import.
+
+    format - 'csv' or 'json', guessed from the file's extension by default.
+
+    A JSON file holds a list of records. A CSV file has a header line naming
+    the fields of the records, and one record per line: empty fields are
+    left out, `group_ids` are separated by commas or spaces, and the
+    `metadata.<key>` columns go in the `metadata` dict.
+    """
+    if not format:
+        format = 'json' if filename.lower().endswith('.json') else 'csv'
+    with open(filename, 'rb') as f:
+        if format == 'json':
+            for rec in json.load(f):
+                yield rec
+            return
+        for row in csv.DictReader(f):
+            rec = {}
+            for key, value in row.items():
+                if not key or value is None or not value.strip():
+                    continue
+                value = value.decode('utf-8').strip()
+                if key.startswith('metadata.'):
+                    rec.setdefault('metadata', {})[key[9:]] = value
+                elif key == 'group_ids':
+                    rec[key] = re.split(r'[\s,]+', value)
+                else:
+                    rec[key] = value
+            yield rec
+
+
 ###
 ### On définit les fonctions qui vont traiter chaque sorte de requête.
 ###
@@ -419,13 +508,108 @@ class SFLvaultClient(object):
         self.set_getpassfunc(None)
 
         self.shell_mode = shell
+        # Decrypted group keys, see _groupkey
+        self.groupkeys = GroupKeyCache()
         self.authtok = ''
+        # time.time() at which self.authtok expires, 0 when unknown
+        self.authtok_expires = 0
         self.authret = None
         # Set the default route to the Vault
         url = self.cfg.get('SFLvault', 'url')
         if url:
             self.vault = xmlrpclib.Server(url, allow_none=True).sflvault
 
+        # Use the sflvault-agent, when one is running
+        self.agent = None
+        if AGENT_SOCK_ENV in os.environ:
+            agent = AgentClient(os.environ[AGENT_SOCK_ENV])
+            try:
+                agent.ping()
+                self.agent = agent
+            except AgentError, e:
+                print "[SFLvault] %s, not using it" % e
+
+        self.authtok_load()
+
+    @property
+    def authtok_file(self):
+        """File in which the authtok is saved, when the `save_authtok`
+        option is set in the [SFLvault] section of the config"""
+        return self.cfg.config_file + '.authtok'
+
+    def _save_authtok(self):
+        return self.cfg.has_option('SFLvault', 'save_authtok') and \
+               self.cfg.get('SFLvault', 'save_authtok').lower() in \
+               ['1', 'true', 'yes', 'on']
+
+    def authtok_valid(self):
+        """Return True if self.authtok can be used without authenticating"""
+        return bool(self.authtok) and time.time() < self.authtok_expires
+
+    def authtok_set(self, retval):
+        """Keep the authtok from an authenticate reply, with its expiry"""
+        self.authtok = retval['authtok']
+        # Vaults before 0.8.1 don't tell when the session expires.
+        if 'session_timeout' in retval:
+            self.authtok_expires = time.time() + int(retval['session_timeout'])
+        else:
+            self.authtok_expires = 0
+
+        if self.agent:
+            self.agent.authtok_set(self.cfg.get('SFLvault', 'url'),
+                                   self.cfg.get('SFLvault', 'username'),
+                                   self.authtok, self.authtok_expires)
+        if not self._save_authtok() or not self.authtok_expires:
+            return
+        fd = os.open(self.authtok_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                     0600)
+        os.fchmod(fd, 0600)
+        fp = os.fdopen(fd, 'w')
+        fp.write("%s\n%s\n%f\n%s\n" % (self.cfg.get('SFLvault', 'url'),
+                                         self.cfg.get('SFLvault', 'username'),
+                                         self.authtok_expires,
+                                         self.authtok))
+        fp.close()
+
+    def authtok_load(self):
+        """Load the authtok saved by authtok_set, if it's still valid"""
+        if self.agent:
+            saved = self.agent.authtok_get(self.cfg.get('SFLvault', 'url'),
+                                           self.cfg.get('SFLvault', 'username'))
+            if saved and time.time() < saved[1]:
+                self.authtok, self.authtok_expires = saved
+                return
+        if not self._save_authtok() or not os.path.exists(self.authtok_file):
+            return
+        if os.stat(self.authtok_file).st_mode & 0077:
+            print "Modes for %s must be 0600 (-rw-------), ignoring it" % \
+                  self.authtok_file
+            return
+        fp = open(self.authtok_file)
+        try:
+            url, username, expires, authtok = fp.read().splitlines()[:4]
+            expires = float(expires)
+        except ValueError:
+            return
+        finally:
+            fp.close()
+        if url == self.cfg.get('SFLvault', 'url') and \
+           username == self.cfg.get('SFLvault', 'username') and \
+           time.time() < expires:
+            self.authtok = authtok
+            self.authtok_expires = expires
+
+    def authtok_forget(self):
+        """Forget the authtok, after the vault rejected it"""
+        self.authtok = ''
+        self.authtok_expires = 0
+        if self.agent:
+            self.agent.authtok_set(self.cfg.get('SFLvault', 'url'),
+                                   self.cfg.get('SFLvault', 'username'),
+                                   '', 0)
+        if os.path.exists(self.authtok_file):
+            os.unlink(self.authtok_file)
+
     def set_getpassfunc(self, func=None):
         """Set the function to ask for passphrase.
 
@@ -441,6 +625,9 @@ class SFLvaultClient(object):
     def _set_vault(self, url, save=False):
         """Set the vault's URL and optionally save it"""
         self.vault = xmlrpclib.Server(url, allow_none=True).sflvault
+        # An authtok is only valid on the vault that issued it
+        self.authtok = ''
+        self.authtok_expires = 0
         if save:
             self.cfg.set('SFLvault', 'url', url)
 
@@ -645,6 +832,76 @@ class SFLvaultClient(object):
 
         return retval
 
+    # ID fields of the bulk import records, and their VaultID prefixes
+    _import_ids = {'customer_id': 'c', 'machine_id': 'm',
+                   'parent_service_id': 's'}
+    # Reference fields, with the ID field and type they stand for
+    _import_refs = {'customer': ('customer_id', 'customer'),
+                    'machine': ('machine_id', 'machine'),
+                    'parent': ('parent_service_id', 'service')}
+
+    def bulk_import(self, records, batch_size=100):
+        """Add customers, machines and services to the vault.
+
+        Arguments:
+            records: iterable of dicts (see read_import_file), with a `type`
+            ('customer', 'machine' or 'service'), the fields of
+            customer_add, machine_add or service_add, and an optional `ref`
+            to refer to it in the `customer`, `machine` or `parent` fields
+            of the next records.
+
+            batch_size: number of records added in each call, and
+            transaction.
+
+        Returns:
+            The result of each record: {'id'} or {'error'}, with its 'ref'.
+        """
+        # ref: (type, id) of the records already added
+        added = {}
+        results = []
+        batch = []
+        for rec in records:
+            rec = dict(rec)
+            for key, prefix in self._import_ids.items():
+                if rec.get(key):
+                    rec[key] = self.vaultId(str(rec[key]), prefix)
+            if rec.get('group_ids'):
+                group_ids = rec['group_ids']
+                if not isinstance(group_ids, list):
+                    group_ids = [group_ids]
+                rec['group_ids'] = [self.vaultId(str(x), 'g')
+                                    for x in group_ids]
+            batch.append(rec)
+            if len(batch) >= batch_size:
+                results.extend(self._bulk_import_batch(batch, added,
+                                                       len(results)))
+                batch = []
+        if batch:
+            results.extend(self._bulk_import_batch(batch, added, len(results)))
+
+        errors = len([r for r in results if 'error' in r])
+        print "Imported %d records, %d errors" % (len(results) - errors,
+                                                  errors)
+        return results
+
+    @authenticate()
+    def _bulk_import_batch(self, batch, added, offset):
+        """Send a batch of records, referring to the ones already `added`"""
+        for rec in batch:
+            for key, (id_key, rtype) in self._import_refs.items():
+                if rec.get(key) in added and added[rec[key]][0] == rtype:
+                    rec[id_key] = added[rec.pop(key)][1]
+        retval = vaultReply(self.vault.bulk_import(self.authtok, batch),
+                            "Error importing records")
+        for i, (rec, res) in enumerate(zip(batch, retval['results'])):
+            if 'error' in res:
+                print "Record %d%s: %s" % (offset + i + 1,
+                    " (%s)" % rec['ref'] if 'ref' in rec else '', res['error'])
+            elif 'ref' in rec:
+                added[rec['ref']] = (rec['type'], res['id'])
+        print "Imported %d records" % (offset + len(batch))
+        return retval['results']
+
     @authenticate()
     def service_passwd(self, service_id, newsecret):
         """Updates the password on the Vault for a certain service"""
@@ -754,7 +1011,8 @@ class SFLvaultClient(object):
 
 
     @authenticate()
-    def search(self, query, filters=None, verbose=True):
+    def search(self, query, filters=None, verbose=True, limit=100,
+               accessible_only=False):
         """Search the database for query terms.
 
         Arguments:
@@ -766,6 +1024,11 @@ class SFLvaultClient(object):
             
             verbose (bool): shows the notes and location attributes for services and machines.
 
+            limit (int): get the results by pages of that many services, printing
+            each one as it comes. 0 to get them all at once.
+
+            accessible_only (bool): only the services you have access to.
+
         Returns:
             Hierarchical view of the results.
         """
@@ -774,15 +1037,49 @@ class SFLvaultClient(object):
         if filters:
             filters = dict([(x, filters[x]) for x in filters if filters[x]])
 
-        retval = vaultReply(self.vault.search(self.authtok, query,
-                 filters.get('groups') if filters else None, verbose, filters),
-                            "Error searching database")
         print "Results:"
+        results = {}
+        cursor = ''
+        args = [self.authtok, query, filters.get('groups') if filters else None,
+                verbose, filters]
+        while True:
+            # Only send what older vaults don't know about when it's used
+            extra = []
+            if limit or accessible_only:
+                extra = [limit, cursor]
+            if accessible_only:
+                extra.append(True)
+            try:
+                retval = self.vault.search(*(args + extra))
+            except xmlrpclib.Fault:
+                # Vaults before 0.8.1 don't page: get all the results at once
+                if not limit or cursor or accessible_only:
+                    raise
+                limit = 0
+                continue
+            retval = vaultReply(retval, "Error searching database")
+            self._print_search_results(retval['results'], verbose)
+            # Gather all the pages
+            for c_id, c in retval['results'].items():
+                machines = results.setdefault(c_id, dict(c, machines={}))
+                for m_id, m in c['machines'].items():
+                    machines['machines'].setdefault(m_id, dict(m, services={}))
+                    machines['machines'][m_id]['services'].update(
+                        m['services'])
+            if not retval.get('has_more'):
+                break
+            cursor = retval['cursor']
+
+        retval['results'] = results
+        return retval
+
+    def _print_search_results(self, results, verbose):
+        """Print a page of search results"""
         encode = lambda x: x.encode('utf-8') if isinstance(x, str) else x
 
         # TODO: call the pager `less` when too long.
         level = 0
-        for c_id, c in retval['results'].items():
+        for c_id, c in results.items():
             level = 0
             # Display customer info
             print "c#%s  %s" % (c_id, encode(c['name']))
@@ -825,24 +1122,48 @@ class SFLvaultClient(object):
             if level in [0,1]:
                 print "%s" % (spc1) + '-' * (80 - len(spc1))
 
-        return retval
-            
+
+    def _groupkey(self, group_id, cryptgroupkey):
+        """Return the group's ElGamal obj, from its cryptgroupkey.
+
+        Group keys are cached in self.groupkeys, since it's the longest
+        thing to decrypt (over a second on a 3GHz machine)"""
+        eg = self.groupkeys.get(group_id, cryptgroupkey)
+        if eg is not None:
+            return eg
+        if self.agent:
+            grouppacked = self.agent.groupkey(group_id, cryptgroupkey)
+            eg = ElGamal.ElGamalobj()
+            (eg.p, eg.x, eg.g, eg.y) = unserial_elgamal_privkey(grouppacked)
+            self.groupkeys.put(group_id, cryptgroupkey, eg)
+            return eg
+        return self.groupkeys.decrypt(group_id, cryptgroupkey, self.privkey)
+
     def _decrypt_service(self, serv, onlysymkey=False, onlygroupkey=False):
         """Decrypt the service object returned from the vault.
 
         onlysymkey - return the plain symkey in the result
         onlygroupkey - return the plain groupkey ElGamal obj in result
         """
+        # The agent keeps the decrypted groupkeys, let it decrypt the symkey
+        if self.agent and not onlygroupkey:
+            try:
+                aeskey = self.agent.symkey(serv['group_id'],
+                                           serv['cryptgroupkey'],
+                                           serv['cryptsymkey'])
+            except AgentError, e:
+                raise DecryptError("Unable to decrypt symkey (%s)" % e)
+            if onlysymkey:
+                serv['symkey'] = aeskey
+            else:
+                serv['plaintext'] = decrypt_secret(aeskey, serv['secret'])
+            return
+
         # First decrypt groupkey
         try:
-            # TODO: implement a groupkey cache system, since it's the longest
-            #       thing to decrypt (over a second on a 3GHz machine)
-            grouppacked = decrypt_longmsg(self.privkey, serv['cryptgroupkey'])
+            eg = self._groupkey(serv['group_id'], serv['cryptgroupkey'])
         except Exception, e:
             raise DecryptError("Unable to decrypt groupkey (%s)" % e)
-
-        eg = ElGamal.ElGamalobj()
-        (eg.p, eg.x, eg.g, eg.y) = unserial_elgamal_privkey(grouppacked)
         groupkey = eg
         
         if onlygroupkey:
@@ -886,6 +1207,53 @@ class SFLvaultClient(object):
         return serv
 
 
+    @authenticate()
+    def changes_since(self, revision=0):
+        """Return what changed in the vault since `revision` (see the vault's
+        changes_since), to keep a local copy of the customers, machines and
+        services current"""
+        return vaultReply(self.vault.changes_since(self.authtok, revision),
+                          "Error getting the changes")
+
+    @authenticate(True)
+    def services_get(self, service_ids, decrypt=True):
+        """Get many services at once, in the order of `service_ids`.
+
+        Their secrets are decrypted in `plaintext` if we have access to them,
+        decrypting the key of each of their groups only once. The services
+        which don't exist are left out.
+        """
+        retval = vaultReply(self.vault.service_get_many(self.authtok,
+                                                        service_ids),
+                            "Error fetching data for services")
+        servs = retval['services']
+        if decrypt:
+            self._decrypt_services(servs)
+        return servs
+
+    def _decrypt_services(self, servs):
+        """Decrypt many services returned from the vault, as
+        _decrypt_service does, grouped by group"""
+        by_group = {}
+        for serv in servs:
+            if serv.get('cryptgroupkey') and serv.get('cryptsymkey'):
+                by_group.setdefault(serv['group_id'], []).append(serv)
+
+        # With an agent too: one roundtrip per group, instead of one per
+        # service
+        for group_id, group_servs in by_group.items():
+            try:
+                eg = self._groupkey(group_id, group_servs[0]['cryptgroupkey'])
+            except Exception, e:
+                raise DecryptError("Unable to decrypt groupkey (%s)" % e)
+            for serv in group_servs:
+                try:
+                    aeskey = decrypt_longmsg(eg, serv['cryptsymkey'])
+                except Exception, e:
+                    raise DecryptError("Unable to decrypt symkey (%s)" % e)
+                serv['plaintext'] = decrypt_secret(aeskey, serv['secret'])
+            del(eg)
+
     @authenticate(True)
     def service_get_tree(self, service_id, with_groups=False):
         """Get information to be edited"""
@@ -1112,15 +1480,17 @@ class SFLvaultClient(object):
                             "Error adding user to group")
 
         # Decrypt cryptgroupkey
-        # TODO: make use of a cache
-        grouppacked = decrypt_longmsg(self.privkey, retval['cryptgroupkey'])
+        groupkey = self._groupkey(group_id, retval['cryptgroupkey'])
+        grouppacked = serial_elgamal_privkey(elgamal_bothkeys(groupkey))
         
         # Get userpubkey and unpack
         eg = ElGamal.ElGamalobj()
         (eg.p, eg.g, eg.y) = unserial_elgamal_pubkey(retval['userpubkey'])
         
-        # Re-encrypt for user
-        newcryptgroupkey = encrypt_longmsg(eg, grouppacked)
+        # Re-encrypt for user, in the format the vault asks for (vaults
+        # older than the version 2 format don't say)
+        newcryptgroupkey = encrypt_longmsg(eg, grouppacked,
+                                           retval.get('version', 1))
         
         # Return a well-formed database-ready cryptgroupkey for user,
         # also, give the param is_admin.. as desired.
@@ -1133,6 +1503,40 @@ class SFLvaultClient(object):
 
         return retval
 
+    @authenticate(True)
+    def rewrap(self):
+        """Re-encrypt my group keys, and the symkeys of my groups' services,
+        in the encrypt_longmsg format the vault asks for."""
+        retval = vaultReply(self.vault.rewrap_list(self.authtok),
+                            "Error listing keys to rewrap")
+        version = retval['version']
+
+        eg = ElGamal.ElGamalobj()
+        (eg.p, eg.g, eg.y) = unserial_elgamal_pubkey(retval['userpubkey'])
+
+        groupkeys = []
+        groups = {}
+        for grp in retval['groups']:
+            groupkey = self._groupkey(grp['group_id'], grp['cryptgroupkey'])
+            groups[grp['group_id']] = groupkey
+            if longmsg_version(grp['cryptgroupkey']) < version:
+                grouppacked = serial_elgamal_privkey(elgamal_bothkeys(groupkey))
+                groupkeys.append([grp['group_id'],
+                                  encrypt_longmsg(eg, grouppacked, version)])
+
+        symkeys = []
+        for sg in retval['symkeys']:
+            groupkey = groups[sg['group_id']]
+            symkey = decrypt_longmsg(groupkey, sg['cryptsymkey'])
+            symkeys.append([sg['service_id'], sg['group_id'],
+                            encrypt_longmsg(groupkey, symkey, version)])
+
+        retval = vaultReply(self.vault.rewrap_store(self.authtok, groupkeys,
+                                                    symkeys),
+                            "Error saving rewrapped keys")
+        print "Success: %s" % retval['message']
+        return retval
+
     @authenticate()
     def group_del_user(self, group_id, user):
         retval = vaultReply(self.vault.group_del_user(self.authtok, group_id,
@@ -36,7 +36,7 @@ from Crypto.PublicKey import ElGamal
 from base64 import b64decode, b64encode
 from datetime import *
 
-from sflvault.client.client import SFLvaultClient
+from sflvault.client.client import SFLvaultClient, read_import_file
 from sflvault.common.crypto import *
 from sflvault.common import VaultError
 from sflvault.client.utils import *
@@ -418,6 +418,43 @@ class SFLvaultCommand(object):
 
 
 
+    def bulk_import(self):
+        """Add customers, machines and services from a CSV or JSON file.
+
+        Each record has a `type` (customer, machine or service), the fields
+        of customer-add (name), machine-add (customer_id, name, fqdn, ip,
+        location, notes) or service-add (machine_id, parent_service_id,
+        url, group_ids, secret, notes, metadata). A record can have a `ref`,
+        that the next ones use in their `customer`, `machine` or `parent`
+        fields to refer to it. For example, in CSV:
+
+          type,ref,name,customer,machine,url,group_ids,secret
+          customer,acme,ACME Inc.,,,,,
+          machine,www,web server,acme,,,,
+          service,,,,www,ssh://root@www.acme.com,g#1 g#2,s3cr3t
+
+        Note that the secrets are in clear text in the file.
+        """
+        self.parser.set_usage("bulk-import [-f csv|json] [-b size] FILE")
+        self.parser.add_option('-f', '--format', dest="format",
+                               help="File format, csv or json (default: "
+                                    "guessed from the file extension)")
+        self.parser.add_option('-b', '--batch-size', dest="batch_size",
+                               type="int", default=100,
+                               help="Records added in each transaction "
+                                    "(default: 100)")
+        self._parse()
+
+        if len(self.args) != 1:
+            raise SFLvaultParserError("A file to import is required")
+        if self.opts.format not in (None, 'csv', 'json'):
+            raise SFLvaultParserError("Unknown format: %s" % self.opts.format)
+
+        self.vault.bulk_import(read_import_file(self.args[0],
+                                                self.opts.format),
+                               self.opts.batch_size)
+
+
     def _service_clean_url(self, url):
         """Remove password in URL, and notify about rewrite."""
         # Rewrite url if a password was included... strip the port and
@@ -812,6 +849,22 @@ class SFLvaultCommand(object):
         self.vault.machine_list(self.opts.verbose, customer_id)
 
 
+    def rewrap(self):
+        """Re-encrypt your group keys, and your groups' services keys, in
+        the current format.
+
+        Run this once after the vault is set to the new format
+        (sflvault.vault.longmsg_version = 2): only you can re-encrypt your
+        own group keys."""
+        self.parser.set_usage("rewrap")
+        self._parse()
+
+        if len(self.args):
+            raise SFLvaultParserError("rewrap takes no arguments")
+
+        self.vault.rewrap()
+
+
     def user_passwd(self):
         """Change the passphrase protecting your local private key"""
         self.parser.set_usage("user-passwd")
@@ -930,6 +983,17 @@ class SFLvaultCommand(object):
                                action="append", type="string",
                                help="Filter results on these customers only")
 
+        self.parser.add_option('-n', '--page-size', dest="limit",
+                               type="int", default=100,
+                               help="Get the results by pages of that many "
+                                    "services, 0 for all at once "
+                                    "(default: 100)")
+
+        self.parser.add_option('-a', '--accessible', dest="accessible_only",
+                               action="store_true", default=False,
+                               help="Show only the services you have "
+                                    "access to")
+
         self._parse()
 
         if not len(self.args):
@@ -947,7 +1011,8 @@ class SFLvaultCommand(object):
                             for x in getattr(self.opts, f)]
             filters[f] = criteria
 
-        self.vault.search(self.args, filters or None, self.opts.verbose)
+        self.vault.search(self.args, filters or None, self.opts.verbose,
+                          self.opts.limit, self.opts.accessible_only)
 
     def wallet(self):
         """Put your SFLvault password in a wallet"""
@@ -0,0 +1,125 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Cache of the decrypted group keys.
+
+Decrypting a cryptgroupkey with the user's private key is the longest
+operation of the client (over a second on a 3GHz machine), and the same
+group key is needed for every service of the group.
+
+The cache hands out copies of its keys: the ones it holds are wiped when
+they are evicted, expired or forgotten, while the callers may still be
+using theirs.
+"""
+
+from collections import OrderedDict
+import hashlib
+import threading
+import time
+
+from Crypto.PublicKey import ElGamal
+
+from sflvault.common.crypto import decrypt_longmsg, unserial_elgamal_privkey
+
+
+class GroupKeyCache(object):
+    """LRU cache of group ElGamal objects, each kept at most `ttl` seconds
+    (None to keep them until they are pushed out or wiped).
+
+    Entries are keyed by group_id *and* a digest of the cryptgroupkey, so a
+    new cryptgroupkey for a group (group key changed, other user) is never
+    answered with a stale key.
+    """
+
+    def __init__(self, size=32, ttl=300):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # {(group_id, digest): (expires, ElGamal obj)}, least recent first
+        self.keys = OrderedDict()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _key(self, group_id, cryptgroupkey):
+        return (int(group_id),
+                hashlib.sha256(cryptgroupkey.encode('ascii')).hexdigest())
+
+    def get(self, group_id, cryptgroupkey):
+        """Return a copy of the cached ElGamal obj, or None"""
+        key = self._key(group_id, cryptgroupkey)
+        with self.lock:
+            self._purge(time.time())
+            if key not in self.keys:
+                return None
+            entry = self.keys.pop(key)
+            self.keys[key] = entry
+            return _copy(entry[1])
+
+    def put(self, group_id, cryptgroupkey, eg):
+        """Cache a copy of `eg`"""
+        key = self._key(group_id, cryptgroupkey)
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        eg = _copy(eg)
+        with self.lock:
+            if key in self.keys:
+                _wipe(self.keys.pop(key)[1])
+            self.keys[key] = (expires, eg)
+            while len(self.keys) > self.size:
+                _wipe(self.keys.popitem(last=False)[1][1])
+
+    def decrypt(self, group_id, cryptgroupkey, privkey):
+        """Return the group's ElGamal obj, decrypting the cryptgroupkey with
+        `privkey` only if it isn't cached"""
+        eg = self.get(group_id, cryptgroupkey)
+        if eg is None:
+            grouppacked = decrypt_longmsg(privkey, cryptgroupkey)
+            eg = ElGamal.ElGamalobj()
+            (eg.p, eg.x, eg.g, eg.y) = unserial_elgamal_privkey(grouppacked)
+            del(grouppacked)
+            self.put(group_id, cryptgroupkey, eg)
+        return eg
+
+    def wipe(self):
+        """Forget all the keys"""
+        with self.lock:
+            while self.keys:
+                _wipe(self.keys.popitem()[1][1])
+
+    def _purge(self, now):
+        for key, (expires, eg) in self.keys.items():
+            if expires is not None and expires < now:
+                del self.keys[key]
+                _wipe(eg)
+
+
+def _copy(eg):
+    out = ElGamal.ElGamalobj()
+    for attr in ('p', 'x', 'g', 'y'):
+        if hasattr(eg, attr):
+            setattr(out, attr, getattr(eg, attr))
+    return out
+
+def _wipe(eg):
+    """Drop the key material from one of the cache's ElGamal obj"""
+    for attr in ('p', 'x', 'g', 'y'):
+        if hasattr(eg, attr):
+            setattr(eg, attr, 0)
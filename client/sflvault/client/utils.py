@@ -33,7 +33,7 @@ __all__ = ['urlparse', 'AuthenticationError', 'PermissionError',
            'VaultIDSpecError', 'VaultConfigurationError', 'RemotingError',
            'ServiceRequireError', 'ServiceExpectError', 'sflvault_escape_chr',
            'ask_for_service_password', 'services_entry_points',
-           "ServiceSwitchException", "KeyringError"]
+           "ServiceSwitchException", "KeyringError", "AgentError"]
 
 
 def services_entry_points():
@@ -90,6 +90,13 @@ class AuthenticationError(Exception):
     pass
 
 
+### sflvault-agent Exceptions
+
+class AgentError(Exception):
+    """Raised when the sflvault-agent can't be reached or fails"""
+    pass
+
+
 ### Server restrictions errors
 
 class PermissionError(Exception):
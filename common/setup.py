@@ -39,6 +39,7 @@ setup(
     url='http://www.sflvault.org',
     license='GPLv3',
     install_requires=requires,
+    extras_require={'gmpy2': ['gmpy2']},
     packages=find_packages(),
     namespace_packages=['sflvault'],
     test_suite='nose.collector',
@@ -0,0 +1,212 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Export a vault to a file, and restore it in an empty database.
+
+The export holds the rows of the vault's tables as they are stored: the
+secrets, symkeys and group keys stay encrypted. It is written as one JSON
+record per line, a header first:
+
+  {"sflvault_export": 1, "tables": ["users", "groups", ...]}
+  {"table": "users", "row": {"id": 1, "username": "admin", ...}}
+  ...
+
+Both ways stream the rows by batches, so that the memory used doesn't
+depend on the size of the vault. The export is consistent: all the tables
+are read in one transaction, from the same snapshot of the vault, even if
+it is written to meanwhile (on SQLite, the writes wait for the export's
+end). Files named *.gz are gzip-compressed.
+The search index isn't exported: rebuild it after a restore. The revisions
+(see changes_since) are, so that clients keep syncing from the same ones.
+"""
+
+from base64 import b64decode, b64encode
+from datetime import datetime
+import gzip
+import json
+import logging
+import sys
+
+from sqlalchemy import sql, types
+
+from sflvault.model import meta
+
+log = logging.getLogger(__name__)
+
+
+EXPORT_VERSION = 1
+
+# Exported tables, in an order satisfying their foreign keys (but for the
+# services' parents, see restore_vault)
+TABLES = ['users', 'groups', 'users_groups', 'customers', 'machines',
+          'services', 'services_groups', 'changes']
+
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def open_export(filename, mode='r'):
+    """Open an export file, gzipped if it ends with .gz. '-' is the
+    standard input or output."""
+    if filename == '-':
+        return sys.stdout if 'w' in mode else sys.stdin
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode + 'b')
+    return open(filename, mode + 'b')
+
+
+def _encoders(table):
+    """Return {column name: function} converting the values that JSON can't
+    hold"""
+    out = {}
+    for col in table.columns:
+        if isinstance(col.type, types.DateTime):
+            out[col.name] = lambda v: v.strftime(DATETIME_FORMAT)
+        elif isinstance(col.type, types._Binary):
+            out[col.name] = lambda v: b64encode(str(v))
+    return out
+
+def _decoders(table):
+    out = {}
+    for col in table.columns:
+        if isinstance(col.type, types.DateTime):
+            out[col.name] = lambda v: datetime.strptime(v, DATETIME_FORMAT)
+        elif isinstance(col.type, types._Binary):
+            out[col.name] = lambda v: b64decode(v)
+    return out
+
+
+def export_vault(engine, out, batch_size=1000):
+    """Write the vault's tables, read in one transaction, to the file `out`.
+    Return {table: rows}"""
+    tables = meta.metadata.tables
+    out.write(json.dumps({'sflvault_export': EXPORT_VERSION,
+                          'tables': TABLES}) + '\n')
+    counts = {}
+    conn = engine.connect()
+    if engine.dialect.name == 'postgresql':
+        # All the tables from the snapshot taken by the first SELECT
+        conn = conn.execution_options(isolation_level='REPEATABLE READ')
+    trans = conn.begin()
+    try:
+        if engine.dialect.name == 'sqlite':
+            # pysqlite only begins a transaction before writing: begin it
+            # here, so that the read lock is held until the end
+            conn.execute('BEGIN')
+        for name in TABLES:
+            table = tables[name]
+            encoders = _encoders(table).items()
+            # Server-side cursor on PostgreSQL, fetched by batches
+            res = conn.execution_options(stream_results=True).execute(
+                sql.select([table]).order_by(table.c.id))
+            counts[name] = 0
+            while True:
+                rows = res.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    row = dict(row)
+                    for key, encode in encoders:
+                        if row[key] is not None:
+                            row[key] = encode(row[key])
+                    out.write(json.dumps({'table': name, 'row': row}) + '\n')
+                counts[name] += len(rows)
+            res.close()
+            log.info("Exported %d %s" % (counts[name], name))
+        trans.commit()
+    except:
+        trans.rollback()
+        raise
+    finally:
+        conn.close()
+    return counts
+
+
+def restore_vault(engine, infile, batch_size=1000):
+    """Insert the rows exported in the file `infile`, in an empty vault, in
+    a single transaction. Return {table: rows}"""
+    header = json.loads(infile.readline() or 'null')
+    if not isinstance(header, dict) or \
+       header.get('sflvault_export') != EXPORT_VERSION:
+        raise ValueError("Not a SFLvault export (version %d)" %
+                         EXPORT_VERSION)
+    tables = meta.metadata.tables
+    decoders = dict((name, _decoders(tables[name]).items())
+                    for name in TABLES)
+    services = tables['services']
+    counts = dict((name, 0) for name in TABLES)
+
+    conn = engine.connect()
+    trans = conn.begin()
+    try:
+        for name in TABLES:
+            if conn.execute(sql.select([sql.func.count()])
+                            .select_from(tables[name])).scalar():
+                raise ValueError("The vault isn't empty: the %s table has "
+                                 "rows" % name)
+
+        # A service's parent may come after it: they are set afterwards.
+        parents = []
+        batch = []
+        batch_table = None
+        for line in infile:
+            rec = json.loads(line)
+            name, row = rec['table'], rec['row']
+            if name not in decoders:
+                raise ValueError("Unknown table in the export: %s" % name)
+            for key, decode in decoders[name]:
+                if row.get(key) is not None:
+                    row[key] = decode(row[key])
+            if name == 'services' and row.get('parent_service_id'):
+                parents.append((row['id'], row['parent_service_id']))
+                row['parent_service_id'] = None
+            if name != batch_table or len(batch) >= batch_size:
+                _insert(conn, batch_table, batch)
+                batch = []
+                batch_table = name
+            batch.append(row)
+            counts[name] += 1
+        _insert(conn, batch_table, batch)
+
+        update = services.update().where(services.c.id == sql.bindparam('_id'))\
+                                  .values(parent_service_id=sql.bindparam('_parent'))
+        for i in range(0, len(parents), batch_size):
+            conn.execute(update, [{'_id': sid, '_parent': parent} for
+                                  sid, parent in parents[i:i + batch_size]])
+
+        if engine.dialect.name == 'postgresql':
+            # The ids were inserted explicitly: move the sequences past them
+            for name in TABLES:
+                conn.execute("SELECT setval(pg_get_serial_sequence('%s', "
+                             "'id'), COALESCE(MAX(id), 0) + 1, false) "
+                             "FROM %s" % (name, name))
+        trans.commit()
+    except:
+        trans.rollback()
+        raise
+    finally:
+        conn.close()
+    for name in TABLES:
+        log.info("Restored %d %s" % (counts[name], name))
+    return counts
+
+def _insert(conn, name, rows):
+    if rows:
+        conn.execute(meta.metadata.tables[name].insert(), rows)
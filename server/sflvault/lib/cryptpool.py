@@ -0,0 +1,108 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Encryption of the same kind of secret for many recipients, in parallel.
+
+`group_add` encrypts the new group key for every global admin, and
+`service_add`/`service_passwd` encrypt the symkey for every group of the
+service. With `sflvault.cryptpool.size` set, these run in a pool of
+worker processes.
+
+The pool is started before the server's threads are (see start_pool): a
+process forked while other threads hold locks (logging, sessions..) would
+inherit them locked. Pre-forked server processes each start their own
+pool, right after they are forked.
+"""
+
+import multiprocessing
+import os
+import threading
+
+
+from sflvault.common import crypto
+from sflvault.common.crypto import encrypt_longmsg, ElGamalPubkeyCache
+from sflvault import model
+
+
+# Pool size, set by init_cryptpool(). 0 to encrypt in the request's thread.
+size = 0
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+def init_cryptpool(pool_size, start=True):
+    """Set the pool size, and start the pool unless `start` is False (to
+    start it in the processes forked afterwards)"""
+    global size, _pool
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.terminate()
+        _pool = None
+        size = pool_size
+    if start:
+        start_pool()
+
+def start_pool():
+    """Start the pool of this process, if it needs one"""
+    if size > 0:
+        _get_pool()
+
+def _get_pool():
+    """Return the pool of this process, starting it if it wasn't (or if it
+    was the parent process')"""
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = multiprocessing.Pool(size, initializer=_init_worker)
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def encrypt_many(jobs):
+    """Encrypt messages with encrypt_longmsg.
+
+    jobs - list of (serialized pubkey, message)
+
+    Returns the list of the ciphertexts, in the order of `jobs`.
+    """
+    if size < 1 or len(jobs) < 2:
+        return [encrypt_longmsg(model.pubkey_cache.get(pubkey), message)
+                for pubkey, message in jobs]
+    # The workers don't see later changes to crypto.LONGMSG_VERSION
+    version = crypto.LONGMSG_VERSION
+    return _get_pool().map(_encrypt,
+                           [(pubkey, message, version)
+                            for pubkey, message in jobs])
+
+
+#
+# In the worker processes
+#
+_pubkeys = ElGamalPubkeyCache()
+
+def _init_worker():
+    # Don't share the RNG state with the parent
+    crypto.atfork()
+
+def _encrypt(job):
+    pubkey, message, version = job
+    return encrypt_longmsg(_pubkeys.get(pubkey), message, version)
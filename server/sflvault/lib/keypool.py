@@ -0,0 +1,97 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""ElGamal keypairs generated ahead of time.
+
+Generating a 1536 bits keypair takes from seconds to tens of seconds, which
+`group_add` would otherwise spend while the client waits. With
+`sflvault.keypool.size` set, a background process keeps that many
+keypairs ready.
+"""
+
+import os
+import Queue
+import multiprocessing
+
+from Crypto import Random
+from Crypto.PublicKey import ElGamal
+
+from sflvault.common.crypto import generate_elgamal_keypair, elgamal_bothkeys
+
+
+class KeypairPool(object):
+    """Keeps up to `size` fresh keypairs, generated by a child process.
+
+    Each keypair is handed out once: they go through a multiprocessing
+    Queue, shared by all the processes forked after `start`.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.queue = multiprocessing.Queue(size)
+        self.process = multiprocessing.Process(target=_generate_keypairs,
+                                               args=(self.queue,),
+                                               name='sflvault-keypool')
+        self.process.daemon = True
+
+    def start(self):
+        self.process.start()
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
+
+    def get(self):
+        """Return a keypair from the pool, or a newly generated one if the
+        pool is empty"""
+        try:
+            keys = self.queue.get_nowait()
+        except Queue.Empty:
+            return generate_elgamal_keypair()
+        eg = ElGamal.ElGamalobj()
+        (eg.p, eg.x, eg.g, eg.y) = keys
+        return eg
+
+
+def _generate_keypairs(queue):
+    """Fill the queue, blocking while it's full"""
+    # Don't share the RNG state with the parent
+    Random.atfork()
+    # Leave the CPU to the requests
+    os.nice(10)
+    while True:
+        queue.put(elgamal_bothkeys(generate_elgamal_keypair()))
+
+
+# Set by init_keypool() when enabled
+keypool = None
+
+def init_keypool(size):
+    """Start generating keypairs in the background"""
+    global keypool
+    keypool = KeypairPool(size)
+    keypool.start()
+
+def new_keypair():
+    """Return a single-use ElGamal keypair, from the pool if enabled"""
+    if keypool is not None:
+        return keypool.get()
+    return generate_elgamal_keypair()
@@ -0,0 +1,155 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Counters and latency histograms of the XML-RPC calls.
+
+`XMLRPCDispatcher._dispatch` records the latency of each call, and whether
+it failed, by method. The authentication failures are counted by reason.
+The server renders them in the Prometheus text format on the
+`sflvault.metrics.path` HTTP path (like GET /metrics), along with the
+number of open sessions. They are disabled by default: that path is served
+without authentication, on the vault's port.
+
+The values are kept in a flat array of doubles, indexed by method: a call
+costs a dict lookup, a bisect and a few additions. With pre-forked server
+processes, the array is in shared memory so that any process can render
+the totals.
+"""
+
+from bisect import bisect_left
+import multiprocessing
+import threading
+
+
+# Upper bounds of the latency buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0)
+
+# Reasons of the authentication failures
+AUTH_FAILURES = ('invalid_user', 'token_expired', 'bad_token',
+                 'session_not_found', 'session_expired')
+
+# Per method: calls, errors, latency sum, then the count of each bucket,
+# the last one being +Inf.
+_CALLS, _ERRORS, _SUM, _BUCKETS = 0, 1, 2, 3
+_WIDTH = _BUCKETS + len(BUCKETS) + 1
+
+
+# The Metrics, set by init_metrics(). None when disabled.
+stats = None
+
+def init_metrics(methods, shared=False):
+    global stats
+    stats = Metrics(methods, shared)
+
+
+class Metrics(object):
+    """Counters of the calls to `methods`, shared with forked processes if
+    `shared` is set"""
+
+    def __init__(self, methods, shared=False):
+        self.methods = sorted(methods)
+        self.index = dict((m, i * _WIDTH) for i, m in enumerate(self.methods))
+        self.auth_index = dict((r, len(self.methods) * _WIDTH + i)
+                               for i, r in enumerate(AUTH_FAILURES))
+        size = len(self.methods) * _WIDTH + len(AUTH_FAILURES)
+        if shared:
+            self.values = multiprocessing.RawArray('d', size)
+            self.lock = multiprocessing.Lock()
+        else:
+            self.values = [0.0] * size
+            self.lock = threading.Lock()
+
+    def observe(self, method, seconds, error=False):
+        """Record a call to `method`, which took `seconds`"""
+        i = self.index.get(method)
+        if i is None:
+            return
+        bucket = i + _BUCKETS + bisect_left(BUCKETS, seconds)
+        values = self.values
+        with self.lock:
+            values[i + _CALLS] += 1
+            if error:
+                values[i + _ERRORS] += 1
+            values[i + _SUM] += seconds
+            values[bucket] += 1
+
+    def auth_failure(self, reason):
+        with self.lock:
+            self.values[self.auth_index[reason]] += 1
+
+    def snapshot(self):
+        """Return ({method: (calls, errors, sum, [bucket counts])},
+                   {reason: auth failures})"""
+        with self.lock:
+            values = self.values[:]
+        calls = {}
+        for method, i in self.index.items():
+            if values[i + _CALLS]:
+                calls[method] = (int(values[i + _CALLS]),
+                                 int(values[i + _ERRORS]),
+                                 values[i + _SUM],
+                                 [int(x) for x in
+                                  values[i + _BUCKETS:i + _WIDTH]])
+        failures = dict((r, int(values[i]))
+                        for r, i in self.auth_index.items())
+        return calls, failures
+
+    def render(self, sessions=None):
+        """Return the metrics in the Prometheus text format"""
+        calls, failures = self.snapshot()
+        out = []
+        out.append('# HELP sflvault_rpc_calls_total XML-RPC calls by method')
+        out.append('# TYPE sflvault_rpc_calls_total counter')
+        for method in sorted(calls):
+            out.append('sflvault_rpc_calls_total{method="%s"} %d' %
+                       (method, calls[method][0]))
+        out.append('# HELP sflvault_rpc_errors_total XML-RPC calls that '
+                   'failed, by method')
+        out.append('# TYPE sflvault_rpc_errors_total counter')
+        for method in sorted(calls):
+            out.append('sflvault_rpc_errors_total{method="%s"} %d' %
+                       (method, calls[method][1]))
+        out.append('# HELP sflvault_rpc_latency_seconds Latency of the '
+                   'XML-RPC calls, by method')
+        out.append('# TYPE sflvault_rpc_latency_seconds histogram')
+        for method in sorted(calls):
+            count, errors, total, buckets = calls[method]
+            cumul = 0
+            for le, n in zip(BUCKETS + ('+Inf',), buckets):
+                cumul += n
+                out.append('sflvault_rpc_latency_seconds_bucket'
+                           '{method="%s",le="%s"} %d' % (method, le, cumul))
+            out.append('sflvault_rpc_latency_seconds_sum{method="%s"} %.6f' %
+                       (method, total))
+            out.append('sflvault_rpc_latency_seconds_count{method="%s"} %d' %
+                       (method, count))
+        out.append('# HELP sflvault_auth_failures_total Authentication '
+                   'failures, by reason')
+        out.append('# TYPE sflvault_auth_failures_total counter')
+        for reason in AUTH_FAILURES:
+            out.append('sflvault_auth_failures_total{reason="%s"} %d' %
+                       (reason, failures[reason]))
+        if sessions is not None:
+            out.append('# HELP sflvault_sessions Open sessions')
+            out.append('# TYPE sflvault_sessions gauge')
+            out.append('sflvault_sessions %d' % sessions)
+        return '\n'.join(out) + '\n'
@@ -0,0 +1,118 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Cache of the search results, in front of `SFLvaultAccess.search`.
+
+Entries are stamped with the write generation, a counter bumped by every
+method changing the vault (see `vault.changes_vault`): any change makes all
+the entries cached before it stale. The counter is in shared memory, so
+that it is seen by all the pre-forked server processes.
+
+Enabled with `sflvault.search.cache_size` (a number of entries), and bounded
+by `sflvault.search.cache_bytes` as well.
+"""
+
+from collections import OrderedDict
+import logging
+import multiprocessing
+import threading
+
+log = logging.getLogger(__name__)
+
+
+# The SearchCache, set by init_searchcache(). None when disabled.
+cache = None
+
+# Write generation, shared with the forked processes
+generation = multiprocessing.Value('l', 0)
+
+def bump():
+    """Invalidate all the cached searches"""
+    with generation.get_lock():
+        generation.value += 1
+
+def init_searchcache(size, max_bytes):
+    global cache
+    cache = SearchCache(size, max_bytes) if size > 0 else None
+
+
+def search_key(user_id, swords, filters, verbose, *args):
+    """Key of a search: the words are ANDed, so their order doesn't count"""
+    if isinstance(swords, (list, tuple)):
+        swords = tuple(sorted(set(x.strip() for x in swords if x.strip())))
+    if isinstance(filters, dict):
+        filters = sorted((k, v) for k, v in filters.items() if v)
+    return repr((user_id, swords, filters, bool(verbose)) + args)
+
+
+class SearchCache(object):
+    """LRU cache of the search results, bounded by a number of entries and
+    their approximate size (the length of their repr)"""
+
+    # Log the counters every that many lookups
+    log_every = 100
+
+    def __init__(self, size=256, max_bytes=16 * 1024 * 1024):
+        self.size = size
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached result, or None"""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and entry[0] != generation.value:
+                self.bytes -= entry[1]
+                entry = None
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries[key] = entry
+            if (self.hits + self.misses) % self.log_every == 0:
+                log.info("Search cache: %(hits)d hits, %(misses)d misses, "
+                         "%(entries)d entries, %(bytes)d bytes" % self.stats())
+        return entry[2] if entry else None
+
+    def put(self, key, result, gen):
+        """Cache a result, computed from the data at generation `gen`"""
+        nbytes = len(repr(result))
+        if nbytes > self.max_bytes or gen != generation.value:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self.entries[key] = (gen, nbytes, result)
+            self.bytes += nbytes
+            while len(self.entries) > self.size or self.bytes > self.max_bytes:
+                key, old = self.entries.popitem(last=False)
+                self.bytes -= old[1]
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self.entries),
+                'bytes': self.bytes}
@@ -0,0 +1,310 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""In-memory search engine, enabled with `sflvault.search.engine = memory`.
+
+It keeps a snapshot of the rows searched by `model.search_query`, with a
+trigram inverted index of their text. Each search word is a regular
+expression: the trigrams of the literal text it requires narrow down the
+candidate rows, which are then checked with the compiled regexps, without
+holding the engine's lock. Words too long or complex to be matched quickly
+(see parse_word) are searched as they are, and the regexps only see the
+first MAX_LINE_LENGTH characters of each line.
+
+The snapshot is updated by `SFLvaultAccess` when its writes are committed.
+With several server processes (`sflvault.processes`), each one also checks
+the version of the search index table before searching, and reloads what
+the other processes changed.
+"""
+
+from collections import defaultdict
+import heapq
+import re
+import sre_constants
+import sre_parse
+import threading
+
+from sqlalchemy import sql
+import transaction
+
+from sflvault import model
+from sflvault.model import meta
+
+
+# The MemorySearchEngine, set by init_searchengine(). None to search in SQL.
+engine = None
+
+def init_searchengine(shared=False):
+    global engine
+    engine = MemorySearchEngine(shared)
+    engine.load()
+    meta.Session.remove()
+
+
+def trigrams(text):
+    return set(text[i:i+3] for i in range(len(text) - 2))
+
+
+# Longest search word, and most repeats in it, searched as a regexp. Longer
+# or more complex words are searched as they are: two repeats (other than ?)
+# can backtrack polynomially, like .*.*!, and optionals exponentially, like
+# a?a?a?aaa.
+MAX_WORD_LENGTH = 100
+MAX_WORD_REPEATS = 1
+MAX_WORD_OPTIONALS = 4
+# The regexps only match the start of longer lines, so that a repeat costs
+# at most MAX_LINE_LENGTH ** 2 steps
+MAX_LINE_LENGTH = 4096
+
+REPEATS = (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT)
+
+
+def _subpatterns(arg):
+    if isinstance(arg, sre_parse.SubPattern):
+        yield arg
+    elif isinstance(arg, (list, tuple)):
+        for item in arg:
+            for sub in _subpatterns(item):
+                yield sub
+
+def _repeats(parsed, counts, in_repeat=False):
+    """Count the repeats of a parsed regexp in `counts`: [repeats,
+    optionals]. Return False if one of them repeats a repeat or an
+    alternative, which can backtrack exponentially, like (a+)+$"""
+    for op, arg in parsed:
+        if in_repeat and (op in REPEATS or op == sre_constants.BRANCH):
+            return False
+        if op in REPEATS:
+            counts[arg[:2] == (0, 1)] += 1
+        for sub in _subpatterns(arg):
+            if not _repeats(sub, counts, in_repeat or op in REPEATS):
+                return False
+    return True
+
+def parse_word(word):
+    """Return a search word's parsed regexp, or None if it must be searched
+    as it is: not a valid regexp, too long or too complex."""
+    if len(word) > MAX_WORD_LENGTH:
+        return None
+    try:
+        parsed = sre_parse.parse(word, re.I | re.M | re.U)
+    except (re.error, sre_constants.error, OverflowError):
+        return None
+    counts = [0, 0]
+    if not _repeats(parsed, counts) or counts[0] > MAX_WORD_REPEATS or \
+       counts[1] > MAX_WORD_OPTIONALS:
+        return None
+    return parsed
+
+
+def clip_lines(text):
+    """Return `text` with its lines cut to MAX_LINE_LENGTH characters"""
+    if len(text) <= MAX_LINE_LENGTH:
+        return text
+    return u'\n'.join(line[:MAX_LINE_LENGTH] for line in text.split(u'\n'))
+
+
+def compile_word(word):
+    """Compile a search word, as a regexp if it is a valid one (see
+    parse_word).
+
+    The searched fields are on separate lines, so that ^ and $ match at
+    the start and end of each of them."""
+    if parse_word(word) is None:
+        return re.compile(re.escape(word), re.I | re.M | re.U)
+    return re.compile(word, re.I | re.M | re.U)
+
+
+def required_literals(pattern):
+    """Return the strings that any match of `pattern` contains.
+
+    These are the runs of literal characters at the top level of the
+    pattern: anything else (classes, repeats, groups, alternatives..)
+    ends a run."""
+    parsed = parse_word(pattern)
+    if parsed is None:
+        return [pattern.lower()]
+    literals = []
+    run = []
+    for op, arg in parsed:
+        if op == sre_constants.LITERAL:
+            run.append(unichr(arg).lower())
+        else:
+            literals.append(u''.join(run))
+            run = []
+    literals.append(u''.join(run))
+    return [x for x in literals if len(x) >= 3]
+
+
+class MemorySearchEngine(object):
+    """Snapshot of the searched rows, and their trigram index"""
+
+    def __init__(self, shared=False):
+        # Check the search index's version before each search
+        self.shared = shared
+        self.version = None
+        self.lock = threading.RLock()
+        # Rows, by (customer_id, machine_id, service_id)
+        self.rows = {}
+        self.texts = {}
+        self.by_customer = defaultdict(set)
+        self.by_trigram = defaultdict(set)
+
+    def load(self):
+        """Load all the rows"""
+        with self.lock:
+            self.version = model.search_index_version()
+            rows = meta.Session.execute(model.search_rows_query()).fetchall()
+            self.rows.clear()
+            self.texts.clear()
+            self.by_customer.clear()
+            self.by_trigram.clear()
+            self._add(rows)
+
+    def apply(self, customer_ids, rows):
+        """Replace the rows of these customers"""
+        with self.lock:
+            for cid in customer_ids:
+                for key in self.by_customer.pop(cid, ()):
+                    self._remove(key)
+            self._add(rows)
+
+    def apply_on_commit(self, customer_ids, rows):
+        """Replace the rows of these customers once the current transaction
+        is committed"""
+        def hook(success):
+            if success:
+                self.apply(customer_ids, rows)
+        transaction.get().addAfterCommitHook(hook)
+
+    def sync(self):
+        """Reload the customers changed in the search index by other
+        processes"""
+        version = model.search_index_version()
+        if version == self.version:
+            return
+        with self.lock:
+            si = model.searchindex_table
+            changed = sql.select([si.c.customer_id]).distinct() \
+                           .where(si.c.id > (self.version[0] or 0))
+            customer_ids = [row[0] for row in meta.Session.execute(changed)]
+            if customer_ids:
+                rows = meta.Session.execute(
+                    model.search_rows_query(customer_ids)).fetchall()
+                self.apply(customer_ids, rows)
+            self.version = version
+            if self.version[1] != len(self.rows):
+                # Customers were deleted
+                self.load()
+
+    def _add(self, rows):
+        for row in rows:
+            key = (row.customers_id, row.machines_id, row.services_id)
+            text = model.search_text(row)
+            self.rows[key] = row
+            self.texts[key] = text
+            self.by_customer[row.customers_id].add(key)
+            for tri in trigrams(text.lower()):
+                self.by_trigram[tri].add(key)
+
+    def _remove(self, key):
+        del self.rows[key]
+        for tri in trigrams(self.texts.pop(key).lower()):
+            keys = self.by_trigram[tri]
+            keys.discard(key)
+            if not keys:
+                del self.by_trigram[tri]
+
+    def _candidates(self, words):
+        """Keys of the rows having all the trigrams required by `words`"""
+        candidates = None
+        for word in words:
+            if word.isdigit():
+                # Could match an ID instead
+                continue
+            for literal in required_literals(word):
+                for tri in trigrams(literal):
+                    keys = self.by_trigram.get(tri, set())
+                    if candidates is None:
+                        candidates = set(keys)
+                    else:
+                        candidates &= keys
+                    if not candidates:
+                        return candidates
+        if candidates is None:
+            candidates = set(self.rows)
+        return candidates
+
+    def search(self, swords, filters=None, limit=None, after=None,
+               user_id=None):
+        """Same as model.search_query, with words being regexps"""
+        if self.shared:
+            self.sync()
+
+        filters = dict((x, filters[x]) for x in filters or {} if filters[x])
+        in_groups = None
+        if 'groups' in filters:
+            sg = model.servicegroups_table
+            sel = sql.select([sg.c.service_id]) \
+                       .where(sg.c.group_id.in_(filters['groups']))
+            in_groups = set(row[0] for row in meta.Session.execute(sel))
+        accessible = None
+        if user_id is not None:
+            sel = model.accessible_services(user_id)
+            accessible = set(row[0] for row in meta.Session.execute(sel))
+
+        regexps = [(word, compile_word(word)) for word in swords]
+        if after:
+            after = tuple(after)
+        # The regexps are matched outside of the lock, not to hold the other
+        # searches and the updates
+        with self.lock:
+            candidates = []
+            for key in self._candidates(swords):
+                customer_id, machine_id, service_id = key
+                if 'customers' in filters and \
+                   customer_id not in filters['customers']:
+                    continue
+                if 'machines' in filters and \
+                   machine_id not in filters['machines']:
+                    continue
+                if in_groups is not None and service_id not in in_groups:
+                    continue
+                if accessible is not None and service_id not in accessible:
+                    continue
+                if after and model.search_sort_key(self.rows[key]) <= after:
+                    continue
+                candidates.append((key, self.rows[key], self.texts[key]))
+
+        out = []
+        for key, row, text in candidates:
+            text = clip_lines(text)
+            for word, regexp in regexps:
+                if word.isdigit() and int(word) in key:
+                    continue
+                if not regexp.search(text):
+                    break
+            else:
+                out.append(row)
+
+        if limit:
+            return heapq.nsmallest(limit, out, key=model.search_sort_key)
+        return sorted(out, key=model.search_sort_key)
@@ -0,0 +1,187 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Storage for the authenticated sessions (authtok) of the vault users.
+
+Sessions are kept as compact `VaultSession` records, and are stored in a
+backend chosen with `sflvault.sessions.backend`:
+
+  memory -- in the server process (the default)
+  sqlite -- in the `sflvault.sessions.file` SQLite file, which can be
+            shared by several server processes (see `sflvault.processes`)
+
+Both backends have the same methods:
+
+  set(authtok, session) -- store the VaultSession under authtok
+  get(authtok)          -- return the VaultSession, or None
+  delete(authtok)
+  purge(now=None)       -- drop the sessions expired at `now`
+  count(now=None)       -- return the number of sessions not expired at `now`
+
+Expired sessions are dropped by the backend itself, but `get` may still
+return a session past its timeout: checking it is the caller's job.
+"""
+
+from collections import namedtuple
+from datetime import datetime
+import heapq
+import os
+import sqlite3
+import threading
+import time
+
+
+VaultSession = namedtuple('VaultSession', ['user_id', 'username', 'is_admin',
+                                           'remote_addr', 'timeout'])
+
+
+class MemorySessionBackend(object):
+    """Sessions kept in this process's memory.
+
+    A heap of (timeout, authtok) is kept along the sessions, so that expired
+    sessions are dropped when new ones are added, without scanning them all.
+    """
+
+    def __init__(self):
+        self.sessions = {}
+        self.expiry = []
+        self.lock = threading.Lock()
+
+    def set(self, authtok, session):
+        with self.lock:
+            self._purge(datetime.now())
+            self.sessions[authtok] = session
+            heapq.heappush(self.expiry, (session.timeout, authtok))
+
+    def get(self, authtok):
+        with self.lock:
+            return self.sessions.get(authtok)
+
+    def delete(self, authtok):
+        with self.lock:
+            self.sessions.pop(authtok, None)
+
+    def purge(self, now=None):
+        with self.lock:
+            self._purge(now or datetime.now())
+
+    def count(self, now=None):
+        now = now or datetime.now()
+        with self.lock:
+            return sum(1 for s in self.sessions.itervalues()
+                       if s.timeout >= now)
+
+    def _purge(self, now):
+        while self.expiry and self.expiry[0][0] < now:
+            timeout, authtok = heapq.heappop(self.expiry)
+            sess = self.sessions.get(authtok)
+            # The entry may be stale: deleted, or replaced by a later session
+            if sess is not None and sess.timeout == timeout:
+                del self.sessions[authtok]
+
+
+class SQLiteSessionBackend(object):
+    """Sessions kept in a SQLite file, shared by all the processes using it.
+
+    Expired sessions are deleted when new ones are added, using the index
+    on the timeout column.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.local = threading.local()
+
+        conn = sqlite3.connect(self.filename)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS sessions ("
+                     "authtok TEXT PRIMARY KEY, "
+                     "user_id INTEGER, "
+                     "username TEXT, "
+                     "is_admin INTEGER, "
+                     "remote_addr TEXT, "
+                     "timeout REAL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS sessions_timeout "
+                     "ON sessions (timeout)")
+        conn.commit()
+        conn.close()
+
+    def _connection(self):
+        """Return a connection for the current thread.
+
+        sqlite3 connections can't be shared between threads, nor between
+        forked processes."""
+        pid = os.getpid()
+        if getattr(self.local, 'pid', None) != pid:
+            self.local.conn = sqlite3.connect(self.filename, timeout=10,
+                                              isolation_level=None)
+            self.local.pid = pid
+        return self.local.conn
+
+    def set(self, authtok, session):
+        conn = self._connection()
+        conn.execute("DELETE FROM sessions WHERE timeout < ?",
+                     (time.time(),))
+        conn.execute(
+            "INSERT OR REPLACE INTO sessions (authtok, user_id, username, "
+            "is_admin, remote_addr, timeout) VALUES (?, ?, ?, ?, ?, ?)",
+            (authtok, session.user_id, session.username,
+             bool(session.is_admin), session.remote_addr,
+             _to_timestamp(session.timeout)))
+
+    def get(self, authtok):
+        row = self._connection().execute(
+            "SELECT user_id, username, is_admin, remote_addr, timeout "
+            "FROM sessions WHERE authtok = ?", (authtok,)).fetchone()
+        if row is None:
+            return None
+        return VaultSession(user_id=row[0],
+                            username=row[1],
+                            is_admin=bool(row[2]),
+                            remote_addr=row[3],
+                            timeout=datetime.fromtimestamp(row[4]))
+
+    def delete(self, authtok):
+        self._connection().execute("DELETE FROM sessions WHERE authtok = ?",
+                                   (authtok,))
+
+    def purge(self, now=None):
+        self._connection().execute("DELETE FROM sessions WHERE timeout < ?",
+                                   (_to_timestamp(now or datetime.now()),))
+
+    def count(self, now=None):
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM sessions WHERE timeout >= ?",
+            (_to_timestamp(now or datetime.now()),)).fetchone()[0]
+
+
+def session_backend_from_settings(settings):
+    """Create the session backend configured in `settings`"""
+    backend = settings.get('sflvault.sessions.backend', 'memory')
+    if backend == 'memory':
+        return MemorySessionBackend()
+    elif backend == 'sqlite':
+        return SQLiteSessionBackend(settings['sflvault.sessions.file'])
+    raise ValueError("Unknown sflvault.sessions.backend: %s" % backend)
+
+
+def _to_timestamp(dt):
+    """Convert a datetime to seconds since the epoch"""
+    return time.mktime(dt.timetuple()) + dt.microsecond / 1000000.0
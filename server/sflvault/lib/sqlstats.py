@@ -0,0 +1,119 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Count the SQL statements run by each XML-RPC call, and their time.
+
+`XMLRPCDispatcher._dispatch` records each call with `recording(method)`.
+Calls running more than `sflvault.sql.max_statements` statements, or
+spending more than `sflvault.sql.max_time` seconds in the database, are
+logged along with their statements.
+
+The recorder of the last call of each method is kept in `last`, for the
+tests to check the query budget of the calls:
+
+  self.assertTrue(sqlstats.last['sflvault.user_list'].count <= 2)
+"""
+
+from contextlib import contextmanager
+import logging
+import threading
+import time
+
+from sqlalchemy import event
+
+log = logging.getLogger(__name__)
+
+
+# Thresholds over which a call is logged, 0 to disable
+max_statements = 0
+max_time = 0
+
+# {method: SQLRecorder} of the last call of each method
+last = {}
+
+# The recorder of the call running in this thread
+_current = threading.local()
+
+
+def init_sqlstats(engine, statements=0, seconds=0):
+    """Hook the recorder to `engine`, and set the logging thresholds"""
+    global max_statements, max_time
+    max_statements = statements
+    max_time = seconds
+    if not getattr(engine, 'sqlstats', False):
+        event.listen(engine, 'before_cursor_execute', _before_execute)
+        event.listen(engine, 'after_cursor_execute', _after_execute)
+        engine.sqlstats = True
+
+
+def _before_execute(conn, cursor, statement, parameters, context,
+                    executemany):
+    if getattr(_current, 'recorder', None) is not None:
+        conn.info.setdefault('sqlstats_start', []).append(time.time())
+
+def _after_execute(conn, cursor, statement, parameters, context,
+                   executemany):
+    recorder = getattr(_current, 'recorder', None)
+    starts = conn.info.get('sqlstats_start')
+    if recorder is not None and starts:
+        recorder.add(statement, time.time() - starts.pop())
+
+
+class SQLRecorder(object):
+    """The statements run by one call, with their time"""
+
+    def __init__(self, method):
+        self.method = method
+        self.statements = []
+        self.time = 0.0
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def add(self, statement, duration):
+        self.statements.append((statement, duration))
+        self.time += duration
+
+    def over_thresholds(self):
+        return ((max_statements and self.count > max_statements) or
+                (max_time and self.time > max_time))
+
+    def log(self):
+        log.warning("%s ran %d SQL statements in %.3fs" %
+                    (self.method, self.count, self.time))
+        for statement, duration in self.statements:
+            log.warning("  %.3fs %s" % (duration, ' '.join(statement.split())))
+
+
+@contextmanager
+def recording(method):
+    """Record the statements run in this thread during the call to `method`"""
+    recorder = SQLRecorder(method)
+    previous = getattr(_current, 'recorder', None)
+    _current.recorder = recorder
+    try:
+        yield recorder
+    finally:
+        _current.recorder = previous
+        last[method] = recorder
+        if recorder.over_thresholds():
+            recorder.log()
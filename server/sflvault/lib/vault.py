@@ -33,15 +33,24 @@ return clean responses to clean queries.
 """
 
 
+from base64 import b64decode, b64encode
+import json
 import xmlrpclib
 
-from sqlalchemy import sql
+from decorator import decorator
+
+from sqlalchemy import sql, types
 from sqlalchemy.exc import InvalidRequestError as InvalidReq
-from sqlalchemy.orm import eagerload_all
+from sqlalchemy.orm import eagerload_all, undefer, undefer_group
 
 from sflvault import model
 from sflvault.model import *
 from sflvault.common import VaultError
+from sflvault.common import crypto
+from sflvault.lib import keypool
+from sflvault.lib import searchcache
+from sflvault.lib import searchengine
+from sflvault.lib.cryptpool import encrypt_many
 
 
 from datetime import timedelta
@@ -58,6 +67,15 @@ def vaultMsg(success, message, dict=None):
             ret[x] = dict[x]
     return ret
 
+@decorator
+def changes_vault(func, self, *args, **kwargs):
+    """Marks the SFLvaultAccess methods changing the vault: the searches
+    cached before them are stale"""
+    try:
+        return func(self, *args, **kwargs)
+    finally:
+        searchcache.bump()
+
 class SFLvaultAccess(object):
 
     def _dispatch(self, method, params):
@@ -95,6 +113,7 @@ class SFLvaultAccess(object):
         self._log_any(log.warning, msg, data)
 
 
+    @changes_vault
     def user_setup(self, username, pubkey):
         """Setup the user's account"""
 
@@ -129,6 +148,7 @@ class SFLvaultAccess(object):
         return vaultMsg(True, 'User setup complete for %s' % username)
 
 
+    @changes_vault
     def user_add(self, username, is_admin, setup_timeout=300):
         usr = query(User).filter_by(username=username).first()
 
@@ -173,6 +193,7 @@ class SFLvaultAccess(object):
                              msg, int(setup_timeout)), {'user_id': uid})
 
 
+    @changes_vault
     def user_del(self, user):
         transaction.begin()
         """Delete a user from database.
@@ -193,6 +214,7 @@ class SFLvaultAccess(object):
         # to a group which holds some passwords.
 
         t1 = model.usergroups_table
+        model.record_deletes(t1, t1.c.user_id==usr.id)
         meta.Session.execute(t1.delete(t1.c.user_id==usr.id))
         username = usr.username
         meta.Session.delete(usr)
@@ -210,7 +232,7 @@ class SFLvaultAccess(object):
         req = query(User)
         if groups:
             req = req.options(eagerload_all('groups_assoc.group'))
-        lst = query(User).all()
+        lst = req.all()
 
         out = []
         for x in lst:
@@ -242,6 +264,13 @@ class SFLvaultAccess(object):
         return vaultMsg(True, "Here is the user list", {'list': out})
 
 
+    def _update_search_index(self, customers=(), machines=()):
+        """Update the search index, and the in-memory search engine once
+        committed"""
+        customer_ids, rows = model.update_search_index(customers, machines)
+        if searchengine.engine:
+            searchengine.engine.apply_on_commit(customer_ids, rows)
+
     def service_get(self, service_id, group_id=None):
         """Get a single service's data.
 
@@ -255,6 +284,7 @@ class SFLvaultAccess(object):
         return vaultMsg(True, "Here is the service", {'service': out})
 
 
+    @changes_vault
     def service_put(self, service_id, data):
         """Put a single service's data back to the vault's database"""
         try:
@@ -269,6 +299,7 @@ class SFLvaultAccess(object):
         # url
         # notes
         # location
+        old_machine_id = s.machine_id
         if 'machine_id' in data:
             s.machine_id = int(data['machine_id'])
         if 'parent_service_id' in data:
@@ -283,6 +314,7 @@ class SFLvaultAccess(object):
         if 'metadata' in data:
             s.metadata = data['metadata']
 
+        self._update_search_index(machines=[old_machine_id, s.machine_id])
         transaction.commit()
 
         self.log_i('Service s#(service_id)s saved successfully' ,
@@ -292,7 +324,8 @@ class SFLvaultAccess(object):
     def _service_get_data(self, service_id, group_id=None, with_groups=False):
         """Retrieve the information for a given service."""
         try:
-            s = query(Service).filter_by(id=service_id).one()
+            s = query(Service).options(undefer_group('details')) \
+                              .filter_by(id=service_id).one()
         except InvalidReq, e:
             self.log_w('Service not found: %(service_id)s (%(error)s)',
                        {"service_id": service_id, "error": str(e)})
@@ -354,30 +387,166 @@ class SFLvaultAccess(object):
 
         return out
 
-    def service_get_tree(self, service_id, with_groups=False):
-        """Get a service tree, starting with service_id"""
+    def _service_get_chain(self, service_id):
+        """Retrieve a service and all its parents, in one query.
 
-        out = []
-        while True:
-            try:
-                data = self._service_get_data(service_id,
-                                              with_groups=with_groups)
-            except VaultError, e:
-                self.log_e('Show service: %(error)s', {"error": str(e)})
-                return vaultMsg(False, str(e))
+        Walks `parent_service_id` with a recursive CTE, which stops on the
+        first service seen twice in a chain (then flagged with `cycle`).
+        Each service comes with the caller's `cryptgroupkey` and
+        `cryptsymkey`, one row per group giving access to it.
 
-            out.append(data)
+        Returns rows ordered from the service to its top-most parent.
+        """
+        s = services_table
+        # No bind parameters in the CTE but service_id: they would be
+        # numbered out of order on SQLite.
+        const = sql.literal_column
+        path = lambda id: const("','") + sql.cast(id, types.String) + \
+                          const("','")
+
+        chain = sql.select([s.c.id,
+                            s.c.parent_service_id,
+                            const('0').label('depth'),
+                            path(s.c.id).label('path'),
+                            const('0').label('cycle')]) \
+                   .where(s.c.id == service_id) \
+                   .cte('chain', recursive=True)
+        parent = s.alias('parent')
+        chain = chain.union_all(
+            sql.select([parent.c.id,
+                        parent.c.parent_service_id,
+                        chain.c.depth + const('1'),
+                        chain.c.path + sql.cast(parent.c.id, types.String) +
+                            const("','"),
+                        sql.case([(chain.c.path.like(const("'%'") +
+                                                     path(parent.c.id) +
+                                                     const("'%'")),
+                                   const('1'))],
+                                 else_=const('0'))])
+               .where(parent.c.id == chain.c.parent_service_id)
+               .where(chain.c.cycle == const('0')))
+
+        keys = self._service_keys()
+        req = sql.select([chain.c.cycle,
+                          s,
+                          keys.c.group_id,
+                          keys.c.cryptsymkey,
+                          keys.c.cryptgroupkey],
+                         from_obj=[chain.join(s, s.c.id == chain.c.id)
+                                        .outerjoin(keys,
+                                                   keys.c.service_id ==
+                                                   chain.c.id)],
+                         use_labels=True) \
+                 .order_by(chain.c.depth, keys.c.group_id)
+
+        result = meta.Session.execute(req)
+        # pysqlite only describes the columns of a WITH statement returning
+        # rows: without any, it's a result "not returning rows"
+        if not result.returns_rows:
+            return []
+        return result.fetchall()
+
+    def _service_keys(self):
+        """Select the caller's keys for each group of the services, as
+        (service_id, group_id, cryptsymkey, cryptgroupkey)"""
+        return sql.select([servicegroups_table.c.service_id,
+                           servicegroups_table.c.group_id,
+                           servicegroups_table.c.cryptsymkey,
+                           usergroups_table.c.cryptgroupkey]) \
+                  .where(servicegroups_table.c.group_id ==
+                         usergroups_table.c.group_id) \
+                  .where(usergroups_table.c.user_id == self.myself_id) \
+                  .alias('keys')
+
+    def _service_row_data(self, row):
+        """Return the service's data, as in service_get, from a row of
+        services joined with _service_keys()"""
+        return {'id': row.services_id,
+                'url': row.services_url,
+                'secret': row.services_secret,
+                'machine_id': row.services_machine_id,
+                'cryptgroupkey': row.keys_cryptgroupkey or '',
+                'cryptsymkey': row.keys_cryptsymkey or '',
+                'group_id': row.keys_group_id or '',
+                'groups_list': None,
+                'parent_service_id': row.services_parent_service_id,
+                'secret_last_modified': row.services_secret_last_modified,
+                'metadata': row.services_metadata or {},
+                'notes': row.services_notes or ''}
+
+    def service_get_many(self, service_ids):
+        """Get many services' data at once, as service_get does, in one
+        query.
+
+        Services are returned in the order of service_ids. The IDs of
+        those which don't exist are listed in `not_found`.
+        """
+        try:
+            service_ids = [int(x) for x in service_ids]
+        except (TypeError, ValueError), e:
+            return vaultMsg(False, "Invalid service IDs: %s" % e)
+        if not service_ids:
+            return vaultMsg(True, "Here are the services",
+                            {'services': [], 'not_found': []})
+
+        s = services_table
+        keys = self._service_keys()
+        req = sql.select([s, keys.c.group_id, keys.c.cryptsymkey,
+                          keys.c.cryptgroupkey],
+                         from_obj=[s.outerjoin(keys,
+                                               keys.c.service_id == s.c.id)],
+                         use_labels=True) \
+                 .where(s.c.id.in_(set(service_ids))) \
+                 .order_by(s.c.id, keys.c.group_id)
+
+        # Keep the first group's keys for each service
+        found = {}
+        for row in meta.Session.execute(req):
+            if row.services_id not in found:
+                found[row.services_id] = self._service_row_data(row)
+
+        out = [found[x] for x in service_ids if x in found]
+        not_found = [x for x in service_ids if x not in found]
+        self.log_i('Services fetched: %(count)d', {'count': len(out)})
+        return vaultMsg(True, "Here are the services",
+                        {'services': out, 'not_found': not_found})
 
-            if not data['parent_service_id']:
-                break
+    def service_get_tree(self, service_id, with_groups=False):
+        """Get a service tree, starting with service_id"""
 
-            # Load the parent...
-            service_id = data['parent_service_id']
+        rows = self._service_get_chain(service_id)
+        if not rows:
+            self.log_e('Show service: %(error)s',
+                       {"error": "Service not found: %s" % service_id})
+            return vaultMsg(False, "Service not found: %s" % service_id)
 
-            # check if we're not in an infinite loop!
-            if service_id in [x['id'] for x in out]:
+        # Keep the first group's keys for each service
+        out = []
+        for row in rows:
+            if row.chain_cycle:
                 self.log_e('Circular references of parent services, aborting.', {})
                 return vaultMsg(False, "Circular references of parent services, aborting.")
+            if out and out[-1]['id'] == row.services_id:
+                continue
+            out.append(self._service_row_data(row))
+
+        parent_id = out[-1]['parent_service_id']
+        if parent_id:
+            self.log_e('Show service: %(error)s',
+                       {"error": "Service not found: %s" % parent_id})
+            return vaultMsg(False, "Service not found: %s" % parent_id)
+
+        # Load groups too if required
+        if with_groups:
+            groups = dict((data['id'], []) for data in out)
+            req = sql.join(groups_table, servicegroups_table) \
+                     .select(use_labels=True) \
+                     .where(ServiceGroup.service_id.in_(groups.keys()))
+            for grp in meta.Session.execute(req):
+                groups[grp.services_groups_service_id].append(
+                    (grp.groups_id, grp.groups_name))
+            for data in out:
+                data['groups_list'] = groups[data['id']]
 
         out.reverse()
 
@@ -395,13 +564,37 @@ class SFLvaultAccess(object):
         return self.service_get_tree(service_id, with_groups)
 
 
-    def search(self, search_query, filters=None, verbose=False):
+    def search(self, search_query, filters=None, verbose=False, limit=None,
+               cursor=None, accessible_only=False):
         """Do the search, and return the result tree.
 
         filters - must be a dictionary with options on which to constraint
                   results.
+        limit - return at most that many services (or machines or customers
+                without services). If there are more, `has_more` is set in
+                the result, along with the `cursor` to get the next ones.
+        cursor - as returned by the previous search, to get the next results
+        accessible_only - return only the services we have access to
 
         """
+        if searchcache.cache:
+            key = searchcache.search_key(self.myself_id, search_query, filters,
+                                         verbose, limit, cursor,
+                                         accessible_only)
+            gen = searchcache.generation.value
+            result = searchcache.cache.get(key)
+            if result is None:
+                result = self._search(search_query, filters, verbose, limit,
+                                      cursor, accessible_only)
+                if not result['error']:
+                    searchcache.cache.put(key, result, gen)
+            return result
+        return self._search(search_query, filters, verbose, limit, cursor,
+                            accessible_only)
+
+    def _search(self, search_query, filters, verbose, limit, cursor,
+                accessible_only):
+        """Do the search, see search()"""
         filter_types = ['groups', 'machines', 'customers']
         # Load objects on which to restrict the query:
         newfilters = {}
@@ -424,7 +617,33 @@ class SFLvaultAccess(object):
                     self.log_e('Search error: %(error)s', {"error": str(e)})
                     return vaultMsg(False, str(e))
 
-        search = model.search_query(search_query, newfilters, verbose)
+        after = None
+        if cursor:
+            try:
+                after = json.loads(b64decode(cursor))
+                assert isinstance(after, list) and len(after) == 5
+            except Exception:
+                self.log_e('Search error: invalid cursor', {})
+                return vaultMsg(False, "Invalid search cursor")
+        # Get one more result, to know if there are more
+        fetch = limit + 1 if limit else None
+        user_id = self.myself_id if accessible_only else None
+
+        if searchengine.engine:
+            search = searchengine.engine.search(search_query, newfilters,
+                                                fetch, after, user_id)
+        else:
+            search = model.search_query(search_query, newfilters, verbose,
+                                        fetch, after, user_id)
+
+        more = {'has_more': False}
+        if limit:
+            search = list(search)
+            if len(search) > limit:
+                search = search[:limit]
+                last = model.search_sort_key(search[-1])
+                more = {'has_more': True,
+                        'cursor': b64encode(json.dumps(last))}
 
 
         # Quick helper funcs, to create the hierarchical 'out' structure.
@@ -468,7 +687,8 @@ class SFLvaultAccess(object):
         # Return 'out', in a nicely structured hierarchical form.
         #self.log_i('Search successfull for: %(search)s',
         #            {'search': search_query})
-        return vaultMsg(True, "Here are the search results", {'results': out})
+        more['results'] = out
+        return vaultMsg(True, "Here are the search results", more)
 
 
     def customer_get(self, customer_id):
@@ -484,6 +704,7 @@ class SFLvaultAccess(object):
 
         return vaultMsg(True, "Here is the customer", {'customer': out})
 
+    @changes_vault
     def customer_put(self, customer_id, data):
         """Put a single customer's data back to the Vault"""
         try:
@@ -496,6 +717,7 @@ class SFLvaultAccess(object):
         if 'name' in data:
             cust.name = data['name']
 
+        self._update_search_index(customers=[cust.id])
         transaction.commit()
 
         self.log_i('Customer c#%(customer_id)s saved successfully)s',
@@ -503,6 +725,7 @@ class SFLvaultAccess(object):
         return vaultMsg(True, "Customer c#%s saved successfully" % customer_id)
 
 
+    @changes_vault
     def customer_add(self, customer_name):
         """Add a new customer to the database"""
         nc = Customer()
@@ -517,12 +740,14 @@ class SFLvaultAccess(object):
         meta.Session.add(nc)
         meta.Session.flush()
         cid = nc.id
+        self._update_search_index(customers=[cid])
         transaction.commit()
 #        meta.Session.refresh(nc)
         #self.log_i('Customer add: c#%s' % cid)
         return vaultMsg(True, 'Customer added', {'customer_id': cid})
 
 
+    @changes_vault
     def machine_put(self, machine_id, data):
         transaction.begin()
         """Put a single machine's data back to the vault"""
@@ -533,12 +758,14 @@ class SFLvaultAccess(object):
                    {"machine_id": machine_id})
             return vaultMsg(False, "Machine not found: %s" % str(e))
 
+        old_customer_id = m.customer_id
         if 'customer_id' in data:
             m.customer_id = int(data['customer_id'])
 
         for x in ['ip', 'name', 'fqdn', 'location', 'notes']:
             if x in data:
                 m.__setattr__(x, data[x])
+        self._update_search_index(customers=[old_customer_id, m.customer_id])
         transaction.commit()
 
         self.log_i('Machine m#%(machine_id)s saved successfully',
@@ -564,6 +791,7 @@ class SFLvaultAccess(object):
         return vaultMsg(True, "Here is the machine", {'machine': out})
 
 
+    @changes_vault
     def machine_add(self, customer_id, name, fqdn, ip, location, notes):
         """Add a new machine to the database"""
 
@@ -582,19 +810,21 @@ class SFLvaultAccess(object):
         meta.Session.flush()
         nmid = nm.id
 
-
+        self._update_search_index(customers=[nm.customer_id])
         transaction.commit()
 
         self.log_i('Machine added: m#%(machine_id)s', {"machine_id": nmid})
         return vaultMsg(True, "Machine added.", {'machine_id': nmid})
 
 
+    @changes_vault
     def service_add(self, machine_id, parent_service_id, url,
                     group_ids, secret, notes, metadata):
         # Get groups
         try:
             groups, group_ids = model.get_objects_list(group_ids, 'groups',
-                                                       return_objects=True)
+                                                       return_objects=True,
+                                                       undefer_='pubkey')
         except ValueError, e:
             return vaultMsg(False, str(e))
 
@@ -624,12 +854,11 @@ class SFLvaultAccess(object):
         meta.Session.add(ns)
 
         # Encrypt symkey for each group, using it's own ElGamal pubkey
-        for g in groups:
-            eg = g.elgamal()
-
+        cryptsymkeys = encrypt_many([(g.pubkey, seckey) for g in groups])
+        for g, cryptsymkey in zip(groups, cryptsymkeys):
             nsg = ServiceGroup()
             nsg.group_id = g.id
-            nsg.cryptsymkey = encrypt_longmsg(eg, seckey)
+            nsg.cryptsymkey = cryptsymkey
 
             ns.groups_assoc.append(nsg)
 
@@ -638,10 +867,187 @@ class SFLvaultAccess(object):
         meta.Session.flush()
         grouplist = [g.name for g in groups]
         nsid = ns.id
+        self._update_search_index(machines=[ns.machine_id])
         transaction.commit()
         return vaultMsg(True, "Service added.", {'service_id': nsid,
                                                  'encrypted_for': grouplist})
 
+    @changes_vault
+    def bulk_import(self, records):
+        """Add many customers, machines and services in one transaction.
+
+        records - list of dicts, each with a 'type' ('customer', 'machine'
+                  or 'service') and the arguments of customer_add (name),
+                  machine_add or service_add. A record can have a 'ref',
+                  which the next ones use to refer to it, in 'customer'
+                  (instead of 'customer_id'), 'machine' (instead of
+                  'machine_id') or 'parent' (instead of 'parent_service_id').
+
+        Invalid records are skipped, along with the ones referring to them.
+        Returns the result of each record, in order: {'id'}, or {'error'},
+        with its 'ref' if it had one.
+        """
+        # Load all the groups and existing objects referred to at once.
+        wanted = {'customer_id': set(), 'machine_id': set(),
+                  'parent_service_id': set(), 'group_ids': set()}
+        for rec in records:
+            for key in ('customer_id', 'machine_id', 'parent_service_id'):
+                if rec.get(key):
+                    # Invalid IDs are the record's error, see resolve()
+                    try:
+                        wanted[key].add(int(rec[key]))
+                    except (TypeError, ValueError):
+                        pass
+            if rec.get('type') == 'service':
+                try:
+                    wanted['group_ids'].update(int(x) for x in
+                                               rec.get('group_ids') or [])
+                except (TypeError, ValueError):
+                    pass
+        existing = {}
+        for key, cls in [('customer_id', Customer), ('machine_id', Machine),
+                         ('parent_service_id', Service)]:
+            existing[key] = set()
+            if wanted[key]:
+                existing[key] = set(x.id for x in meta.Session.execute(
+                    sql.select([cls.id]).where(cls.id.in_(wanted[key]))))
+        groups = {}
+        if wanted['group_ids']:
+            groups = dict((g.id, g) for g in query(Group)
+                          .options(undefer('pubkey'))
+                          .filter(Group.id.in_(wanted['group_ids'])))
+
+        def resolve(rec, ref_key, id_key, cls):
+            """Return the object or ID `rec` refers to"""
+            if rec.get(ref_key) is not None:
+                obj = refs.get(rec[ref_key])
+                if not isinstance(obj, cls):
+                    raise ValueError("Unknown %s reference: %s" %
+                                     (ref_key, rec[ref_key]))
+                return obj
+            if rec.get(id_key):
+                try:
+                    obj_id = int(rec[id_key])
+                except (TypeError, ValueError):
+                    raise ValueError("Invalid %s: %s" % (id_key, rec[id_key]))
+                if obj_id not in existing[id_key]:
+                    raise ValueError("No such %s: %s" % (id_key, rec[id_key]))
+                return obj_id
+            return None
+
+        refs = {}
+        results = []
+        # (ServiceGroup, pubkey, seckey), encrypted all at once
+        jobs = []
+        customer_ids = set()
+        machine_ids = set()
+        now = datetime.now()
+        for rec in records:
+            res = {}
+            if rec.get('ref') is not None:
+                res['ref'] = rec['ref']
+            results.append(res)
+            try:
+                rtype = rec.get('type')
+                if rtype == 'customer':
+                    if not rec.get('name'):
+                        raise ValueError("Missing required argument: name")
+                    obj = Customer()
+                    obj.name = rec['name']
+                    obj.created_time = now
+                    obj.created_user = self.myself_username
+                elif rtype == 'machine':
+                    if not rec.get('name'):
+                        raise ValueError("Missing required argument: name")
+                    customer = resolve(rec, 'customer', 'customer_id',
+                                       Customer)
+                    if customer is None:
+                        raise ValueError("Missing required argument: "
+                                         "customer_id")
+                    obj = Machine()
+                    if isinstance(customer, Customer):
+                        obj.customer = customer
+                    else:
+                        obj.customer_id = customer
+                        customer_ids.add(customer)
+                    obj.created_time = now
+                    obj.name = rec['name']
+                    for x in ['fqdn', 'ip', 'location', 'notes']:
+                        setattr(obj, x, rec.get(x) or '')
+                elif rtype == 'service':
+                    if not rec.get('url'):
+                        raise ValueError("Missing required argument: url")
+                    machine = resolve(rec, 'machine', 'machine_id', Machine)
+                    if machine is None:
+                        raise ValueError("Missing required argument: "
+                                         "machine_id")
+                    parent = resolve(rec, 'parent', 'parent_service_id',
+                                     Service)
+                    sgroups = [groups.get(int(x))
+                               for x in rec.get('group_ids') or []]
+                    if not sgroups or None in sgroups:
+                        raise ValueError("Invalid groups: %s" %
+                                         rec.get('group_ids'))
+                    obj = Service()
+                    if isinstance(machine, Machine):
+                        obj.machine = machine
+                    else:
+                        obj.machine_id = machine
+                        machine_ids.add(machine)
+                    if isinstance(parent, Service):
+                        obj.parent = parent
+                    else:
+                        obj.parent_service_id = parent
+                    obj.url = rec['url']
+                    obj.notes = rec.get('notes') or ''
+                    obj.metadata = rec.get('metadata') or {}
+                    (seckey, obj.secret) = encrypt_secret(rec.get('secret')
+                                                          or '')
+                    obj.secret_last_modified = now
+                    for g in sgroups:
+                        nsg = ServiceGroup()
+                        nsg.group_id = g.id
+                        obj.groups_assoc.append(nsg)
+                        jobs.append((nsg, g.pubkey, seckey))
+                    del(seckey)
+                else:
+                    raise ValueError("Unknown record type: %s" % rtype)
+            except (TypeError, ValueError), e:
+                res['error'] = str(e)
+                continue
+            if rec.get('ref') is not None:
+                refs[rec['ref']] = obj
+            res['obj'] = obj
+            meta.Session.add(obj)
+
+        cryptsymkeys = encrypt_many([(pubkey, seckey)
+                                     for nsg, pubkey, seckey in jobs])
+        for (nsg, pubkey, seckey), cryptsymkey in zip(jobs, cryptsymkeys):
+            nsg.cryptsymkey = cryptsymkey
+        del(jobs)
+
+        meta.Session.flush()
+        for res in results:
+            obj = res.pop('obj', None)
+            if isinstance(obj, Customer):
+                res['id'] = obj.id
+                customer_ids.add(obj.id)
+            elif isinstance(obj, Machine):
+                res['id'] = obj.id
+                customer_ids.add(obj.customer_id)
+            elif isinstance(obj, Service):
+                res['id'] = obj.id
+                machine_ids.add(obj.machine_id)
+        self._update_search_index(customers=customer_ids, machines=machine_ids)
+        transaction.commit()
+
+        errors = len([r for r in results if 'error' in r])
+        self.log_i('Bulk import: %(added)d added, %(errors)d errors',
+                   {'added': len(results) - errors, 'errors': errors})
+        return vaultMsg(True, "Imported %d records, %d errors" %
+                        (len(results) - errors, errors),
+                        {'results': results})
+
     def group_get(self, group_id):
         """Get a single group's data"""
         try:
@@ -668,6 +1074,7 @@ class SFLvaultAccess(object):
         return vaultMsg(True, "Here is the group", {'group': out})
 
 
+    @changes_vault
     def group_put(self, group_id, data):
         """Put a single group's data back to the Vault"""
         transaction.begin()
@@ -697,6 +1104,7 @@ class SFLvaultAccess(object):
         return vaultMsg(True, "Group g#%s saved successfully" % group_id)
 
 
+    @changes_vault
     def group_add(self, group_name, hidden=False):
         """Add a new group the database. Nothing will be added to it
         by default"""
@@ -705,8 +1113,8 @@ class SFLvaultAccess(object):
         me = query(User).get(self.myself_id)
         myeg = me.elgamal()
 
-        # Generate keypair
-        newkeys = generate_elgamal_keypair()
+        # Generate keypair, or take one generated ahead of time
+        newkeys = keypool.new_keypair()
 
         ng = Group()
         ng.name = group_name
@@ -716,18 +1124,22 @@ class SFLvaultAccess(object):
         meta.Session.add(ng)
 
         # Add myself to the group and all other global admins.
-        admins = set(query(User).filter_by(is_admin=True).all())
+        admins = set(query(User).options(undefer('pubkey'))
+                                .filter_by(is_admin=True).all())
         admins.add(me)
 
-        for usr in list(admins):
+        admins = list(admins)
+        grouppacked = serial_elgamal_privkey(elgamal_bothkeys(newkeys))
+        cryptgroupkeys = encrypt_many([(usr.pubkey, grouppacked)
+                                       for usr in admins])
+        del(grouppacked)
+        for usr, cryptgroupkey in zip(admins, cryptgroupkeys):
             nug = UserGroup()
             # Make sure I'm admin of my newly created group
             if usr == me:
                 nug.is_admin = True
             nug.user_id = usr.id
-            nug.cryptgroupkey = encrypt_longmsg(usr.elgamal(),
-                                                serial_elgamal_privkey(
-                                                    elgamal_bothkeys(newkeys)))
+            nug.cryptgroupkey = cryptgroupkey
             ng.users_assoc.append(nug)
         name = ng.name
         gid = ng.id
@@ -738,6 +1150,7 @@ class SFLvaultAccess(object):
                         {'name': name, 'group_id': int(gid),
                          'cryptgroupkey': key})
 
+    @changes_vault
     def group_del(self, group_id, delete_cascade=True):
         """Remove a group from the vault. Only if no services are associated
         with it anymore.
@@ -760,6 +1173,7 @@ class SFLvaultAccess(object):
                     
 
         # Delete UserGroup elements...
+        model.record_deletes(usergroups_table, UserGroup.group_id==grp.id)
         q1 = usergroups_table.delete(UserGroup.group_id==grp.id)
         meta.Session.execute(q1)
 
@@ -811,6 +1225,7 @@ class SFLvaultAccess(object):
         return vaultMsg(True, 'Here is the list of groups', {'list': out})
 
 
+    @changes_vault
     def group_add_service(self, group_id, service_id, symkey):
         """Add a service to a group.
 
@@ -844,6 +1259,7 @@ class SFLvaultAccess(object):
         return vaultMsg(True, "Added service to group successfully", {})
 
 
+    @changes_vault
     def group_del_service(self, group_id, service_id):
         """Remove the association between a group and a service, simply."""
         transaction.begin()
@@ -871,13 +1287,15 @@ class SFLvaultAccess(object):
         return vaultMsg(True, "Removed service from group successfully")
 
 
+    @changes_vault
     def group_add_user(self, group_id, user, is_admin=False,
                        cryptgroupkey=None):
         """Add a user to a group. Call once to retrieve information,
         and a second time with cryptgroupkey to save cipher information.
 
         The second call should give the group's privkey, encrypted by the
-        remote user for the user being added.
+        remote user for the user being added, in the encrypt_longmsg format
+        version returned by the first call.
 
         is_admin - Gives admin privileges to the user being added or not.
         user - User can be a username or a user_id
@@ -916,7 +1334,8 @@ class SFLvaultAccess(object):
             ret = {'user_id': int(usr.id),
                    'group_id': int(group_id),
                    'userpubkey': usr.pubkey,
-                   'cryptgroupkey': ug.cryptgroupkey}
+                   'cryptgroupkey': ug.cryptgroupkey,
+                   'version': crypto.LONGMSG_VERSION}
             return vaultMsg(True, "Continue, send the cryptgroupkey back, encrypted by the userpubkey provided", ret)
 
         nug = UserGroup()
@@ -936,6 +1355,66 @@ class SFLvaultAccess(object):
         return vaultMsg(True, "Added user to group successfully")
 
 
+    def rewrap_list(self):
+        """Return what I must re-encrypt in the current encrypt_longmsg
+        format (see `rewrap_store`).
+
+        Only the members of a group can decrypt its symkeys, and only I can
+        decrypt my cryptgroupkeys, so each user must rewrap his own.
+        """
+        groups = []
+        symkeys = []
+        for ug in query(UserGroup).filter_by(user_id=self.myself_id).all():
+            groups.append({'group_id': ug.group_id,
+                           'cryptgroupkey': ug.cryptgroupkey})
+            sgs = query(ServiceGroup).filter_by(group_id=ug.group_id).all()
+            for sg in sgs:
+                if longmsg_version(sg.cryptsymkey) < crypto.LONGMSG_VERSION:
+                    symkeys.append({'service_id': sg.service_id,
+                                    'group_id': sg.group_id,
+                                    'cryptsymkey': sg.cryptsymkey})
+
+        me = query(User).get(self.myself_id)
+        return vaultMsg(True, "Here are the keys to rewrap",
+                        {'version': crypto.LONGMSG_VERSION,
+                         'userpubkey': me.pubkey,
+                         'groups': groups,
+                         'symkeys': symkeys})
+
+    @changes_vault
+    def rewrap_store(self, groupkeys, symkeys):
+        """Save keys re-encrypted from what rewrap_list returned.
+
+        groupkeys - list of [group_id, cryptgroupkey], for my groups
+        symkeys - list of [service_id, group_id, cryptsymkey]
+        """
+        transaction.begin()
+        my_groups = dict((ug.group_id, ug) for ug in
+                         query(UserGroup).filter_by(user_id=self.myself_id))
+
+        for group_id, cryptgroupkey in groupkeys:
+            if group_id not in my_groups:
+                return vaultMsg(False, "You are not part of group g#%s" %
+                                group_id)
+            my_groups[group_id].cryptgroupkey = cryptgroupkey
+
+        for service_id, group_id, cryptsymkey in symkeys:
+            if group_id not in my_groups:
+                return vaultMsg(False, "You are not part of group g#%s" %
+                                group_id)
+            sg = query(ServiceGroup).filter_by(service_id=service_id,
+                                               group_id=group_id).first()
+            if not sg:
+                return vaultMsg(False, "Service s#%s is not in group g#%s" %
+                                (service_id, group_id))
+            sg.cryptsymkey = cryptsymkey
+
+        transaction.commit()
+        return vaultMsg(True, "Rewrapped %d group keys and %d symkeys" %
+                        (len(groupkeys), len(symkeys)))
+
+
+    @changes_vault
     def group_del_user(self, group_id, user):
         """Remove the association between a group and a user.
 
@@ -1005,6 +1484,7 @@ class SFLvaultAccess(object):
         return vaultMsg(True, "Removed user from group successfully" + ohoh, {})
 
 
+    @changes_vault
     def customer_del(self, customer_id):
         """Delete a customer from database, bringing along all it's machines
         and services
@@ -1044,6 +1524,8 @@ class SFLvaultAccess(object):
 
         # Delete all related groupciphers
         if servs_ids:
+            model.record_deletes(servicegroups_table,
+                                 ServiceGroup.service_id.in_(servs_ids))
             query(model.ServiceGroup)\
                 .filter(model.ServiceGroup.service_id.in_(servs_ids))\
                 .delete(synchronize_session=False)
@@ -1056,6 +1538,7 @@ class SFLvaultAccess(object):
         # d3 = sql.delete(model.machines_table) \
         #        .where(model.machines_table.c.id.in_(mach_ids))
         if mach_ids:
+            model.record_changes('machines', mach_ids)
             query(model.Machine)\
                 .filter(model.Machine.id.in_(mach_ids))\
                 .delete(synchronize_session=False)
@@ -1063,18 +1546,21 @@ class SFLvaultAccess(object):
         # d4 = sql.delete(model.customers_table) \
         #        .where(model.customers_table.c.id == customer_id)
 
+        model.record_changes('customers', [int(customer_id)])
         query(model.Customer).filter(model.Customer.id==customer_id).delete(synchronize_session=False)
         # meta.Session.execute(d)
         # meta.Session.execute(d2)
         # meta.Session.execute(d3)
         # meta.Session.execute(d4)
 
+        self._update_search_index(customers=[customer_id])
         transaction.commit()
 
         return vaultMsg(True,
                         'Deleted customer c#%s successfully' % customer_id)
 
 
+    @changes_vault
     def machine_del(self, machine_id):
         """Delete a machine from database, bringing on all child services."""
         transaction.begin()
@@ -1083,6 +1569,7 @@ class SFLvaultAccess(object):
 
         if not machine:
             return vaultMsg(True, "No such machine: m#%s" % machine_id)
+        customer_id = machine.customer_id
 
         # Get all the services that will be deleted
         servs = query(model.Service).join('machine') \
@@ -1110,12 +1597,16 @@ class SFLvaultAccess(object):
                             {'childs': retval})
 
         if servs_ids:
+            model.record_deletes(servicegroups_table,
+                                 ServiceGroup.service_id.in_(servs_ids))
             query(model.ServiceGroup)\
                 .filter(model.ServiceGroup.service_id.in_(servs_ids))\
                 .delete(synchronize_session=False)
+            model.record_changes('services', servs_ids)
             query(model.Service)\
                 .filter(model.Service.id.in_(servs_ids))\
                 .delete(synchronize_session=False)
+        model.record_changes('machines', [int(machine_id)])
         query(model.Machine).filter(model.Machine.id==machine_id).delete(synchronize_session=False)
         # Delete all related groupciphers
 #        raise Exception
@@ -1132,11 +1623,13 @@ class SFLvaultAccess(object):
  #       meta.Session.execute(d2)
  #       meta.Session.execute(d3)
 
+        self._update_search_index(customers=[customer_id])
         transaction.commit()
 
         return vaultMsg(True, 'Deleted machine m#%s successfully' % machine_id)
 
 
+    @changes_vault
     def service_del(self, service_id):
         """Delete a service, making sure no other child remains attached."""
         # Integerize
@@ -1163,17 +1656,76 @@ class SFLvaultAccess(object):
         #  service is in, otherwise, disallow.
 
         # Delete all related user-ciphers
+        model.record_deletes(servicegroups_table,
+                             ServiceGroup.service_id == service_id)
         query(model.ServiceGroup).filter(model.ServiceGroup.service_id == service_id).delete(synchronize_session=False)
         # Delete the service
+        machine_id = serv.machine_id
+        model.record_changes('services', [service_id])
         query(Service).filter(model.Service.id==service_id).delete(synchronize_session=False)
+        self._update_search_index(machines=[machine_id])
         transaction.commit()
 
         return vaultMsg(True, 'Deleted service s#%s successfully' % service_id)
 
 
 
+    # Columns returned by changes_since, for each table
+    changes_columns = {
+        'customers': ['id', 'name'],
+        'machines': ['id', 'customer_id', 'name', 'fqdn', 'ip', 'location',
+                     'notes'],
+        'services': ['id', 'machine_id', 'parent_service_id', 'url', 'notes',
+                     'metadata', 'secret_last_modified'],
+        'services_groups': ['id', 'service_id', 'group_id'],
+        'users_groups': ['id', 'user_id', 'group_id', 'is_admin'],
+        }
+
+    def changes_since(self, revision=0):
+        """Return the customers, machines, services and memberships
+        (services_groups, users_groups) changed since `revision`, as
+        returned by a previous call (0 the first time), and the IDs of
+        those deleted since, in `deleted`.
+
+        The current `revision` is returned, to get the next changes. When
+        `full` is set, everything was returned instead: the local copy
+        should be replaced. This is the case for revision 0, or when the
+        revision isn't known to this vault (e.g. restored from a backup).
+
+        Secrets and keys aren't returned: get them with service_get_many.
+        """
+        try:
+            revision = int(revision)
+        except (TypeError, ValueError):
+            return vaultMsg(False, "Invalid revision: %s" % revision)
+        # Taken first: what changes meanwhile is returned again next time
+        current = model.changes_revision()
+        full = revision <= 0 or revision > current
+
+        changed = None if full else model.changes_since(revision)
+        out = {'revision': current, 'full': full, 'deleted': {}}
+        tables = meta.metadata.tables
+        for kind in model.CHANGES_TABLES:
+            table = tables[kind]
+            req = sql.select([table.c[x] for x in self.changes_columns[kind]])
+            rows = []
+            if full:
+                rows = meta.Session.execute(req.order_by(table.c.id))
+            else:
+                ids = sorted(changed[kind])
+                # Not too many bind parameters at once
+                for i in range(0, len(ids), 500):
+                    rows.extend(meta.Session.execute(
+                        req.where(table.c.id.in_(ids[i:i + 500]))))
+            out[kind] = [dict(row) for row in rows]
+            if not full:
+                found = set(x['id'] for x in out[kind])
+                out['deleted'][kind] = [x for x in ids if x not in found]
+        return vaultMsg(True, "Here are the changes", out)
+
     def customer_list(self):
-        lst = query(Customer).all()
+        sel = sql.select([Customer.id, Customer.name])
+        lst = meta.Session.execute(sel)
 
         out = []
         for x in lst:
@@ -1186,8 +1738,11 @@ class SFLvaultAccess(object):
 
     def machine_list(self, customer_id=None):
         """Return a simple list of the machines"""
-        sel = sql.join(customers_table, machines_table) \
-                 .select(use_labels=True) \
+        sel = sql.select([Machine.id, Machine.name, Machine.fqdn, Machine.ip,
+                          Machine.location, Machine.notes,
+                          Customer.id, Customer.name],
+                         from_obj=[sql.join(customers_table, machines_table)],
+                         use_labels=True) \
                  .order_by(Customer.id)
 
         # Filter also..
@@ -1234,6 +1789,7 @@ class SFLvaultAccess(object):
     #    return vaultMsg(True, "Here is the machines list", {'list': out})
 
 
+    @changes_vault
     def service_passwd(self, service_id, newsecret):
         """Change the passwd for a given service"""
         transaction.begin()
@@ -1241,7 +1797,11 @@ class SFLvaultAccess(object):
         service_id = int(service_id)
 
         serv = query(Service).get(service_id)
-        groups = serv.groups
+        group_ids = [sg.group_id for sg in serv.groups_assoc]
+        groups = []
+        if group_ids:
+            groups = query(Group).options(undefer('pubkey')) \
+                                 .filter(Group.id.in_(group_ids)).all()
 
         (seckey, ciphertext) = encrypt_secret(newsecret)
         serv.secret = ciphertext
@@ -1254,9 +1814,11 @@ class SFLvaultAccess(object):
         # TODO: for traceability, mark the date we changed the password.
         #
 
-        for sg in serv.groups_assoc:
-            eg = [g for g in groups if g.id == sg.group_id][0].elgamal()
-            sg.cryptsymkey = encrypt_longmsg(eg, seckey)
+        pubkeys = dict((g.id, g.pubkey) for g in groups)
+        cryptsymkeys = encrypt_many([(pubkeys[sg.group_id], seckey)
+                                     for sg in serv.groups_assoc])
+        for sg, cryptsymkey in zip(serv.groups_assoc, cryptsymkeys):
+            sg.cryptsymkey = cryptsymkey
 
         grouplist = [g.name for g in groups]
         transaction.commit()
@@ -24,10 +24,11 @@ from datetime import datetime
 import re
 
 from Crypto.PublicKey import ElGamal
-from sqlalchemy import Column, MetaData, Table, types, ForeignKey
-from sqlalchemy.orm import mapper, relation, backref
+from sqlalchemy import Column, MetaData, Table, types, ForeignKey, Index
+from sqlalchemy import DDL, event, inspect
+from sqlalchemy.orm import mapper, relation, backref, deferred, object_mapper
 from sqlalchemy.orm import scoped_session, sessionmaker, eagerload, lazyload
-from sqlalchemy.orm import eagerload_all
+from sqlalchemy.orm import eagerload_all, undefer, undefer_group
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy import sql
 
@@ -35,10 +36,13 @@ from sflvault.model import meta
 from sflvault.model.meta import Session, metadata
 from sflvault.model.custom_types import JSONEncodedDict
 from sflvault.common.crypto import *
-from zope.sqlalchemy import ZopeTransactionExtension
+from zope.sqlalchemy import ZopeTransactionExtension, mark_changed
 
 # TODO: add an __all__ statement here, to speed up loading...
 
+# Parsed (and precomputed) ElGamal pubkeys of users and groups, see elgamal()
+pubkey_cache = ElGamalPubkeyCache()
+
 
 def init_model(engine):
     """Call me before using any of the tables or classes in the model."""
@@ -49,6 +53,7 @@ def init_model(engine):
 
     meta.engine = engine
     meta.Session = scoped_session(sm)
+    event.listen(sm, 'after_flush', _record_flushed_changes)
 
 
 users_table = Table("users", metadata,
@@ -66,7 +71,9 @@ users_table = Table("users", metadata,
                     Column('created_time', types.DateTime,
                            default=datetime.now),
                     # Admin flag, allows to add users, and grant access.
-                    Column('is_admin', types.Boolean, default=False)
+                    Column('is_admin', types.Boolean, default=False),
+                    # login and authenticate
+                    Index('users_username', 'username'),
                     )
 
 usergroups_table = Table('users_groups', metadata,
@@ -77,6 +84,11 @@ usergroups_table = Table('users_groups', metadata,
                                 ForeignKey('groups.id')),
                          Column('is_admin', types.Boolean, default=False),
                          Column('cryptgroupkey', types.Text),
+                         # A user's groups (see search_query's user_id)
+                         Index('users_groups_user_id_group_id',
+                               'user_id', 'group_id'),
+                         # A group's members (group_get, group_del)
+                         Index('users_groups_group_id', 'group_id'),
                          )
 
 groups_table = Table('groups', metadata,
@@ -95,6 +107,11 @@ servicegroups_table = Table('services_groups', metadata,
                             Column('group_id', types.Integer,
                                    ForeignKey('groups.id')),
                             Column('cryptsymkey', types.Text),
+                            # A group's services, and a service's groups
+                            Index('services_groups_group_id_service_id',
+                                  'group_id', 'service_id'),
+                            Index('services_groups_service_id_group_id',
+                                  'service_id', 'group_id'),
                             )
 
 
@@ -121,7 +138,8 @@ machines_table = Table('machines', metadata,
                       # la ville et dans son boîtier (4ième ?)
                       Column('location', types.Text),
                       # Notes sur le serveur, références, URLs, etc..
-                      Column('notes', types.Text)
+                      Column('notes', types.Text),
+                      Index('machines_customer_id', 'customer_id'),
                       )
 
 # Each ssh or web app. service that have a password.
@@ -142,10 +160,78 @@ services_table = Table('services', metadata,
                        Column('notes', types.Text),
                        Column('secret', types.Text),
                        Column('secret_last_modified', types.DateTime,
-                              default=datetime.now)
+                              default=datetime.now),
+                       Index('services_machine_id', 'machine_id'),
+                       # Children checks of service_del, and the parents chain
+                       Index('services_parent_service_id',
+                             'parent_service_id'),
                        )
 
 
+# Text of the fields searched by search_query, one row for each of its results
+# (a service, or a machine without services, or a customer without machines).
+# Rebuilt for a whole customer whenever one of its objects changes, see
+# update_search_index().
+searchindex_table = Table('search_index', metadata,
+                          Column('id', types.Integer, primary_key=True),
+                          Column('customer_id', types.Integer),
+                          Column('machine_id', types.Integer),
+                          Column('service_id', types.Integer),
+                          Column('text', types.Text),
+                          Index('search_index_customer_id', 'customer_id'),
+                          Index('search_index_service_id', 'service_id'),
+                          sqlite_autoincrement=True
+                          )
+
+# Revisions of the vault: the last change of each customer, machine,
+# service and membership, deleted ones included (tombstones), see
+# record_changes(). The id is the revision, always increasing.
+changes_table = Table('changes', metadata,
+                      Column('id', types.Integer, primary_key=True),
+                      # A table name, see CHANGES_TABLES
+                      Column('kind', types.String(20)),
+                      Column('object_id', types.Integer),
+                      Index('changes_kind_object_id', 'kind', 'object_id'),
+                      sqlite_autoincrement=True
+                      )
+
+def _has_fts5_trigram(ddl, target, bind, **kw):
+    """Whether this SQLite has FTS5 and its trigram tokenizer (3.34+)"""
+    if bind.dialect.name != 'sqlite':
+        return False
+    try:
+        bind.execute("CREATE VIRTUAL TABLE temp.fts5_check "
+                     "USING fts5(text, tokenize='trigram')")
+        bind.execute("DROP TABLE temp.fts5_check")
+    except Exception:
+        return False
+    return True
+
+# On SQLite, search_fts indexes the text's trigrams, for LIKE '%word%'.
+for ddl in ["CREATE VIRTUAL TABLE search_fts USING fts5(text, "
+                "content='search_index', content_rowid='id', "
+                "tokenize='trigram')",
+            "CREATE TRIGGER search_index_ai AFTER INSERT ON search_index BEGIN "
+                "INSERT INTO search_fts (rowid, text) VALUES (new.id, new.text); "
+                "END",
+            "CREATE TRIGGER search_index_ad AFTER DELETE ON search_index BEGIN "
+                "INSERT INTO search_fts (search_fts, rowid, text) "
+                "VALUES ('delete', old.id, old.text); "
+                "END"]:
+    event.listen(searchindex_table, 'after_create',
+                 DDL(ddl).execute_if(callable_=_has_fts5_trigram))
+# On PostgreSQL, a trigram GIN index does the same for ILIKE '%word%'.
+for ddl in ["CREATE EXTENSION IF NOT EXISTS pg_trgm",
+            "CREATE INDEX search_index_text_trgm ON search_index "
+                "USING gin (text gin_trgm_ops)"]:
+    event.listen(searchindex_table, 'after_create',
+                 DDL(ddl).execute_if(dialect='postgresql'))
+
+searchfts_table = sql.table('search_fts',
+                            sql.column('rowid'),
+                            sql.column('text'))
+
+
 class Service(object):
     def __repr__(self):
         return "<Service s#%d: %s>" % (self.id, self.url)
@@ -164,9 +250,7 @@ class User(object):
 
     def elgamal(self):
         """Return the ElGamal object, ready to encrypt stuff."""
-        e = ElGamal.ElGamalobj()
-        (e.p, e.g, e.y) = unserial_elgamal_pubkey(self.pubkey)
-        return e
+        return pubkey_cache.get(self.pubkey)
     
     def __repr__(self):
         return "<User u#%d: %s>" % (self.id, self.username)
@@ -195,9 +279,7 @@ class Group(object):
     
     def elgamal(self):
         """Return the ElGamal object, ready to encrypt stuff."""
-        e = ElGamal.ElGamalobj()
-        (e.p, e.g, e.y) = unserial_elgamal_pubkey(self.pubkey)
-        return e
+        return pubkey_cache.get(self.pubkey)
 
 class Customer(object):
     def __repr__(self):
@@ -223,7 +305,12 @@ class Customer(object):
 #             User
 
 # Map each class to its corresponding table.
+#
+# Relations are loaded when accessed, and the large text columns are
+# deferred: load them with undefer() or undefer_group() when they are needed
+# for many objects.
 mapper(User, users_table, {
+    'pubkey': deferred(users_table.c.pubkey),
     # Quick access to services...
     'services': relation(Service,
                          secondary=usergroups_table.join(servicegroups_table, usergroups_table.c.group_id==servicegroups_table.c.group_id),
@@ -239,6 +326,7 @@ mapper(UserGroup, usergroups_table, {
     })
 
 mapper(Group, groups_table, {
+    'pubkey': deferred(groups_table.c.pubkey),
     'services_assoc': relation(ServiceGroup, backref='group')
     })
 Group.users = association_proxy('users_assoc', 'user')
@@ -249,8 +337,10 @@ mapper(ServiceGroup, servicegroups_table, {
     })
 
 mapper(Service, services_table, {
+    'secret': deferred(services_table.c.secret, group='details'),
+    'notes': deferred(services_table.c.notes, group='details'),
+    'metadata': deferred(services_table.c.metadata, group='details'),
     'children': relation(Service,
-                         lazy=False,
                          backref=backref('parent', uselist=False,
                                          remote_side=[services_table.c.id]),
                          primaryjoin=services_table.c.parent_service_id==services_table.c.id)
@@ -258,10 +348,11 @@ mapper(Service, services_table, {
 Service.groups = association_proxy('groups_assoc', 'group')
 
 mapper(Machine, machines_table, {
-    'services': relation(Service, backref='machine', lazy=False)
+    'notes': deferred(machines_table.c.notes),
+    'services': relation(Service, backref='machine')
     })
 mapper(Customer, customers_table, {
-    'machines': relation(Machine, backref='customer', lazy=False)
+    'machines': relation(Machine, backref='customer')
     })
 
 ################ Helper functions ################
@@ -301,13 +392,14 @@ def get_objects_ids(objects_ids, object_type):
 
 
 def get_objects_list(objects_ids, object_type, eagerload_all_=None,
-                     return_objects=True):
+                     return_objects=True, undefer_=None):
     """Get a list of objects by their IDs, either as int or str. Make
     sure we return a list of integers as IDs.
 
     object_type - the type of object to be returned. It must be one of
                 ['groups', 'machines', 'customers']
     return_objects - whether to return the actual objects or not.
+    undefer_ - a deferred column to load along the objects
     """
 
     objects_types_assoc = {'groups': Group,
@@ -335,6 +427,8 @@ def get_objects_list(objects_ids, object_type, eagerload_all_=None,
 
         if eagerload_all_:
             objects_q = objects_q.options(eagerload_all(eagerload_all_))
+        if undefer_:
+            objects_q = objects_q.options(undefer(undefer_))
         objects = objects_q.all()
     else:
         objects_q = sql.select([obj.id]).where(obj.id.in_(objects_ids))
@@ -349,10 +443,22 @@ def get_objects_list(objects_ids, object_type, eagerload_all_=None,
     return (objects if return_objects else None, objects_ids)
 
 
-def search_query(swords, filters=None, verbose=False):
+def search_query(swords, filters=None, verbose=False, limit=None, after=None,
+                 user_id=None):
+    """Search the customers, machines and services.
 
-    # Create the join..
-    sel = sql.outerjoin(customers_table, machines_table).outerjoin(services_table)
+    Results are ordered like search_sort_key().
+
+    limit - return at most that many rows
+    after - return the rows after this search_sort_key() (see `limit`)
+    user_id - return only the services this user has access to
+    """
+
+    si = searchindex_table
+    # Start from the matching index rows..
+    sel = si.outerjoin(customers_table, Customer.id == si.c.customer_id) \
+            .outerjoin(machines_table, Machine.id == si.c.machine_id) \
+            .outerjoin(services_table, Service.id == si.c.service_id)
 
     if filters:
         # Remove filters that are just None
@@ -365,46 +471,265 @@ def search_query(swords, filters=None, verbose=False):
             raise RuntimeError("filters themselves must be a list of ints")
         
         if 'groups' in filters:
-            sel = sel.join(servicegroups_table)
+            sel = sel.join(servicegroups_table,
+                           ServiceGroup.service_id == si.c.service_id)
 
-    sel = sel.select(use_labels=True)
+    sel = sql.select(search_columns(), from_obj=[sel], use_labels=True)
 
     if filters:
         if 'groups' in filters:
             sel = sel.where(ServiceGroup.group_id.in_(filters['groups']))
         if 'machines' in filters:
-            sel = sel.where(Machine.id.in_(filters['machines']))
+            sel = sel.where(si.c.machine_id.in_(filters['machines']))
         if 'customers' in filters:
-            sel = sel.where(Customer.id.in_(filters['customers']))
-
-    # Fields to search in..
-    textfields = [Customer.name,
-                  Machine.name,
-                  Machine.fqdn,
-                  Machine.ip,
-                  Machine.location,
-                  Machine.notes,
-                  Service.url,
-                  Service.notes]
-    numfields = [Customer.id,
-                 Machine.id,
-                 Service.id]
-    
-    # TODO: distinguish between INTEGER fields and STRINGS and search
-    # differently (check only ==, and only if word can be converted to int())
+            sel = sel.where(si.c.customer_id.in_(filters['customers']))
+
+    if user_id is not None:
+        sel = sel.where(si.c.service_id.in_(accessible_services(user_id)))
+
+    # Every word must be in the text, or be one of the IDs
+    fts = _search_fts()
+    textwords = [word for word in swords if not word.isdigit()]
+    if textwords:
+        if fts:
+            # LIKE is case insensitive, and uses the trigrams
+            sel = sel.where(si.c.id.in_(
+                sql.select([searchfts_table.c.rowid]).where(sql.and_(*[
+                    searchfts_table.c.text.like('%%%s%%' % word)
+                    for word in textwords]))))
+        else:
+            for word in textwords:
+                sel = sel.where(si.c.text.ilike('%%%s%%' % word))
 
-    andlist = []
+    numfields = [si.c.customer_id,
+                 si.c.machine_id,
+                 si.c.service_id]
     for word in swords:
-        orlist = [field.ilike('%%%s%%' % word) for field in textfields]
         if word.isdigit():
-            # Search numeric fields too
-            orlist += [field == int(word) for field in numfields]
-        orword = sql.or_(*orlist)
-        andlist.append(orword)
+            orlist = [field == int(word) for field in numfields]
+            if fts:
+                orlist.append(si.c.id.in_(
+                    sql.select([searchfts_table.c.rowid])
+                       .where(searchfts_table.c.text.like('%%%s%%' % word))))
+            else:
+                orlist.append(si.c.text.ilike('%%%s%%' % word))
+            sel = sel.where(sql.or_(*orlist))
+
+    sortkey = [sql.func.coalesce(Machine.name, u''),
+               sql.func.coalesce(Service.url, u''),
+               si.c.customer_id,
+               sql.func.coalesce(si.c.machine_id, 0),
+               sql.func.coalesce(si.c.service_id, 0)]
+    if after:
+        sel = sel.where(sql.tuple_(*sortkey) > sql.tuple_(*after))
+    sel = sel.order_by(*sortkey)
+    if limit:
+        sel = sel.limit(limit)
 
-    sel = sel.where(sql.and_(*andlist))
+    return meta.Session.execute(sel)
 
-    sel = sel.order_by(Machine.name, Service.url)
 
-    return meta.Session.execute(sel)
+def accessible_services(user_id):
+    """Select the IDs of the services a user has access to, through his
+    groups"""
+    return sql.select([servicegroups_table.c.service_id],
+                      from_obj=[sql.join(usergroups_table, servicegroups_table,
+                                         usergroups_table.c.group_id ==
+                                         servicegroups_table.c.group_id)]) \
+              .where(usergroups_table.c.user_id == user_id)
+
+
+def search_sort_key(row):
+    """Sort key of the search results: (machine name, service url, and the
+    IDs of the row)"""
+    return (row.machines_name or u'',
+            row.services_url or u'',
+            row.customers_id,
+            row.machines_id or 0,
+            row.services_id or 0)
+
+
+def _search_fts():
+    """Whether the search_fts trigram index is there (SQLite only)"""
+    if getattr(meta.engine, 'search_fts', None) is None:
+        meta.engine.search_fts = meta.engine.dialect.name == 'sqlite' and \
+            bool(meta.engine.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'search_fts'"
+                ).fetchall())
+    return meta.engine.search_fts
+
+
+def search_columns():
+    """The columns of the search results (no secrets!)"""
+    c, m, s = customers_table.c, machines_table.c, services_table.c
+    return [c.id, c.name,
+            m.id, m.name, m.fqdn, m.ip, m.location, m.notes,
+            s.id, s.url, s.notes, s.parent_service_id, s.metadata]
+
+
+def search_rows_query(customer_ids=None):
+    """Select the rows searched by search_query, of some customers (or of
+    all of them), labeled like its results"""
+    sel = sql.select(search_columns(),
+                     from_obj=[sql.outerjoin(customers_table, machines_table)
+                                  .outerjoin(services_table)],
+                     use_labels=True)
+    if customer_ids is not None:
+        sel = sel.where(Customer.id.in_(customer_ids))
+    return sel
+
+
+def search_text(row):
+    """The searched text of a row from search_rows_query"""
+    return u'\n'.join([unicode(x) for x in (row.customers_name,
+                                            row.machines_name,
+                                            row.machines_fqdn,
+                                            row.machines_ip,
+                                            row.machines_location,
+                                            row.machines_notes,
+                                            row.services_url,
+                                            row.services_notes)
+                       if x is not None])
+
+
+def _search_index_rows(rows):
+    return [{'customer_id': row.customers_id,
+             'machine_id': row.machines_id,
+             'service_id': row.services_id,
+             'text': search_text(row)} for row in rows]
+
+
+def update_search_index(customers=(), machines=()):
+    """Update the search index for these customers, and the customers of
+    these machines. Call it after any change to customers, machines or
+    services (before committing).
+
+    Returns the updated customers' IDs, and their rows from
+    search_rows_query."""
+    meta.Session.flush()
+    customer_ids = set(int(x) for x in customers if x)
+    machine_ids = [int(x) for x in machines if x]
+    if machine_ids:
+        sel = sql.select([Machine.customer_id]) \
+                 .where(Machine.id.in_(machine_ids))
+        customer_ids.update(row[0] for row in meta.Session.execute(sel)
+                            if row[0])
+    if not customer_ids:
+        return customer_ids, []
+
+    si = searchindex_table
+    meta.Session.execute(si.delete().where(si.c.customer_id.in_(customer_ids)))
+    # Only SQL statements: let the transaction know there's something to commit
+    mark_changed(meta.Session())
+    rows = meta.Session.execute(search_rows_query(customer_ids)).fetchall()
+    if rows:
+        meta.Session.execute(si.insert(), _search_index_rows(rows))
+    return customer_ids, rows
+
+
+def rebuild_search_index(batch_size=1000):
+    """Recompute the whole search index, `batch_size` rows at a time.
+    Returns the number of rows."""
+    meta.Session.execute(searchindex_table.delete())
+    mark_changed(meta.Session())
+    res = meta.Session.execute(search_rows_query())
+    count = 0
+    while True:
+        rows = res.fetchmany(batch_size)
+        if not rows:
+            break
+        meta.Session.execute(searchindex_table.insert(),
+                             _search_index_rows(rows))
+        count += len(rows)
+    return count
+
+
+def search_index_version():
+    """Changes whenever the search index does: its IDs are never reused"""
+    si = searchindex_table
+    sel = sql.select([sql.func.max(si.c.id), sql.func.count(si.c.id)])
+    return tuple(meta.Session.execute(sel).fetchone())
+
+
+# The tables whose changes are recorded
+CHANGES_TABLES = ['customers', 'machines', 'services', 'services_groups',
+                  'users_groups']
+
+def record_changes(kind, ids):
+    """Record a new revision for the objects `ids` of the table `kind`,
+    changed or deleted in the current transaction"""
+    ids = set(ids)
+    if not ids:
+        return
+    c = changes_table.c
+    if meta.engine.dialect.name == 'postgresql':
+        # Revisions must be committed in order, so that changes_since()
+        # never misses one: writers wait for each other.
+        meta.Session.execute("LOCK TABLE changes IN SHARE ROW EXCLUSIVE MODE")
+    meta.Session.execute(changes_table.delete()
+                         .where(c.kind == kind)
+                         .where(c.object_id.in_(ids)))
+    meta.Session.execute(changes_table.insert(),
+                         [{'kind': kind, 'object_id': x} for x in sorted(ids)])
+    mark_changed(meta.Session())
+
+def record_deletes(table, whereclause):
+    """Record the rows of `table` about to be deleted with `whereclause`,
+    for the deletes which don't go through the Session"""
+    record_changes(table.name, [row[0] for row in meta.Session.execute(
+        sql.select([table.c.id]).where(whereclause))])
+
+def _record_flushed_changes(session, flush_context):
+    """Record the objects added, modified or deleted by a flush"""
+    changed = {}
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        table = object_mapper(obj).local_table
+        if table.name in CHANGES_TABLES and \
+           (obj not in session.dirty or session.is_modified(obj)):
+            changed.setdefault(table.name, set()).add(obj.id)
+    for kind, ids in changed.items():
+        record_changes(kind, ids)
+
+def changes_revision():
+    """Return the last revision of the vault"""
+    return meta.Session.execute(
+        sql.select([sql.func.max(changes_table.c.id)])).scalar() or 0
+
+def changes_since(revision):
+    """Return {kind: set of IDs} of the objects changed since `revision`"""
+    out = dict((kind, set()) for kind in CHANGES_TABLES)
+    c = changes_table.c
+    for kind, object_id in meta.Session.execute(
+            sql.select([c.kind, c.object_id]).where(c.id > revision)):
+        out[kind].add(object_id)
+    return out
+
+
+def create_indexes():
+    """Create the indexes declared on the tables which are missing from the
+    database, as in vaults created by older versions. create_all() only
+    creates the indexes of the tables it creates.
+
+    Return the names of the indexes created."""
+    inspector = inspect(meta.engine)
+    tables = set(inspector.get_table_names())
+    created = []
+    for table in metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = set(ix['name'] for ix in inspector.get_indexes(table.name))
+        for index in sorted(table.indexes, key=lambda ix: ix.name):
+            if index.name not in existing:
+                index.create(meta.engine)
+                created.append(index.name)
+    return created
+
+
+def search_index_stale():
+    """Whether the search index is empty while there are customers, as
+    when upgrading from a vault without it."""
+    indexed = sql.select([searchindex_table.c.id]).limit(1)
+    customers = sql.select([Customer.id]).limit(1)
+    return (not meta.Session.execute(indexed).fetchall() and
+            bool(meta.Session.execute(customers).fetchall()))
 
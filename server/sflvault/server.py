@@ -9,13 +9,29 @@ import logging
 import logging.config
 import argparse
 import socket
+import threading
+import Queue
+import signal
+import errno
+import time
 
 import transaction
 from sqlalchemy import engine_from_config
 from OpenSSL import SSL
 
+import sflvault.common.crypto
+import sflvault.lib.backup
+import sflvault.lib.cryptpool
+import sflvault.lib.keypool
+import sflvault.lib.metrics
+import sflvault.lib.searchcache
+import sflvault.lib.searchengine
+import sflvault.lib.sqlstats
 import sflvault.model
+import sflvault.views
 from sflvault.views import XMLRPCDispatcher
+from sflvault.lib.session import (MemorySessionBackend, SQLiteSessionBackend,
+                                  session_backend_from_settings)
 
 log = logging.getLogger(__name__)
 
@@ -44,6 +60,20 @@ class SFLvaultRequestHandler(SimpleXMLRPCRequestHandler):
 
         return self.server.instance._dispatch(request, method, params)
 
+    def do_GET(self):
+        """Serve the metrics on `sflvault.metrics.path`"""
+        stats = sflvault.lib.metrics.stats
+        if stats is None or \
+           self.path != SFLvaultServer.settings['sflvault.metrics.path']:
+            self.report_404()
+            return
+        response = stats.render(sflvault.views.vaultSessions.count())
+        self.send_response(200)
+        self.send_header("Content-type", "text/plain; version=0.0.4")
+        self.send_header("Content-length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
     rpc_paths = ('/vault', '/vault/rpc', '/',)
 
 class SecureXMLRPCServer(HTTPServer, SimpleXMLRPCDispatcher):
@@ -74,23 +104,85 @@ class SecureXMLRPCServer(HTTPServer, SimpleXMLRPCDispatcher):
             pass #some platforms may raise ENOTCONN here
         self.close_request(request)
 
+class PooledMixIn:
+    """Mix-in class to handle requests in a bounded pool of threads.
+
+    It works like SocketServer.ThreadingMixIn, but instead of starting a new
+    thread for each request, `workers` threads are started once and handle
+    the accepted requests one after the other.
+    """
+    workers = 4
+
+    def start_workers(self):
+        """Start the worker threads, call once before serving."""
+        # Don't accept more connections than we can handle right away.
+        self.requests = Queue.Queue(self.workers)
+        for i in range(self.workers):
+            t = threading.Thread(target=self.process_request_worker,
+                                 name="sflvault-worker-%d" % i)
+            t.setDaemon(True)
+            t.start()
+
+    def process_request_worker(self):
+        """Loop run by each worker thread."""
+        while True:
+            request, client_address = self.requests.get()
+            try:
+                self.finish_request(request, client_address)
+                self.shutdown_request(request)
+            except:
+                self.handle_error(request, client_address)
+                self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        """Queue the request for the next available worker."""
+        self.requests.put((request, client_address))
+
+class PooledXMLRPCServer(PooledMixIn, SimpleXMLRPCServer):
+    pass
+
+class PooledSecureXMLRPCServer(PooledMixIn, SecureXMLRPCServer):
+    pass
+
 class SFLvaultServer(object):
 
-    def __init__(self, config_file_name):
+    def __init__(self, config_file_name, serve=True):
+        """serve - set to False to only open the database"""
         self.server = None
         SFLvaultServer.settings = self.get_settings(config_file_name)
 
+        self.initialize_crypto()
+        if serve:
+            self.initialize_keypool()
         self.start_sqlalchemy()
         self.initialize_models()
-        self.create_admin_if_necessary()
-        self.initialize_server()
+        if serve:
+            self.create_admin_if_necessary()
+            self.initialize_search()
+            self.initialize_sessions()
+            self.initialize_server()
         
     def get_settings(self, config_file_name=None):
         result = {
             'sflvault.vault.session_timeout': '15',
             'sflvault.vault.setup_timeout': '300',
+            'sflvault.vault.longmsg_version': '1',
+            'sflvault.keypool.size': '0',
+            'sflvault.vault.pubkey_cache_size': '32',
+            'sflvault.vault.pubkey_cache_bytes': str(16 * 1024 * 1024),
+            'sflvault.cryptpool.size': '0',
+            'sflvault.search.engine': 'sql',
+            'sflvault.search.cache_size': '0',
+            'sflvault.search.cache_bytes': str(16 * 1024 * 1024),
+            'sflvault.sql.max_statements': '50',
+            'sflvault.sql.max_time': '1.0',
+            'sflvault.metrics.path': '',
             'sflvault.host': 'localhost',
             'sflvault.port': '5000',
+            'sflvault.workers': '0',
+            'sflvault.processes': '0',
+            'sflvault.sessions.backend': 'memory',
+            'sflvault.sessions.file': '%s/sflvault-sessions.db' % os.getcwd(),
             'sqlalchemy.url': 'sqlite:///%s/sflvault.db' % os.getcwd()
         }
         if config_file_name:
@@ -99,13 +191,74 @@ class SFLvaultServer(object):
             result.update(self.get_dict_for_config_section(config, 'sflvault'))
         return result
 
+    def initialize_crypto(self):
+        # Format of the keys encrypted by the server (group_add, service_add..)
+        sflvault.common.crypto.LONGMSG_VERSION = \
+            int(SFLvaultServer.settings['sflvault.vault.longmsg_version'])
+        # Users' and groups' pubkeys, precomputed to encrypt faster
+        sflvault.model.pubkey_cache.size = \
+            int(SFLvaultServer.settings['sflvault.vault.pubkey_cache_size'])
+        sflvault.model.pubkey_cache.max_bytes = \
+            int(SFLvaultServer.settings['sflvault.vault.pubkey_cache_bytes'])
+        # Processes encrypting for many users or groups at once, started
+        # now, before any thread. Pre-forked server processes start their
+        # own (see _spawn_child).
+        processes = int(SFLvaultServer.settings['sflvault.processes'])
+        sflvault.lib.cryptpool.init_cryptpool(
+            int(SFLvaultServer.settings['sflvault.cryptpool.size']),
+            start=processes <= 1)
+
+    def initialize_keypool(self):
+        size = int(SFLvaultServer.settings['sflvault.keypool.size'])
+        if size > 0:
+            log.info("Keeping %d ElGamal keypairs ready" % size)
+            sflvault.lib.keypool.init_keypool(size)
+
     def start_sqlalchemy(self):
         self.engine = engine_from_config(SFLvaultServer.settings,
                                     'sqlalchemy.')
+        # Calls running too many statements, or too long, are logged
+        sflvault.lib.sqlstats.init_sqlstats(self.engine,
+            int(SFLvaultServer.settings['sflvault.sql.max_statements']),
+            float(SFLvaultServer.settings['sflvault.sql.max_time']))
 
     def initialize_models(self):
         sflvault.model.init_model(self.engine)
         sflvault.model.meta.metadata.create_all(self.engine)
+        if sflvault.model.search_index_stale():
+            self.rebuild_search_index()
+
+    def rebuild_search_index(self):
+        log.info("Building the search index")
+        rows = sflvault.model.rebuild_search_index()
+        transaction.commit()
+        sflvault.model.meta.Session.remove()
+        log.info("Search index built: %d rows" % rows)
+        return rows
+
+    def create_indexes(self):
+        created = sflvault.model.create_indexes()
+        for name in created:
+            log.info("Created index %s" % name)
+        return created
+
+    def export_vault(self, filename):
+        out = sflvault.lib.backup.open_export(filename, 'w')
+        try:
+            return sflvault.lib.backup.export_vault(self.engine, out)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+
+    def restore_vault(self, filename):
+        infile = sflvault.lib.backup.open_export(filename, 'r')
+        try:
+            counts = sflvault.lib.backup.restore_vault(self.engine, infile)
+        finally:
+            if infile is not sys.stdin:
+                infile.close()
+        self.rebuild_search_index()
+        return counts
 
     def create_admin_if_necessary(self):
         if not sflvault.model.query(sflvault.model.User).filter_by(username='admin').first():
@@ -119,17 +272,41 @@ class SFLvaultServer(object):
             #transaction.begin()
             sflvault.model.meta.Session.add(u)
             transaction.commit()
+        # Requests will use their own session.
+        sflvault.model.meta.Session.remove()
+
+    def initialize_search(self):
+        engine = SFLvaultServer.settings['sflvault.search.engine']
+        if engine == 'memory':
+            processes = int(SFLvaultServer.settings['sflvault.processes'])
+            sflvault.lib.searchengine.init_searchengine(shared=processes > 1)
+            log.info("Searching in memory, %d rows loaded" %
+                     len(sflvault.lib.searchengine.engine.rows))
+        elif engine != 'sql':
+            raise ValueError("Unknown sflvault.search.engine: %s" % engine)
+        sflvault.lib.searchcache.init_searchcache(
+            int(SFLvaultServer.settings['sflvault.search.cache_size']),
+            int(SFLvaultServer.settings['sflvault.search.cache_bytes']))
+
+    def initialize_sessions(self):
+        self.sessions = session_backend_from_settings(SFLvaultServer.settings)
+        sflvault.views.init_sessions(self.sessions)
 
     def initialize_server(self):
         dispatcher = self._create_request_dispatcher()
+        self.initialize_metrics(dispatcher.registry)
         host = SFLvaultServer.settings['sflvault.host']
         port = int(SFLvaultServer.settings['sflvault.port'])
         address = (host, port)
         keyfile = SFLvaultServer.settings.get('sflvault.keyfile')
         certfile = SFLvaultServer.settings.get('sflvault.certfile')
+        workers = int(SFLvaultServer.settings['sflvault.workers'])
         if keyfile and certfile:
             log.info("Starting in SSL mode")
-            self.server = SecureXMLRPCServer(
+            server_class = SecureXMLRPCServer
+            if workers:
+                server_class = PooledSecureXMLRPCServer
+            self.server = server_class(
                 address,
                 requestHandler=SFLvaultRequestHandler,
                 keyfile=keyfile,
@@ -139,7 +316,10 @@ class SFLvaultServer(object):
             )
         else:
             log.info("Starting in insecure mode")
-            self.server = SimpleXMLRPCServer(
+            server_class = SimpleXMLRPCServer
+            if workers:
+                server_class = PooledXMLRPCServer
+            self.server = server_class(
                 address,
                 requestHandler=SFLvaultRequestHandler,
                 logRequests=False,
@@ -147,6 +327,13 @@ class SFLvaultServer(object):
             )
         self.server.register_introspection_functions()
         self.server.register_instance(dispatcher)
+        if workers:
+            self.server.workers = workers
+
+    def initialize_metrics(self, methods):
+        if SFLvaultServer.settings['sflvault.metrics.path']:
+            processes = int(SFLvaultServer.settings['sflvault.processes'])
+            sflvault.lib.metrics.init_metrics(methods, shared=processes > 1)
 
     def _create_request_dispatcher(self):
         dispatcher = XMLRPCDispatcher()
@@ -154,8 +341,100 @@ class SFLvaultServer(object):
         return dispatcher
 
     def start_server(self):
+        processes = int(SFLvaultServer.settings['sflvault.processes'])
+        if processes > 1:
+            self.start_prefork(processes)
+        else:
+            self.serve()
+
+    def serve(self):
+        """Serve requests in this process, until interrupted"""
+        if isinstance(self.server, PooledMixIn):
+            log.info("Serving requests with %d worker threads" %
+                     self.server.workers)
+            self.server.start_workers()
         self.server.serve_forever()
 
+    def start_prefork(self, processes):
+        """Serve requests with `processes` forked children, all accepting
+        connections on the same listening socket.
+
+        Children that die are replaced. Sessions must be valid in all
+        children, so they can't be kept in memory: the SQLite backend is
+        used in that case.
+        """
+        if isinstance(self.sessions, MemorySessionBackend):
+            log.warning("Memory sessions can't be shared between processes, "
+                        "using the SQLite backend (%s)" %
+                        SFLvaultServer.settings['sflvault.sessions.file'])
+            self.sessions = SQLiteSessionBackend(
+                SFLvaultServer.settings['sflvault.sessions.file'])
+            sflvault.views.init_sessions(self.sessions)
+        # Children must open their own connections to the database
+        sflvault.model.meta.Session.remove()
+        self.engine.dispose()
+
+        self.children = {}
+        self.running = True
+
+        def stop(signum, frame):
+            self.running = False
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        log.info("Starting %d server processes" % processes)
+        for i in range(processes):
+            self._spawn_child()
+
+        while self.running:
+            try:
+                pid, status = os.wait()
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            started = self.children.pop(pid, None)
+            if started is None or not self.running:
+                continue
+            log.warning("Server process %d exited (status %d), replacing it" %
+                        (pid, status))
+            # Don't loop too fast if children die right away.
+            if time.time() - started < 1:
+                time.sleep(1)
+            self._spawn_child()
+
+        log.info("Stopping server processes")
+        for pid in self.children.keys():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in self.children.keys():
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+
+    def _spawn_child(self):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = time.time()
+            return
+
+        # In the child process.
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        # PyCrypto's RNG must be re-seeded after a fork.
+        sflvault.common.crypto.atfork()
+        sflvault.lib.cryptpool.start_pool()
+        status = 0
+        try:
+            self.serve()
+        except:
+            log.exception("Server process %d crashed" % os.getpid())
+            status = 1
+        os._exit(status)
+
     def get_dict_for_config_section(self, config, section):
         my_dict = {} 
         for key in config._sections[section].keys():
@@ -167,9 +446,39 @@ def main():
     parser = argparse.ArgumentParser(description="Launch the SFLVault server")
     parser.add_argument('config_file', nargs='?', default=None,
         help="INI config file")
+    parser.add_argument('--rebuild-search-index', action='store_true',
+        help="Rebuild the search index, and exit")
+    parser.add_argument('--create-indexes', action='store_true',
+        help="Create the indexes missing from an existing database, and exit")
+    parser.add_argument('--export', metavar='FILE',
+        help="Export the vault (still encrypted) to FILE, gzipped if it "
+             "ends with .gz, or - for the standard output, and exit")
+    parser.add_argument('--restore', metavar='FILE',
+        help="Restore an export in an empty vault, and exit")
     args = parser.parse_args()
     if args.config_file:
         logging.config.fileConfig(args.config_file)
+    if args.export:
+        server = SFLvaultServer(args.config_file, serve=False)
+        counts = server.export_vault(args.export)
+        print >>sys.stderr, "Exported: %s" % ', '.join(
+            "%d %s" % (counts[x], x) for x in sflvault.lib.backup.TABLES)
+        return
+    if args.restore:
+        server = SFLvaultServer(args.config_file, serve=False)
+        counts = server.restore_vault(args.restore)
+        print "Restored: %s" % ', '.join(
+            "%d %s" % (counts[x], x) for x in sflvault.lib.backup.TABLES)
+        return
+    if args.create_indexes:
+        server = SFLvaultServer(args.config_file, serve=False)
+        created = server.create_indexes()
+        print "Indexes created: %s" % (', '.join(created) or 'none')
+        return
+    if args.rebuild_search_index:
+        server = SFLvaultServer(args.config_file, serve=False)
+        print "Search index rebuilt: %d rows" % server.rebuild_search_index()
+        return
     server = SFLvaultServer(args.config_file)
     server.start_server()
 
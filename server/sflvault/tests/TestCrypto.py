@@ -0,0 +1,153 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from unittest import TestCase, skipIf
+
+from sflvault.common import crypto
+from sflvault.common.crypto import *
+
+
+class TestLongmsg(TestCase):
+
+    def setUp(self):
+        self.eg = generate_elgamal_keypair()
+        self.groupkey = serial_elgamal_privkey(elgamal_bothkeys(self.eg))
+
+    def test_both_versions(self):
+        for version in (1, 2):
+            ciphertext = encrypt_longmsg(self.eg, self.groupkey, version)
+            self.assertEqual(longmsg_version(ciphertext), version)
+            self.assertEqual(decrypt_longmsg(self.eg, ciphertext),
+                             self.groupkey)
+
+    def test_default_version(self):
+        ciphertext = encrypt_longmsg(self.eg, 'symkey')
+        self.assertTrue(ciphertext.startswith('v2$'))
+
+    def test_v2_binary_message(self):
+        message = '\x00\x01binary\x00'
+        ciphertext = encrypt_longmsg(self.eg, message, 2)
+        self.assertEqual(decrypt_longmsg(self.eg, ciphertext), message)
+
+    def test_v2_tampered(self):
+        ciphertext = encrypt_longmsg(self.eg, self.groupkey, 2)
+        self.assertRaises(DecryptError, decrypt_longmsg, self.eg,
+                          ciphertext[:-24] + 'A' * 24)
+        self.assertRaises(DecryptError, decrypt_longmsg, self.eg, 'v2$junk')
+
+
+class TestMathBackends(TestCase):
+
+    def setUp(self):
+        self.eg = generate_elgamal_keypair()
+        self.python = math_backends['python']
+
+    def test_python_backend_matches_pycrypto(self):
+        K = randfunc(32)
+        self.assertEqual(elgamal_encrypt(self.eg, 'message', K, self.python),
+                         self.eg.encrypt('message', K))
+        ciphertext = self.eg.encrypt('message', randfunc(32))
+        self.assertEqual(elgamal_decrypt(self.eg, ciphertext, self.python),
+                         'message')
+
+    @skipIf(crypto.gmpy2 is None, "gmpy2 is not installed")
+    def test_gmpy2_backend_matches_python(self):
+        gmp = math_backends['gmpy2']
+        for i in range(5):
+            message = randfunc(100)
+            K = randfunc(32)
+            ciphertext = elgamal_encrypt(self.eg, message, K, self.python)
+            self.assertEqual(elgamal_encrypt(self.eg, message, K, gmp),
+                             ciphertext)
+            self.assertEqual(elgamal_decrypt(self.eg, ciphertext, gmp),
+                             elgamal_decrypt(self.eg, ciphertext, self.python))
+
+    def test_longmsg_across_backends(self):
+        """ What one backend encrypts, the others decrypt """
+        groupkey = serial_elgamal_privkey(elgamal_bothkeys(self.eg))
+        default = crypto.math_backend
+        try:
+            for encrypter in math_backends.values():
+                for decrypter in math_backends.values():
+                    for version in (1, 2):
+                        crypto.math_backend = encrypter
+                        ciphertext = encrypt_longmsg(self.eg, groupkey,
+                                                     version)
+                        crypto.math_backend = decrypter
+                        self.assertEqual(
+                            decrypt_longmsg(self.eg, ciphertext), groupkey)
+        finally:
+            crypto.math_backend = default
+
+
+class TestFixedBase(TestCase):
+
+    def setUp(self):
+        self.eg = generate_elgamal_keypair()
+
+    def test_pow(self):
+        for backend in math_backends.values():
+            table = FixedBaseTable(self.eg.g, self.eg.p, backend=backend)
+            for exp in (0, 1, 15, 16, bytes_to_long(randfunc(32)),
+                        (1 << 256) - 1, 1 << 300):
+                self.assertEqual(table.pow(exp), pow(self.eg.g, exp, self.eg.p))
+
+    def test_pubkey_cache(self):
+        pubkey = serial_elgamal_pubkey(elgamal_pubkey(self.eg))
+        cache = ElGamalPubkeyCache(size=1)
+        eg = cache.get(pubkey)
+        self.assertFalse(hasattr(eg, 'fixed_base'))
+        # Precomputed on second use
+        self.assertTrue(cache.get(pubkey) is eg)
+        self.assertTrue(hasattr(eg, 'fixed_base'))
+
+        K = randfunc(32)
+        self.assertEqual(elgamal_encrypt(eg, 'message', K),
+                         self.eg.encrypt('message', K))
+        ciphertext = encrypt_longmsg(eg, 'message')
+        self.assertEqual(decrypt_longmsg(self.eg, ciphertext), 'message')
+
+        other = generate_elgamal_keypair()
+        other.y = other.y + 1
+        cache.get(serial_elgamal_pubkey(elgamal_pubkey(other)))
+        self.assertEqual(len(cache.keys), 1)
+        self.assertFalse(cache.get(pubkey) is eg)
+
+    def test_pubkey_cache_bytes(self):
+        pubkeys = []
+        for i in range(3):
+            eg = generate_elgamal_keypair()
+            eg.y = eg.y + i
+            pubkeys.append(serial_elgamal_pubkey(elgamal_pubkey(eg)))
+        cache = ElGamalPubkeyCache()
+        eg = cache.get(pubkeys[0])
+        cache.get(pubkeys[0])
+        nbytes = cache.nbytes
+        # About 500KB for a 1536 bits key
+        self.assertTrue(400000 < nbytes < 600000, nbytes)
+
+        # Room for the tables of two keys
+        cache = ElGamalPubkeyCache(max_bytes=nbytes * 5 / 2)
+        for pubkey in pubkeys:
+            cache.get(pubkey)
+            cache.get(pubkey)
+        self.assertEqual(cache.keys.keys(), pubkeys[1:])
+        self.assertTrue(cache.nbytes <= cache.max_bytes)
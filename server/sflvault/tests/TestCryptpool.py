@@ -0,0 +1,71 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+from unittest import TestCase
+
+from sflvault.common.crypto import *
+from sflvault.lib import cryptpool
+
+
+class TestCryptpool(TestCase):
+
+    def setUp(self):
+        self.keys = [generate_elgamal_keypair() for i in range(3)]
+        self.jobs = [(serial_elgamal_pubkey(elgamal_pubkey(eg)), 'message %d' % i)
+                     for i, eg in enumerate(self.keys)]
+
+    def tearDown(self):
+        cryptpool.init_cryptpool(0)
+
+    def _check(self, ciphertexts):
+        self.assertEqual(len(ciphertexts), 3)
+        for i, (eg, ciphertext) in enumerate(zip(self.keys, ciphertexts)):
+            self.assertEqual(decrypt_longmsg(eg, ciphertext), 'message %d' % i)
+
+    def test_inline(self):
+        self._check(cryptpool.encrypt_many(self.jobs))
+
+    def test_pool(self):
+        cryptpool.init_cryptpool(2)
+        self._check(cryptpool.encrypt_many(self.jobs))
+        self.assertTrue(cryptpool._pool is not None)
+        # Reused
+        pool = cryptpool._pool
+        self._check(cryptpool.encrypt_many(self.jobs))
+        self.assertTrue(cryptpool._pool is pool)
+
+    def test_pool_started(self):
+        cryptpool.init_cryptpool(2)
+        # Before any request
+        pool = cryptpool._pool
+        self.assertTrue(pool is not None)
+        # Requests from many threads share it
+        threads = [threading.Thread(target=cryptpool.encrypt_many,
+                                    args=(self.jobs,)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertTrue(cryptpool._pool is pool)
+        # Or left to the forked processes
+        cryptpool.init_cryptpool(2, start=False)
+        self.assertEqual(cryptpool._pool, None)
@@ -0,0 +1,94 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from unittest import TestCase
+import time
+
+from Crypto.PublicKey import ElGamal
+
+from sflvault.common.crypto import *
+from sflvault.client.groupkeys import GroupKeyCache
+
+
+class TestGroupKeyCache(TestCase):
+
+    def setUp(self):
+        self.userkey = generate_elgamal_keypair()
+        self.groupkey = ElGamal.generate(256, randfunc)
+        self.cryptgroupkey = encrypt_longmsg(
+            self.userkey,
+            serial_elgamal_privkey(elgamal_bothkeys(self.groupkey)))
+
+    def test_decrypt_once(self):
+        cache = GroupKeyCache()
+        eg = cache.decrypt(1, self.cryptgroupkey, self.userkey)
+        self.assertEqual(eg.x, self.groupkey.x)
+        # Cached: no privkey needed anymore
+        self.assertEqual(cache.decrypt(1, self.cryptgroupkey, None).x,
+                         self.groupkey.x)
+
+    def test_keyed_by_ciphertext(self):
+        cache = GroupKeyCache()
+        cache.put(1, self.cryptgroupkey, self.groupkey)
+        self.assertEqual(cache.get(1, self.cryptgroupkey + 'x'), None)
+        self.assertEqual(cache.get(2, self.cryptgroupkey), None)
+
+    def test_lru(self):
+        cache = GroupKeyCache(size=2)
+        egs = [ElGamal.ElGamalobj() for i in range(3)]
+        for i, eg in enumerate(egs):
+            eg.x = i + 1
+        cache.put(1, 'a', egs[0])
+        cache.put(2, 'b', egs[1])
+        cache.get(1, 'a')
+        cache.put(3, 'c', egs[2])
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get(2, 'b'), None)
+        self.assertEqual(cache.get(1, 'a').x, 1)
+
+    def test_evict_held_key(self):
+        # The keys handed out survive their eviction from the cache
+        cache = GroupKeyCache(size=1)
+        held = cache.decrypt(1, self.cryptgroupkey, self.userkey)
+        cached = cache.keys.values()[0][1]
+        cache.put(2, 'b', ElGamal.ElGamalobj())
+        self.assertEqual(cache.get(1, self.cryptgroupkey), None)
+        self.assertEqual((held.p, held.x), (self.groupkey.p, self.groupkey.x))
+        ciphertext = self.groupkey.encrypt('symkey', randfunc(16))
+        self.assertEqual(held.decrypt(ciphertext), 'symkey')
+        # The cache's own copy is wiped
+        self.assertEqual((cached.p, cached.x), (0, 0))
+
+    def test_ttl(self):
+        cache = GroupKeyCache(ttl=0.1)
+        cache.put(1, self.cryptgroupkey, self.groupkey)
+        time.sleep(0.2)
+        self.assertEqual(cache.get(1, self.cryptgroupkey), None)
+        self.assertNotEqual(self.groupkey.x, 0)
+
+    def test_wipe(self):
+        cache = GroupKeyCache(ttl=None)
+        cache.put(1, self.cryptgroupkey, self.groupkey)
+        cached = cache.keys.values()[0][1]
+        cache.wipe()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cached.x, 0)
+        self.assertNotEqual(self.groupkey.x, 0)
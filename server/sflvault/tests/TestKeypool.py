@@ -0,0 +1,56 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+from unittest import TestCase
+
+from sflvault.common.crypto import *
+from sflvault.lib.keypool import KeypairPool
+
+
+class TestKeypairPool(TestCase):
+
+    def setUp(self):
+        self.pool = KeypairPool(2)
+
+    def tearDown(self):
+        if self.pool.process.is_alive():
+            self.pool.stop()
+
+    def _usable(self, eg):
+        ciphertext = encrypt_longmsg(eg, 'message')
+        return decrypt_longmsg(eg, ciphertext) == 'message'
+
+    def test_pool(self):
+        self.pool.start()
+        for i in range(50):
+            if self.pool.queue.full():
+                break
+            time.sleep(0.1)
+        self.assertTrue(self.pool.queue.full())
+        eg = self.pool.get()
+        self.assertTrue(self._usable(eg))
+        self.assertTrue(self.pool.process.is_alive())
+
+    def test_empty_pool_generates(self):
+        # Not started: nothing in the queue
+        eg = self.pool.get()
+        self.assertTrue(self._usable(eg))
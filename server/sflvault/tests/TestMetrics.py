@@ -0,0 +1,71 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+from unittest import TestCase
+
+from sflvault.lib.metrics import Metrics
+
+
+class TestMetrics(TestCase):
+
+    def test_observe(self):
+        stats = Metrics(['sflvault.search', 'sflvault.service_get'])
+        stats.observe('sflvault.search', 0.002)
+        stats.observe('sflvault.search', 0.3, error=True)
+        stats.observe('sflvault.search', 60)
+        stats.observe('unknown.method', 1)
+        stats.auth_failure('bad_token')
+        calls, failures = stats.snapshot()
+        self.assertEqual(calls.keys(), ['sflvault.search'])
+        count, errors, total, buckets = calls['sflvault.search']
+        self.assertEqual((count, errors), (3, 1))
+        self.assertAlmostEqual(total, 60.302)
+        # 0.0025, 0.5 and +Inf
+        self.assertEqual([i for i, n in enumerate(buckets) if n],
+                         [1, 8, 13])
+        self.assertEqual(failures['bad_token'], 1)
+        self.assertEqual(failures['invalid_user'], 0)
+
+    def test_render(self):
+        stats = Metrics(['sflvault.search'])
+        stats.observe('sflvault.search', 0.002)
+        stats.observe('sflvault.search', 0.003)
+        lines = stats.render(sessions=4).splitlines()
+        self.assertTrue('sflvault_rpc_calls_total{method="sflvault.search"} 2'
+                        in lines)
+        self.assertTrue('sflvault_rpc_latency_seconds_bucket'
+                        '{method="sflvault.search",le="0.0025"} 1' in lines)
+        self.assertTrue('sflvault_rpc_latency_seconds_bucket'
+                        '{method="sflvault.search",le="+Inf"} 2' in lines)
+        self.assertTrue('sflvault_auth_failures_total{reason="bad_token"} 0'
+                        in lines)
+        self.assertTrue('sflvault_sessions 4' in lines)
+
+    def test_shared(self):
+        stats = Metrics(['sflvault.search'], shared=True)
+        pid = os.fork()
+        if not pid:
+            stats.observe('sflvault.search', 0.1)
+            os._exit(0)
+        os.waitpid(pid, 0)
+        stats.observe('sflvault.search', 0.1)
+        self.assertEqual(stats.snapshot()[0]['sflvault.search'][0], 2)
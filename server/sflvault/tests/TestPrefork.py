@@ -0,0 +1,114 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from binascii import hexlify
+import os
+import select
+import shutil
+import signal
+import tempfile
+import time
+from unittest import TestCase
+
+from sqlalchemy import create_engine
+
+from sflvault.common.crypto import randfunc
+from sflvault.lib import metrics
+from sflvault.lib.session import SQLiteSessionBackend
+from sflvault.server import SFLvaultServer
+
+
+class TestPrefork(TestCase):
+    """start_prefork's children, without their XML-RPC servers"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.stats = metrics.stats
+        metrics.init_metrics(['sflvault.search'], shared=True)
+        self.rfd, self.wfd = os.pipe()
+        self.buf = ''
+
+    def tearDown(self):
+        metrics.stats = self.stats
+        os.close(self.rfd)
+        shutil.rmtree(self.tmpdir)
+
+    def _serve(self):
+        """Served by each child: report its pid and random bytes, count a
+        call, and wait to be killed"""
+        metrics.stats.observe('sflvault.search', 0.01)
+        os.write(self.wfd, '%d %s\n' % (os.getpid(), hexlify(randfunc(16))))
+        while True:
+            time.sleep(1)
+
+    def _master(self):
+        """Run start_prefork in a process of its own, not to change the
+        test's signal handlers"""
+        pid = os.fork()
+        if pid:
+            os.close(self.wfd)
+            return pid
+        status = 1
+        try:
+            os.close(self.rfd)
+            server = SFLvaultServer.__new__(SFLvaultServer)
+            SFLvaultServer.settings = {'sflvault.sessions.file':
+                                       os.path.join(self.tmpdir, 's.db')}
+            server.sessions = SQLiteSessionBackend(
+                os.path.join(self.tmpdir, 's.db'))
+            server.engine = create_engine('sqlite://')
+            server.serve = self._serve
+            server.start_prefork(2)
+            status = 0
+        finally:
+            os._exit(status)
+
+    def _readline(self, timeout=10):
+        deadline = time.time() + timeout
+        while '\n' not in self.buf:
+            left = deadline - time.time()
+            self.assertTrue(left > 0, "No news from the children")
+            if select.select([self.rfd], [], [], left)[0]:
+                data = os.read(self.rfd, 4096)
+                self.assertTrue(data, "The children are gone")
+                self.buf += data
+        line, self.buf = self.buf.split('\n', 1)
+        pid, rand = line.split()
+        return int(pid), rand
+
+    def test_children(self):
+        master = self._master()
+        try:
+            children = dict([self._readline(), self._readline()])
+            # A dead child is replaced
+            os.kill(children.keys()[0], signal.SIGKILL)
+            pid, rand = self._readline()
+            self.assertFalse(pid in children)
+            children[pid] = rand
+        finally:
+            os.kill(master, signal.SIGTERM)
+            os.waitpid(master, 0)
+
+        # Each one re-seeded its RNG after the fork
+        self.assertEqual(len(set(children.values())), 3, children)
+        # And counted its call in the shared metrics
+        calls, failures = metrics.stats.snapshot()
+        self.assertEqual(calls['sflvault.search'][0], 3)
@@ -0,0 +1,69 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from unittest import TestCase
+
+from sflvault.lib import searchcache
+from sflvault.lib.searchcache import SearchCache, search_key
+
+
+class TestSearchCache(TestCase):
+
+    def setUp(self):
+        self.cache = SearchCache(size=2, max_bytes=100)
+
+    def _put(self, key, result):
+        self.cache.put(key, result, searchcache.generation.value)
+
+    def test_key(self):
+        self.assertEqual(search_key(1, ['b', 'a ', 'a'], {'groups': None},
+                                    False),
+                         search_key(1, ['a', 'b'], {}, 0))
+        self.assertNotEqual(search_key(1, ['a'], None, False),
+                            search_key(2, ['a'], None, False))
+
+    def test_lru(self):
+        self._put('a', 'result a')
+        self._put('b', 'result b')
+        self.assertEqual(self.cache.get('a'), 'result a')
+        self._put('c', 'result c')
+        # b was the least recently used
+        self.assertEqual(self.cache.get('b'), None)
+        self.assertEqual(self.cache.get('a'), 'result a')
+        self.assertEqual(self.cache.stats()['hits'], 2)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_max_bytes(self):
+        self._put('a', 'x' * 60)
+        self._put('b', 'y' * 60)
+        self.assertEqual(self.cache.get('a'), None)
+        self.assertEqual(self.cache.get('b'), 'y' * 60)
+        self._put('c', 'z' * 200)
+        self.assertEqual(self.cache.get('c'), None)
+
+    def test_generation(self):
+        gen = searchcache.generation.value
+        self._put('a', 'result a')
+        searchcache.bump()
+        self.assertEqual(self.cache.get('a'), None)
+        # Computed before the change
+        self.cache.put('a', 'result a', gen)
+        self.assertEqual(self.cache.get('a'), None)
@@ -0,0 +1,139 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import namedtuple
+import threading
+import time
+from unittest import TestCase
+
+from sflvault.lib import searchengine
+from sflvault.lib.searchengine import MemorySearchEngine, required_literals
+from sflvault.lib.searchengine import parse_word
+from sflvault.model import search_sort_key
+
+
+Row = namedtuple('Row', ['customers_id', 'customers_name',
+                         'machines_id', 'machines_name', 'machines_fqdn',
+                         'machines_ip', 'machines_location', 'machines_notes',
+                         'services_id', 'services_url', 'services_notes'])
+
+def row(cid, mid=None, sid=None, url=None, name=u'Customer'):
+    return Row(cid, name, mid, mid and u'machine %d' % mid, None,
+               mid and u'10.0.0.%d' % mid, None, None, sid, url, None)
+
+
+class TestSearchEngine(TestCase):
+
+    def setUp(self):
+        self.engine = MemorySearchEngine()
+        self.engine.apply([1, 2], [row(1, 1, 1, u'ssh://root@alpha.org'),
+                                   row(1, 1, 2, u'mysql://beta.org'),
+                                   row(2, 2, 3, u'ssh://root@gamma.net'),
+                                   row(3, name=u'Empty')])
+
+    def _ids(self, words, filters=None):
+        return sorted(r.services_id
+                      for r in self.engine.search(words, filters))
+
+    def test_required_literals(self):
+        self.assertEqual(required_literals(u'alpha.org'), [u'alpha', u'org'])
+        self.assertEqual(required_literals(u'ROOT@[ab]'), [u'root@'])
+        self.assertEqual(required_literals(u'alpha|beta'), [])
+        # Not a valid regexp: searched as is
+        self.assertEqual(required_literals(u'c++'), [u'c++'])
+
+    def test_parse_word(self):
+        self.assertTrue(parse_word(u'^ssh://(root|admin)@.+\\.org$'))
+        # Repeated repeats and alternatives, too long: searched as they are
+        self.assertEqual(parse_word(u'(a+)+$'), None)
+        self.assertEqual(parse_word(u'(a|aa)*$'), None)
+        self.assertEqual(parse_word(u'a' * 101), None)
+        self.assertEqual(parse_word(u'.*.*.*.*.*.*!'), None)
+        self.assertEqual(parse_word(u'a?' * 5 + u'a' * 5), None)
+        self.assertTrue(parse_word(u'^https?://.+\\.org$'))
+        self.assertEqual(required_literals(u'(ssh+)+'), [u'(ssh+)+'])
+
+    def test_search_catastrophic(self):
+        start = time.time()
+        for word in (u'(a+)+$', u'.*.*.*.*.*.*!', u'a?' * 5 + u'a' * 5):
+            regexp = searchengine.compile_word(word)
+            self.assertEqual(regexp.search(u'a' * 80 + u'!'), None)
+        self.assertTrue(time.time() - start < 1)
+        # One repeat, over a long line: only its start is matched
+        self.engine.apply([5], [row(5, 5, 5, u'http://' + u'a' * 100000)])
+        start = time.time()
+        self.assertEqual(self._ids([u'aaa', u'.*!']), [])
+        self.assertTrue(time.time() - start < 1)
+        self.engine.apply([4], [row(4, 4, 4, u'http://(a+)+$')])
+        self.assertEqual(self._ids([u'(a+)+$']), [4])
+
+    def test_search_unlocked(self):
+        # The regexps are matched without holding the engine's lock
+        locked = []
+        class Regexp(object):
+            def search(regexp, text):
+                def acquire():
+                    if self.engine.lock.acquire(False):
+                        self.engine.lock.release()
+                    else:
+                        locked.append(text)
+                t = threading.Thread(target=acquire)
+                t.start()
+                t.join()
+                return True
+        compile_word = searchengine.compile_word
+        searchengine.compile_word = lambda word: Regexp()
+        try:
+            self.assertEqual(self._ids([u'org']), [1, 2])
+        finally:
+            searchengine.compile_word = compile_word
+        self.assertEqual(locked, [])
+
+    def test_search(self):
+        self.assertEqual(self._ids([u'org']), [1, 2])
+        self.assertEqual(self._ids([u'ROOT', u'\\.(net|com)$']), [3])
+        self.assertEqual(self._ids([u'^ssh://', u'alpha|gamma']), [1, 3])
+        # Service s#3, and customer c#3
+        self.assertEqual(self._ids([u'3']), [None, 3])
+        self.assertEqual(self._ids([u'empty']), [None])
+        self.assertEqual(self._ids([u'c++']), [])
+
+    def test_limit(self):
+        rows = self.engine.search([u'ssh|mysql'], limit=2)
+        # Same machine: by url
+        self.assertEqual([r.services_id for r in rows], [2, 1])
+        rows = self.engine.search([u'ssh|mysql'], limit=2,
+                                  after=list(search_sort_key(rows[-1])))
+        self.assertEqual([r.services_id for r in rows], [3])
+
+    def test_filters(self):
+        self.assertEqual(self._ids([u'ssh'], {'customers': [2]}), [3])
+        self.assertEqual(self._ids([u'ssh'], {'machines': [1],
+                                              'customers': None}), [1])
+
+    def test_apply_replaces_customer_rows(self):
+        self.engine.apply([1], [row(1, 1, 1, u'ssh://delta.org')])
+        self.assertEqual(self._ids([u'org']), [1])
+        self.assertEqual(self._ids([u'alpha']), [])
+        self.engine.apply([1], [])
+        self.assertEqual(self._ids([u'org']), [])
+        self.assertFalse([tri for tri in self.engine.by_trigram
+                          if tri in u'delta'])
@@ -0,0 +1,93 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from datetime import datetime, timedelta
+import os
+import tempfile
+from unittest import TestCase
+
+from sflvault.lib.session import (VaultSession, MemorySessionBackend,
+                                  SQLiteSessionBackend)
+
+
+def _session(username, seconds):
+    return VaultSession(user_id=1, username=username, is_admin=False,
+                        remote_addr='127.0.0.1',
+                        timeout=datetime.now() + timedelta(0, seconds))
+
+
+class SessionBackendTests(object):
+    """Tests run against each session backend"""
+
+    def test_set_get_delete(self):
+        sess = _session(u'admin', 60)
+        self.backend.set('tok1', sess)
+        got = self.backend.get('tok1')
+        self.assertEqual(got.username, u'admin')
+        self.assertEqual(got.user_id, 1)
+        self.assertFalse(got.is_admin)
+        self.assertTrue(abs(got.timeout - sess.timeout) < timedelta(0, 1))
+        self.backend.delete('tok1')
+        self.assertEqual(self.backend.get('tok1'), None)
+
+    def test_missing(self):
+        self.assertEqual(self.backend.get('nope'), None)
+        self.backend.delete('nope')
+
+    def test_expired_sessions_are_purged(self):
+        self.backend.set('old', _session(u'old', -10))
+        self.backend.set('new', _session(u'new', 60))
+        self.assertEqual(self.backend.get('old'), None)
+        self.backend.purge(datetime.now() + timedelta(0, 120))
+        self.assertEqual(self.backend.get('new'), None)
+
+    def test_count(self):
+        self.assertEqual(self.backend.count(), 0)
+        self.backend.set('tok1', _session(u'first', 10))
+        self.backend.set('tok2', _session(u'second', 60))
+        self.assertEqual(self.backend.count(), 2)
+        self.assertEqual(self.backend.count(datetime.now() +
+                                            timedelta(0, 30)), 1)
+
+    def test_replaced_session_is_kept(self):
+        self.backend.set('tok', _session(u'first', 10))
+        self.backend.set('tok', _session(u'second', 60))
+        self.backend.purge(datetime.now() + timedelta(0, 30))
+        self.assertEqual(self.backend.get('tok').username, u'second')
+
+
+class TestMemorySessionBackend(SessionBackendTests, TestCase):
+
+    def setUp(self):
+        self.backend = MemorySessionBackend()
+
+
+class TestSQLiteSessionBackend(SessionBackendTests, TestCase):
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.backend = SQLiteSessionBackend(self.filename)
+
+    def tearDown(self):
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(self.filename + suffix):
+                os.unlink(self.filename + suffix)
@@ -0,0 +1,67 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+from unittest import TestCase
+
+from sqlalchemy import create_engine
+
+from sflvault.lib import sqlstats
+
+
+class TestSqlstats(TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        sqlstats.init_sqlstats(self.engine, 2, 0)
+
+    def tearDown(self):
+        sqlstats.init_sqlstats(self.engine, 0, 0)
+        sqlstats.last.pop('test.method', None)
+
+    def test_recording(self):
+        with sqlstats.recording('test.method') as recorder:
+            self.engine.execute('SELECT 1')
+            self.engine.execute('SELECT 2')
+        # Not recorded outside of a call
+        self.engine.execute('SELECT 3')
+        self.assertTrue(sqlstats.last['test.method'] is recorder)
+        self.assertEquals([s for s, t in recorder.statements],
+                          ['SELECT 1', 'SELECT 2'])
+        self.assertEquals(recorder.time, sum(t for s, t in recorder.statements))
+        self.assertFalse(recorder.over_thresholds())
+
+    def test_thresholds(self):
+        logged = []
+        handler = logging.Handler()
+        handler.emit = logged.append
+        sqlstats.log.addHandler(handler)
+        try:
+            with sqlstats.recording('test.method') as recorder:
+                for i in range(3):
+                    self.engine.execute('SELECT %d' % i)
+        finally:
+            sqlstats.log.removeHandler(handler)
+        self.assertTrue(recorder.over_thresholds())
+        self.assertEquals(len(logged), 4)
+        self.assertTrue('test.method ran 3 SQL statements' in
+                        logged[0].getMessage())
+        self.assertTrue(logged[3].getMessage().endswith('SELECT 2'))
@@ -26,12 +26,42 @@ from sflvault.common import VaultError
 
 from sflvault.client.client import authenticate
 from sflvault.client.client import SFLvaultConfig, SFLvaultClient
+from sflvault.client.client import read_import_file
 
+import json
 import logging
+import os
 import random
+import shutil
+import tempfile
+import re
+import urllib2
+
+from sqlalchemy import create_engine, event, sql
+
+from sflvault import model
+from sflvault.lib import backup, sqlstats
 
 log = logging.getLogger('tester')
 
+# SELECTs and objects loaded by the vault, see TestVaultController._loads()
+loads = None
+
+def _record_select(conn, cursor, statement, parameters, context, executemany):
+    if loads is not None and statement.startswith('SELECT'):
+        loads['selects'].append((statement, len(cursor.description)))
+
+def _record_load(cls):
+    def load(target, context):
+        if loads is not None:
+            loads[cls.__name__] = loads.get(cls.__name__, 0) + 1
+    event.listen(cls, 'load', load)
+
+for cls in [model.Customer, model.Machine, model.Service, model.User,
+            model.Group, model.ServiceGroup, model.UserGroup]:
+    _record_load(cls)
+
+
 class TestVaultController(TestController):
     
 
@@ -66,6 +96,56 @@ class TestVaultController(TestController):
     def setUp(self):
         self.vault = self.getVault()
 
+    def _loads(self, method, *args):
+        """Call a vault method, and return what it loaded from the
+        database: {'selects': [(statement, number of columns)],
+                   class name: number of objects loaded}"""
+        global loads
+        if not getattr(model.meta.engine, 'loads_recorded', False):
+            event.listen(model.meta.engine, 'after_cursor_execute',
+                         _record_select)
+            model.meta.engine.loads_recorded = True
+        # Authenticate first
+        self.vault.customer_list()
+        loads = {'selects': []}
+        try:
+            ret = getattr(self.vault.vault, method)(self.vault.authtok, *args)
+            self.assertFalse(ret['error'])
+            return loads
+        finally:
+            loads = None
+
+    def test_rpc_loads(self):
+        """ RPCs only load the rows and columns they need """
+        service = self._add_new_service()
+        sid = service['service_id']
+        mid = self.vault.service_get(sid)['machine_id']
+        cid = self.vault.machine_get(mid)['customer_id']
+
+        loaded = self._loads('customer_list')
+        self.assertEqual([cols for sql, cols in loaded['selects']], [2])
+
+        loaded = self._loads('customer_get', cid)
+        self.assertEqual(loaded, {'selects': loaded['selects'],
+                                  'Customer': 1})
+
+        loaded = self._loads('machine_list')
+        self.assertEqual([cols for sql, cols in loaded['selects']], [8])
+
+        loaded = self._loads('machine_put', mid, {'name': 'renamed'})
+        self.assertEqual(loaded.get('Machine'), 1)
+        self.assertFalse('Service' in loaded)
+
+        loaded = self._loads('service_put', sid, {'notes': 'new notes'})
+        self.assertEqual(loaded.get('Service'), 1)
+        for sql, cols in loaded['selects']:
+            self.assertFalse('services.secret AS' in sql, sql)
+
+        loaded = self._loads('service_get', sid)
+        self.assertEqual(loaded.get('Service'), 1)
+        self.assertTrue([sql for sql, cols in loaded['selects']
+                         if 'services.secret AS' in sql])
+
     def test_customer_add(self):
         """testing add a new customer to the vault"""
         res = self.vault.customer_add('testing customer 1 2 3')
@@ -105,6 +185,220 @@ class TestVaultController(TestController):
                                      '')
         self.assertFalse("Error adding service" in res['message'])
 
+    def test_bulk_import(self):
+        """ bulk_import adds records referring to each other, by batches """
+        gid = self.vault.group_add(u'Import group')['group_id']
+        cid = self.vault.customer_add(u'Existing customer')['customer_id']
+        fd, filename = tempfile.mkstemp(suffix='.csv')
+        os.write(fd, 'type,ref,name,customer,customer_id,machine,parent,'
+                     'url,group_ids,secret,metadata.port\n'
+                     'customer,acme,ACME Inc.,,,,,,,,\n'
+                     'machine,www,web server,acme,,,,,,,\n'
+                     'machine,db,database,,%d,,,,,,\n'
+                     'service,ssh,,,,www,,ssh://root@www.acme.com,g#%d,'
+                     'first secret,22\n'
+                     'service,,,,,db,ssh,ssh://root@db.acme.com,%d,second,\n'
+                     'machine,,no customer,,,,,,,,\n'
+                     'service,,,,,nothing,,ssh://x,%d,third,\n'
+                     % (cid, gid, gid, gid))
+        os.close(fd)
+        try:
+            records = list(read_import_file(filename))
+            results = self.vault.bulk_import(records, batch_size=2)
+        finally:
+            os.unlink(filename)
+
+        self.assertEquals(len(results), 7)
+        self.assertEquals([r.get('ref') for r in results[:4]],
+                          ['acme', 'www', 'db', 'ssh'])
+        self.assertTrue(all('id' in r for r in results[:5]), results)
+        self.assertTrue('customer_id' in results[5]['error'])
+        self.assertTrue('nothing' in results[6]['error'])
+        # Not an ID: only that record fails
+        retval = self.vault.vault.bulk_import(self.vault.authtok, [
+            {'type': 'machine', 'name': u'bad', 'customer_id': 'x'},
+            {'type': 'machine', 'name': u'good', 'customer_id': cid}])
+        self.assertFalse(retval['error'])
+        self.assertTrue('Invalid customer_id' in
+                        retval['results'][0]['error'])
+        self.assertTrue('id' in retval['results'][1])
+
+        machine = self.vault.machine_get(results[1]['id'])
+        self.assertEquals(machine['customer_id'], results[0]['id'])
+        self.assertEquals(self.vault.machine_get(results[2]['id'])
+                          ['customer_id'], cid)
+        service = self.vault.service_get(results[3]['id'])
+        self.assertEquals(service['plaintext'], 'first secret')
+        self.assertEquals(service['metadata'], {'port': '22'})
+        self.assertEquals(service['machine_id'], results[1]['id'])
+        child = self.vault.service_get(results[4]['id'])
+        self.assertEquals(child['plaintext'], 'second')
+        self.assertEquals(child['parent_service_id'], results[3]['id'])
+        found = self.vault.search(['acme.com'])['results']
+        self.assertEquals(sorted(found.keys()),
+                          sorted([str(cid), str(results[0]['id'])]))
+
+    def test_export_restore(self):
+        """ An export restored in an empty database gives the same rows """
+        first = self._add_new_service()['service_id']
+        second = self._add_new_service()['service_id']
+        # The parent comes after its child in the export
+        self.vault.service_put(first, {'parent_service_id': second})
+        self.vault.service_put(second, {'metadata': {'port': 22}})
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'export.gz')
+            out = backup.open_export(filename, 'w')
+            exported = backup.export_vault(model.meta.engine, out,
+                                           batch_size=2)
+            out.close()
+            self.assertTrue(exported['services'] >= 2)
+
+            engine = create_engine('sqlite:///%s/restored.db' % tmpdir)
+            model.meta.metadata.create_all(engine)
+            restored = backup.restore_vault(engine,
+                                            backup.open_export(filename),
+                                            batch_size=2)
+            self.assertEquals(restored, exported)
+            for name in backup.TABLES:
+                table = model.meta.metadata.tables[name]
+                select = sql.select([table]).order_by(table.c.id)
+                self.assertEquals(engine.execute(select).fetchall(),
+                                  model.meta.engine.execute(select).fetchall())
+
+            # Only in an empty vault
+            self.assertRaises(ValueError, backup.restore_vault, engine,
+                              backup.open_export(filename))
+            engine.dispose()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_export_consistent(self):
+        """ A service added during an export isn't half exported """
+        import threading
+        import time
+        mid = self._add_new_machine()['machine_id']
+        gid = self._add_new_group()['group_id']
+        self._add_new_service()
+        changes = model.changes_table
+        revision = model.meta.engine.execute(
+            sql.select([sql.func.max(changes.c.id)])).scalar()
+        added = []
+        writer = threading.Thread(target=lambda: added.append(
+            self.vault.service_add(mid, 0, 'ssh://during.export', [gid],
+                                   'secret')))
+
+        class Out(object):
+            """Adds a service once the first one is exported"""
+            def __init__(self):
+                self.lines = []
+            def write(self, line):
+                self.lines.append(json.loads(line))
+                if writer.ident is None and \
+                   self.lines[-1].get('table') == 'services':
+                    writer.start()
+                    # Give it the time to commit, if it can
+                    time.sleep(1)
+
+        out = Out()
+        backup.export_vault(model.meta.engine, out, batch_size=1)
+        writer.join()
+        self.assertFalse(added[0]['error'])
+        rows = {}
+        for rec in out.lines[1:]:
+            rows.setdefault(rec['table'], []).append(rec['row'])
+        services = set(row['id'] for row in rows['services'])
+        self.assertFalse(added[0]['service_id'] in services)
+        for row in rows['services_groups']:
+            self.assertTrue(row['service_id'] in services)
+        # Nor its revisions
+        self.assertEquals(max(row['id'] for row in rows['changes']),
+                          revision)
+
+    def test_services_get(self):
+        """ services_get fetches and decrypts many services at once """
+        gid = self.vault.group_add(u'Many group')['group_id']
+        mid = self._add_new_machine()['machine_id']
+        sids = [self.vault.service_add(mid, 0, 'ssh://many%d' % i, [gid],
+                                       'secret %d' % i, '')['service_id']
+                for i in range(4)]
+        # Not in the admin's groups
+        other = self.vault.service_add(mid, 0, 'ssh://other', [], 'no', '')
+
+        self.vault.groupkeys.wipe()
+        decrypted = []
+        decrypt = self.vault.groupkeys.decrypt
+        def counted(*args):
+            decrypted.append(args[0])
+            return decrypt(*args)
+        self.vault.groupkeys.decrypt = counted
+        try:
+            servs = self.vault.services_get(list(reversed(sids)) +
+                                            [other['service_id'], 999999])
+        finally:
+            del self.vault.groupkeys.decrypt
+        self.assertEquals(decrypted, [gid])
+        self.assertEquals([s['id'] for s in servs],
+                          list(reversed(sids)) + [other['service_id']])
+        self.assertEquals([s.get('plaintext') for s in servs],
+                          ['secret 3', 'secret 2', 'secret 1', 'secret 0',
+                           None])
+        self.assertTrue(sqlstats.last['sflvault.service_get_many'].count <= 2)
+
+        retval = self.vault.vault.service_get_many(self.vault.authtok,
+                                                   [sids[0], 999999])
+        self.assertEquals(retval['not_found'], [999999])
+        self.assertEquals(retval['services'][0]['cryptsymkey'],
+                          self.vault.vault.service_get(self.vault.authtok,
+                              sids[0])['service']['cryptsymkey'])
+
+    def test_changes_since(self):
+        """ changes_since returns what changed, and what was deleted """
+        first = self.vault.changes_since(0)
+        self.assertTrue(first['full'])
+        revision = first['revision']
+
+        sid = self._add_new_service()['service_id']
+        changes = self.vault.changes_since(revision)
+        self.assertFalse(changes['full'])
+        self.assertTrue(changes['revision'] > revision)
+        self.assertEquals([s['id'] for s in changes['services']], [sid])
+        service = changes['services'][0]
+        self.assertEquals(len(changes['machines']), 1)
+        self.assertEquals(changes['machines'][0]['id'], service['machine_id'])
+        self.assertEquals(len(changes['customers']), 1)
+        self.assertEquals([(x['service_id'], x['id'])
+                           for x in changes['services_groups']],
+                          [(sid, changes['services_groups'][0]['id'])])
+        self.assertEquals(len(changes['users_groups']), 1)
+        self.assertFalse(any(changes['deleted'].values()))
+        self.assertFalse('secret' in service)
+        sgid = changes['services_groups'][0]['id']
+
+        # Only the service changed
+        revision = changes['revision']
+        self.vault.service_put(sid, {'notes': 'changed notes'})
+        changes = self.vault.changes_since(revision)
+        self.assertEquals(changes['services'][0]['notes'], 'changed notes')
+        self.assertEquals(changes['customers'] + changes['machines'] +
+                          changes['services_groups'], [])
+
+        # Tombstones
+        revision = changes['revision']
+        self.vault.service_del(sid)
+        changes = self.vault.changes_since(revision)
+        self.assertEquals(changes['services'], [])
+        self.assertEquals(changes['deleted']['services'], [sid])
+        self.assertEquals(changes['deleted']['services_groups'], [sgid])
+
+        nothing = self.vault.changes_since(changes['revision'])
+        self.assertEquals(nothing['revision'], changes['revision'])
+        self.assertFalse(any(nothing[x] for x in model.CHANGES_TABLES))
+        # Unknown revision: everything
+        self.assertTrue(self.vault.changes_since(nothing['revision'] + 1000)
+                        ['full'])
+
     def test_alias_add(self):
         """testing add a new alias to the vault"""
         cres = self.vault.customer_add(u"Testing é les autres")
@@ -256,6 +550,38 @@ class TestVaultController(TestController):
         self.assertTrue("Added user to group successfully" in gares1['message'])
         self.assertFalse("Error adding user to group" in gares2['message'])
     
+    def test_group_add_user_version(self):
+        """The added user's groupkey is in the vault's longmsg format"""
+        from sflvault.common import crypto
+        from sflvault.client import client
+        ures = self.vault.user_add('test_add_user_version')
+        tmp_vault = SFLvaultClient(self.getConfFileUser())
+        tmp_vault.user_setup('test_add_user_version',
+                             'http://localhost:6555/vault/rpc',
+                             'passphrase')
+        gres = self.vault.group_add('test_group_version')
+
+        # A client writing version 2 by default, on a vault set to version 1
+        real_encrypt_longmsg = client.encrypt_longmsg
+        def encrypt_longmsg(eg, message, version=2):
+            return real_encrypt_longmsg(eg, message, version)
+        client.encrypt_longmsg = encrypt_longmsg
+        crypto.LONGMSG_VERSION = 1
+        try:
+            res = self.vault.group_add_user(gres['group_id'],
+                                            ures['user_id'])
+        finally:
+            crypto.LONGMSG_VERSION = 2
+            client.encrypt_longmsg = real_encrypt_longmsg
+        self.assertFalse(res['error'])
+
+        ug = model.usergroups_table
+        select = sql.select([ug.c.cryptgroupkey],
+                            sql.and_(ug.c.group_id == gres['group_id'],
+                                     ug.c.user_id == ures['user_id']))
+        cryptgroupkey = model.meta.engine.execute(select).scalar()
+        self.assertEquals(longmsg_version(cryptgroupkey), 1)
+
     def test_group_list(self):
         response = self.vault.group_list()
         self.assertTrue(len(response['list']) == 0)
@@ -385,6 +711,146 @@ class TestVaultController(TestController):
                           'service_del',
                           filters={'machines': ['invalid', 'filter', 'value'] })
 
+    def test_search_index_follows_changes(self):
+        """ Search finds parts of words, and follows the changes to
+        customers, machines and services """
+        cres = self.vault.customer_add(u"Indexed customer")
+        mres = self.vault.machine_add(str(cres['customer_id']),
+                                      "Machine name 4",
+                                      "indexed.example.com",
+                                      '4.3.2.1',
+                                      None,
+                                      None)
+        # A customer, then a machine without services
+        results = self.vault.search(['NDEXED', 'name 4'])['results']
+        self.assertEqual(results.keys(), [str(cres['customer_id'])])
+
+        gres = self._add_new_group()
+        sres = self.vault.service_add(mres['machine_id'], 0,
+                                      u'ssh://reindexed@service',
+                                      [gres['group_id']], 'test', '')
+        self.assertEqual(len(self.vault.search('reindexed@')['results']), 1)
+
+        self.vault.customer_put(cres['customer_id'], {'name': u'Renamed'})
+        self.assertEqual(len(self.vault.search(['renamed', 'reindexed@'])
+                             ['results']), 1)
+
+        self.vault.service_put(sres['service_id'], {'url': u'ssh://moved'})
+        self.assertEqual(len(self.vault.search('reindexed@')['results']), 0)
+
+        self.vault.machine_del(mres['machine_id'])
+        self.assertEqual(len(self.vault.search('indexed.example')['results']),
+                         0)
+        self.assertEqual(len(self.vault.search('renamed')['results']), 1)
+
+    def test_search_pages(self):
+        """ Search results come by pages, following a cursor """
+        for i in range(3):
+            self._add_new_service()
+        everything = self.vault.search('sflvault.org', limit=0)['results']
+        # The client goes through the pages, and gathers them
+        self.assertEqual(self.vault.search('sflvault.org', limit=2)['results'],
+                         everything)
+
+        retval = self.vault.vault.search(self.vault.authtok, 'sflvault.org',
+                                         None, False, None, 2, '')
+        self.assertTrue(retval['has_more'])
+        services = []
+        while True:
+            for c in retval['results'].values():
+                for m in c['machines'].values():
+                    services.extend(m['services'].keys())
+            if not retval['has_more']:
+                break
+            retval = self.vault.vault.search(self.vault.authtok,
+                                             'sflvault.org', None, False,
+                                             None, 2, retval['cursor'])
+        self.assertEqual(len(services), len(set(services)))
+        self.assertEqual(len(services),
+                         sum(len(m['services']) for c in everything.values()
+                             for m in c['machines'].values()))
+
+        for cursor in ('garbage', 'W10=', '!!'):
+            retval = self.vault.vault.search(self.vault.authtok,
+                                             'sflvault.org', None, False,
+                                             None, 2, cursor)
+            self.assertTrue(retval['error'])
+            self.assertEqual(retval['message'], "Invalid search cursor")
+
+    def test_search_old_vault(self):
+        """ Vaults without paging get searched with their arguments """
+        import xmlrpclib
+        self._add_new_service()
+        everything = self.vault.search('sflvault.org', limit=0)['results']
+
+        class OldVault(object):
+            """Takes the search arguments of the vaults before paging"""
+            def __init__(self, vault):
+                self.vault = vault
+                self.calls = []
+            def search(self, *args):
+                self.calls.append(len(args))
+                if len(args) != 5:
+                    raise xmlrpclib.Fault(1, "TypeError: sflvault_search() "
+                                             "takes exactly 6 arguments")
+                return self.vault.search(*args)
+            def __getattr__(self, name):
+                return getattr(self.vault, name)
+
+        old = OldVault(self.vault.vault)
+        self.vault.vault = old
+        try:
+            self.assertEqual(self.vault.search('sflvault.org')['results'],
+                             everything)
+            self.assertEqual(old.calls, [7, 5])
+            # Without paging, nothing more is sent
+            self.vault.search('sflvault.org', limit=0)
+            self.assertEqual(old.calls, [7, 5, 5])
+            # They can't keep to the accessible services
+            self.assertRaises(xmlrpclib.Fault, self.vault.search,
+                              'sflvault.org', accessible_only=True)
+        finally:
+            self.vault.vault = old.vault
+
+    def test_search_accessible_only(self):
+        """ Search can be limited to the services we can decrypt """
+        service = self._add_new_service()
+        # In no group
+        mres = self._add_new_machine()
+        other = self.vault.service_add(mres['machine_id'], 0,
+                                       u'ssh://sflvault.org', [],
+                                       'secret', '', {})
+
+        def service_ids(results):
+            return [s_id for c in results.values()
+                    for m in c['machines'].values()
+                    for s_id in m['services']]
+
+        everything = service_ids(self.vault.search('sflvault.org')['results'])
+        self.assertTrue(str(other['service_id']) in everything)
+        accessible = service_ids(self.vault.search('sflvault.org',
+                                                   accessible_only=True)
+                                 ['results'])
+        self.assertTrue(str(service['service_id']) in accessible)
+        self.assertFalse(str(other['service_id']) in accessible)
+
+    def test_search_cache(self):
+        """ Cached searches are dropped by changes to the vault """
+        from sflvault.lib import searchcache
+        searchcache.init_searchcache(10, 1024 * 1024)
+        try:
+            self._add_new_service()
+            first = self.vault.search(['sflvault.org'])['results']
+            self.assertEqual(self.vault.search(['sflvault.org'])['results'],
+                             first)
+            self.assertEqual(searchcache.cache.hits, 1)
+
+            self._add_new_service()
+            self.assertEqual(len(self.vault.search(['sflvault.org'])
+                                 ['results']), len(first) + 1)
+        finally:
+            searchcache.init_searchcache(0, 0)
+
     def test_search_filters_narrow_results(self):
         """ Search can be filtered by machine, groups and customers """
         # Adds three services. Each one has a different customer
@@ -536,6 +1002,54 @@ class TestVaultController(TestController):
         self.assertEquals(len(response3['list']), 2)
 
 
+    def test_user_list_statements(self):
+        """ user_list runs the same statements, whatever the number of users
+        and groups """
+        self.vault.group_add(u'Users group 1')
+        self.vault.group_add(u'Users group 2')
+        self.vault.user_add('statements1')
+
+        users = self.vault.user_list(True)['list']
+        self.assertEquals(len(users[0]['groups']), 2)
+        count = sqlstats.last['sflvault.user_list'].count
+        self.assertTrue(count <= 2, sqlstats.last['sflvault.user_list'].statements)
+
+        self.vault.user_add('statements2')
+        self.vault.user_add('statements3')
+        self.assertEquals(len(self.vault.user_list(True)['list']), 4)
+        self.assertEquals(sqlstats.last['sflvault.user_list'].count, count)
+        self.assertTrue(sqlstats.last['sflvault.user_list'].time > 0)
+
+    def test_metrics(self):
+        """ The calls are counted on the metrics path """
+        self.vault.customer_list()
+        self.vault.customer_list()
+        self.vault.vault.customer_list('invalid authtok')
+        metrics = urllib2.urlopen('http://localhost:6555/metrics').read()
+        calls = re.search(r'^sflvault_rpc_calls_total'
+                          r'{method="sflvault.customer_list"} (\d+)$',
+                          metrics, re.M)
+        errors = re.search(r'^sflvault_rpc_errors_total'
+                           r'{method="sflvault.customer_list"} (\d+)$',
+                           metrics, re.M)
+        self.assertTrue(int(calls.group(1)) >= 3)
+        self.assertTrue(int(errors.group(1)) >= 1)
+        self.assertTrue(re.search(r'^sflvault_auth_failures_total'
+                                  r'{reason="session_not_found"} [1-9]',
+                                  metrics, re.M))
+        self.assertTrue(re.search(r'^sflvault_sessions [1-9]', metrics, re.M))
+        self.assertRaises(urllib2.HTTPError, urllib2.urlopen,
+                          'http://localhost:6555/nothing')
+
+    def test_create_indexes(self):
+        """ create_indexes only creates the missing indexes """
+        self.assertEquals(model.create_indexes(), [])
+        model.meta.engine.execute('DROP INDEX services_parent_service_id')
+        model.meta.engine.execute('DROP INDEX users_username')
+        self.assertEquals(model.create_indexes(),
+                          ['users_username', 'services_parent_service_id'])
+        self.assertEquals(model.create_indexes(), [])
+
     def test_service_get_invalid_service(self):
         # Try to get a service that we are sure doesn't
         # exist
@@ -687,6 +1201,31 @@ class TestVaultController(TestController):
         self.assertEquals(len(response2), 1)
 
 
+    def test_service_get_tree_not_found(self):
+        """ service_get_tree on a missing service says so """
+        self._add_new_service()
+        self.assertRaises(VaultError, self.vault.service_get_tree, 99999)
+        retval = self.vault.vault.service_get_tree(self.vault.authtok, 99999,
+                                                   False)
+        self.assertTrue(retval['error'])
+        self.assertEquals(retval['message'], "Service not found: 99999")
+
+    def test_service_get_tree_parents(self):
+        """ service_get_tree returns the parents first, with the keys to
+        decrypt each of them """
+        ids = []
+        for i in range(3):
+            ids.append(self._add_new_service()['service_id'])
+            if i:
+                self.vault.service_put(ids[i], {'parent_service_id': ids[i-1]})
+
+        services = self.vault.service_get_tree(ids[-1], True)
+        self.assertEqual([s['id'] for s in services], ids)
+        self.assertEqual(services[0]['parent_service_id'], None)
+        for s in services:
+            self.assertEqual(s['plaintext'], 'secret')
+            self.assertEqual(len(s['groups_list']), 1)
+
     def test_service_get_tree_circular_reference_fail(self):
         """ If there are circular references in service definitions,
         service_get_tree should fail """
@@ -774,3 +1313,131 @@ class TestVaultController(TestController):
         machine_list3 = machine_list_response3['list']
         self.assertEquals(len(machine_list3), 0)
 
+
+
+    def test_concurrent_requests(self):
+        """ Requests served at the same time by the worker threads
+        each get their own vault context """
+        import threading
+        import xmlrpclib
+
+        self.vault.customer_list()
+        authtok = self.vault.authtok
+        results = []
+
+        def add_customers(name):
+            vault = xmlrpclib.Server('http://localhost:6555/vault/rpc',
+                                     allow_none=True).sflvault
+            for i in range(5):
+                results.append(vault.customer_add(authtok, name))
+
+        threads = [threading.Thread(target=add_customers,
+                                    args=('concurrent %d' % i,))
+                   for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEquals(len(results), 20)
+        self.assertFalse([x for x in results if x['error']])
+        customer_list = self.vault.customer_list()['list']
+        self.assertEquals(len(customer_list), 20)
+
+    def test_authtok_reused_until_rejected(self):
+        """ A valid authtok is used without the login/authenticate
+        roundtrip, and a rejected one is replaced """
+        self.vault.customer_list()
+        authtok = self.vault.authtok
+        self.vault.authret = None
+        self.vault.customer_list()
+        self.assertEquals(self.vault.authret, None)
+        self.assertEquals(self.vault.authtok, authtok)
+
+        self.vault.authtok = 'rejected'
+        customer_list = self.vault.customer_list()
+        self.assertTrue('list' in customer_list)
+        self.assertNotEquals(self.vault.authtok, 'rejected')
+        self.assertTrue(self.vault.authtok_valid())
+
+    def test_authtok_saved(self):
+        import os
+        import stat
+        cfg = self.vault.cfg
+        cfg.set('SFLvault', 'save_authtok', 'true')
+        cfg.config_write()
+        try:
+            self.vault.authtok_forget()
+            self.vault.customer_list()
+            mode = os.stat(self.vault.authtok_file).st_mode
+            self.assertEquals(stat.S_IMODE(mode), 0600)
+
+            other = SFLvaultClient(cfg.config_file, shell=True)
+            self.assertEquals(other.authtok, self.vault.authtok)
+            self.assertTrue(other.authtok_valid())
+        finally:
+            cfg.cfg.remove_option('SFLvault', 'save_authtok')
+            cfg.config_write()
+            self.vault.authtok_forget()
+        self.assertFalse(os.path.exists(self.vault.authtok_file))
+
+    def test_agent(self):
+        """ Services are decrypted by the sflvault-agent, which keeps the
+        decrypted groupkeys """
+        import os
+        import shutil
+        import tempfile
+        import threading
+        import time
+        from sflvault.client.agent import SFLvaultAgent, AgentClient
+
+        sres = self._add_new_service()
+        plain = self.vault.service_get(sres['service_id'])
+        sockdir = tempfile.mkdtemp()
+        path = os.path.join(sockdir, 'agent')
+        agent = SFLvaultAgent(path, self.vault.privkey, lifetime=60)
+        t = threading.Thread(target=agent.run)
+        t.start()
+        self.vault.agent = AgentClient(path)
+        try:
+            for i in range(2):
+                serv = self.vault.service_get(sres['service_id'])
+                self.assertEquals(serv['plaintext'], plain['plaintext'])
+            self.assertEquals(len(agent.groupkeys), 1)
+
+            # Authentication challenge, decrypted by the agent
+            self.vault.authtok_forget()
+            self.vault.customer_list()
+            self.assertTrue(self.vault.authtok_valid())
+        finally:
+            self.vault.agent = None
+            # Expire the agent, and wake it up
+            agent.expires = time.time()
+            AgentClient(path).ping()
+            t.join()
+            shutil.rmtree(sockdir)
+        self.assertEquals(agent.privkey, None)
+        self.assertFalse(os.path.exists(path))
+
+    def test_rewrap(self):
+        """ Keys written in the version 1 format are rewrapped """
+        from sflvault.common import crypto
+        crypto.LONGMSG_VERSION = 1
+        try:
+            sres = self._add_new_service()
+        finally:
+            crypto.LONGMSG_VERSION = 2
+        serv = self.vault.service_get(sres['service_id'])
+        self.assertEquals(longmsg_version(serv['cryptgroupkey']), 1)
+        self.assertEquals(longmsg_version(serv['cryptsymkey']), 1)
+
+        res = self.vault.rewrap()
+        self.assertFalse(res['error'])
+
+        serv2 = self.vault.service_get(sres['service_id'])
+        self.assertEquals(longmsg_version(serv2['cryptgroupkey']), 2)
+        self.assertEquals(longmsg_version(serv2['cryptsymkey']), 2)
+        self.assertEquals(serv2['plaintext'], serv['plaintext'])
+        # Nothing left to do
+        res = self.vault.rewrap()
+        self.assertTrue('0 group keys and 0 symkeys' in res['message'])
@@ -0,0 +1,171 @@
+# -=- encoding: utf-8 -=-
+#
+# SFLvault - Secure networked password store and credentials manager.
+#
+# Copyright (C) 2008-2009  Savoir-faire Linux inc.
+#
+# Author: Alexandre Bourget <alexandre.bourget@savoirfairelinux.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark of the vault's calls on a large synthetic vault, without and
+with the indexes created by `--create-indexes`.
+
+  $ python -m sflvault.tests.bench_indexes [--customers 500] [--repeat 200]
+
+It fills a temporary SQLite database with customers, machines, services,
+users and groups (with fake keys: nothing is encrypted), drops all the
+indexes, times each call, creates the indexes like an upgraded vault would,
+and times them again.
+"""
+
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import transaction
+from sqlalchemy import create_engine
+
+from sflvault import model
+from sflvault.model import meta
+from sflvault.lib.vault import SFLvaultAccess
+
+
+def populate(customers, machines, services, users, groups, user_groups,
+             service_groups):
+    """Insert a synthetic vault, return {name: some ids} for the calls"""
+    rnd = random.Random(42)
+    tables = model.metadata.tables
+    n_machines = customers * machines
+    n_services = n_machines * services
+    execute = meta.engine.execute
+
+    execute(tables['customers'].insert(),
+            [{'id': i, 'name': u'Customer %d' % i}
+             for i in range(1, customers + 1)])
+    execute(tables['machines'].insert(),
+            [{'id': i, 'customer_id': (i - 1) // machines + 1,
+              'name': u'machine%d' % i, 'fqdn': u'm%d.example.com' % i,
+              'ip': '10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255)}
+             for i in range(1, n_machines + 1)])
+    # The services of a machine are children of its first one
+    execute(tables['services'].insert(),
+            [{'id': i, 'machine_id': (i - 1) // services + 1,
+              'parent_service_id': (None if (i - 1) % services == 0
+                                    else (i - 1) // services * services + 1),
+              'url': 'ssh://root@m%d/' % i, 'secret': 'x' * 100}
+             for i in range(1, n_services + 1)])
+    execute(tables['groups'].insert(),
+            [{'id': i, 'name': u'Group %d' % i, 'pubkey': 'x' * 1000}
+             for i in range(1, groups + 1)])
+    execute(tables['users'].insert(),
+            [{'id': i, 'username': u'user%d' % i, 'pubkey': 'x' * 1000,
+              'is_admin': i == 1}
+             for i in range(1, users + 1)])
+    execute(tables['users_groups'].insert(),
+            [{'user_id': u, 'group_id': g, 'cryptgroupkey': 'x' * 500}
+             for u in range(1, users + 1)
+             for g in rnd.sample(range(1, groups + 1), user_groups)])
+    execute(tables['services_groups'].insert(),
+            [{'service_id': s, 'group_id': g, 'cryptsymkey': 'x' * 500}
+             for s in range(1, n_services + 1)
+             for g in rnd.sample(range(1, groups + 1), service_groups)])
+    return {'customers': range(1, customers + 1),
+            'machines': range(1, n_machines + 1),
+            'services': range(1, n_services + 1),
+            'parents': range(1, n_services + 1, services),
+            'users': range(1, users + 1),
+            'groups': range(1, groups + 1)}
+
+
+def calls(ids):
+    """Return [(name, function(vault, rnd))], the calls to time"""
+    def login(vault, rnd):
+        username = u'user%d' % rnd.choice(ids['users'])
+        return model.query(model.User).filter_by(username=username).one()
+    def pick(method, kind):
+        def call(vault, rnd):
+            return getattr(vault, method)(rnd.choice(ids[kind]))
+        return call
+    return [('login', login),
+            ('customer_get', pick('customer_get', 'customers')),
+            ('machine_get', pick('machine_get', 'machines')),
+            ('service_get', pick('service_get', 'services')),
+            ('service_get_tree', pick('service_get_tree', 'services')),
+            ('group_get', pick('group_get', 'groups')),
+            # Refused: the children checks only
+            ('service_del', pick('service_del', 'parents'))]
+
+
+def run(calls, repeat, user_id):
+    """Return {name: average seconds per call}"""
+    out = {}
+    for name, call in calls:
+        rnd = random.Random(name)
+        vault = SFLvaultAccess()
+        vault.myself_id = user_id
+        start = time.time()
+        for i in range(repeat):
+            call(vault, rnd)
+            transaction.abort()
+            meta.Session.remove()
+        out[name] = (time.time() - start) / repeat
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--customers', type=int, default=500)
+    parser.add_argument('--machines', type=int, default=10,
+                        help="machines per customer")
+    parser.add_argument('--services', type=int, default=4,
+                        help="services per machine")
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--groups', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix='sflvault-bench-')
+    try:
+        engine = create_engine('sqlite:///%s' %
+                               os.path.join(tmpdir, 'vault.db'))
+        model.init_model(engine)
+        model.metadata.create_all(engine)
+        for table in model.metadata.sorted_tables:
+            for index in table.indexes:
+                index.drop(engine)
+        print "Populating..."
+        ids = populate(args.customers, args.machines, args.services,
+                       args.users, args.groups, 5, 2)
+        to_time = calls(ids)
+        without = run(to_time, args.repeat, user_id=1)
+        created = model.create_indexes()
+        print "Created: %s" % ', '.join(created)
+        with_ = run(to_time, args.repeat, user_id=1)
+
+        print "%-20s %12s %12s %8s" % ('call', 'no index', 'indexes',
+                                       'speedup')
+        for name, call in to_time:
+            print "%-20s %10.3fms %10.3fms %7.1fx" % (
+                name, without[name] * 1000, with_[name] * 1000,
+                without[name] / with_[name])
+    finally:
+        shutil.rmtree(tmpdir, True)
+
+
+if __name__ == '__main__':
+    main()
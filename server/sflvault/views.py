@@ -24,6 +24,8 @@ import transaction
 
 from sflvault.common.crypto import *
 from sflvault.lib.vault import SFLvaultAccess, vaultMsg
+from sflvault.lib.session import MemorySessionBackend, VaultSession
+from sflvault.lib import metrics, sqlstats
 from sflvault.model import *
 import datetime
 from decorator import decorator
@@ -32,6 +34,7 @@ from distutils.version import LooseVersion
 import venusian
 
 import sys
+import time
 
 log = logging.getLogger(__name__)
 
@@ -39,8 +42,18 @@ MINIMAL_CLIENT_VERSION = LooseVersion('0.7.6')
 # Permissions decorators for XML-RPC calls
 #
 
-vaultSessions = {}
-vault = SFLvaultAccess()
+# Replaced by init_sessions() with the configured backend, at server startup
+vaultSessions = MemorySessionBackend()
+
+def init_sessions(backend):
+    """Set the backend in which the sessions are stored"""
+    global vaultSessions
+    vaultSessions = backend
+
+def auth_failure(reason):
+    """Count an authentication failure, see metrics.AUTH_FAILURES"""
+    if metrics.stats is not None:
+        metrics.stats.auth_failure(reason)
 
 def test_group_admin(request, group_id):
     if not query(Group).filter_by(id=group_id).first():
@@ -50,8 +63,8 @@ def test_group_admin(request, group_id):
 
     # Verify if I'm is_admin on that group
     ug = query(UserGroup).filter_by(group_id=group_id,
-                                    user_id=sess['user_id']).first()
-    me = query(User).get(sess['user_id'])
+                                    user_id=sess.user_id).first()
+    me = query(User).get(sess.user_id)
     
     # Make sure I'm in that group (to be able to decrypt the groupkey)
     if not ug or (not ug.is_admin and not me.is_admin):
@@ -65,7 +78,24 @@ class XMLRPCDispatcher(object):
         params = (request, ) + params
 
         if method in self.registry:
-            return self.registry[method](*params)
+            # Each request gets its own SFLvaultAccess, so that the
+            # authenticated user (myself_id) is never shared between
+            # concurrent requests.
+            request['vault'] = SFLvaultAccess()
+            start = time.time()
+            error = True
+            try:
+                with sqlstats.recording(method):
+                    ret = self.registry[method](*params)
+                error = isinstance(ret, dict) and ret.get('error', False)
+                return ret
+            finally:
+                if metrics.stats is not None:
+                    metrics.stats.observe(method, time.time() - start, error)
+                # Release the thread's DB session at the end of the request,
+                # worker threads are reused for the next ones.
+                transaction.abort()
+                meta.Session.remove()
 
     def __init__(self):
         self.registry = {}
@@ -143,14 +173,14 @@ def _authenticated_user_first(request, cryptok):
 
 
     if not s:
+        auth_failure(error_msg.replace(' ', '_'))
         return vaultMsg(False, "Permission denied (%s)" % error_msg)
 
     sess = s
 
-    if 'user_id' in sess:
-        vault.myself_id = sess['user_id']
-    if 'username' in sess:
-        vault.myself_username = sess['username']
+    vault = request['vault']
+    vault.myself_id = sess.user_id
+    vault.myself_username = sess.username
 
 @decorator
 def authenticated_admin(func, request, *args, **kwargs):
@@ -168,7 +198,7 @@ def authenticated_admin(func, request, *args, **kwargs):
         sess = None
 
     if sess:
-        if not sess['userobj'].is_admin:
+        if not sess.is_admin:
             return vaultMsg(False, "Permission denied, admin priv. required")
 
     return func(request, *args, **kwargs)
@@ -195,7 +225,9 @@ def sflvault_authenticate(request, username, cryptok):
                 print "Session expired... "
 
             if sess:
-                return vaultMsg(True, 'Authentication successful (cached)', {'authtok': cryptok})
+                return vaultMsg(True, 'Authentication successful (cached)',
+                                {'authtok': cryptok,
+                                 'session_timeout': int((sess.timeout - datetime.now()).total_seconds())})
     except KeyError:
         pass
     
@@ -204,25 +236,31 @@ def sflvault_authenticate(request, username, cryptok):
         db = meta.Session()
         u = db.query(User).filter(User.username == username).all()[0]
     except:
+        auth_failure('invalid_user')
         return vaultMsg(False, 'Invalid user')
 
     if u.logging_timeout < datetime.now():
+        auth_failure('token_expired')
         return vaultMsg(False, 'Login token expired. Now: %s Timeout: %s' % (datetime.now(), u.logging_timeout))
 
     # str() necessary, to convert buffer to string.
     if cryptok != str(u.logging_token):
         #TODO: Ask about this line.
         #raise Exception
+        auth_failure('bad_token')
         return vaultMsg(False, 'Authentication failed')
     else:
         newtok = b64encode(randfunc(32))
-        set_session(newtok, {'username': username,
-                                'timeout': datetime.now() + timedelta(0, int(settings['sflvault.vault.session_timeout'])),
-                                'remote_addr': request.get('REMOTE_ADDR', None),
-                                'userobj': u,
-                                'user_id': u.id
-                                })
-        return vaultMsg(True, 'Authentication successful', {'authtok': newtok})
+        session_timeout = int(settings['sflvault.vault.session_timeout'])
+        set_session(newtok, VaultSession(
+            user_id=u.id,
+            username=username,
+            is_admin=u.is_admin,
+            remote_addr=request.get('REMOTE_ADDR', None),
+            timeout=datetime.now() + timedelta(0, session_timeout)))
+        # session_timeout lets the client reuse the authtok until it expires
+        return vaultMsg(True, 'Authentication successful',
+                        {'authtok': newtok, 'session_timeout': session_timeout})
 
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.login')
@@ -242,6 +280,7 @@ def sflvault_login(request, username, version):
         #u = query(User).filter_by(username=username).one()
         u = meta.Session.query(User).filter_by(username=username).one()
     except Exception, e:
+        auth_failure('invalid_user')
         return vaultMsg(False, "User unknown: %s" % e.message)
     
     # TODO: implement throttling ?
@@ -255,7 +294,7 @@ def sflvault_login(request, username, version):
     
     #a = meta.Session.query(User).filter_by(username=username).one()
     e = u.elgamal()
-    cryptok = serial_elgamal_msg(e.encrypt(rnd, randfunc(32)))
+    cryptok = serial_elgamal_msg(elgamal_encrypt(e, rnd, randfunc(32)))
     
     transaction.commit()
     #meta.Session.close()
@@ -268,37 +307,37 @@ def user_add(request, authtok, username, is_admin):
         setup_timeout = request['settings']['sflvault.vault.setup_timeout']
     except KeyError, e:
         setup_timeout = 300
-    return vault.user_add(username, is_admin, setup_timeout=setup_timeout)
+    return request['vault'].user_add(username, is_admin, setup_timeout=setup_timeout)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.user_setup')
 def user_setup(request, username, pubkey):
-    return vault.user_setup(username, pubkey)
+    return request['vault'].user_setup(username, pubkey)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.user_del')
 @authenticated_admin
 def sflvault_user_del(request, authtok, user):
-    return vault.user_del(user)
+    return request['vault'].user_del(user)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.user_list')
 @authenticated_user
 def sflvault_user_list(request, authtok, groups):
-    return vault.user_list(groups)
+    return request['vault'].user_list(groups)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.machine_get')
 @xmlrpc_method(endpoint='sflvault', method='sflvault.machine.get')
 @authenticated_user
 def sflvault_machine_get(request, authtok, machine_id):
-    return vault.machine_get(machine_id)
+    return request['vault'].machine_get(machine_id)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.machine_put')
 @authenticated_user
 def sflvault_machine_put(request, authtok, machine_id, data):
-    return vault.machine_put(machine_id, data)
+    return request['vault'].machine_put(machine_id, data)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.service_get')
 @authenticated_user
 def sflvault_service_get(request, authtok, service_id, group_id=None):
-    return vault.service_get(service_id, group_id)
+    return request['vault'].service_get(service_id, group_id)
 
 
 # si ça arrive via /jsonrpc .. on convertie en JSON en sortant
@@ -309,10 +348,20 @@ def sflvault_service_get(request, authtok, service_id, group_id=None):
 #@rpc_view(method='sflvault.service_get', skip_first=False)
 #def sflvault_service_get(authtok, service_id, group_id=None):
 
+@xmlrpc_method(endpoint='sflvault', method='sflvault.changes_since')
+@authenticated_user
+def sflvault_changes_since(request, authtok, revision=0):
+    return request['vault'].changes_since(revision)
+
+@xmlrpc_method(endpoint='sflvault', method='sflvault.service_get_many')
+@authenticated_user
+def sflvault_service_get_many(request, authtok, service_ids):
+    return request['vault'].service_get_many(service_ids)
+
 @xmlrpc_method(endpoint='sflvault', method='sflvault.service_get_tree')
 @authenticated_user
 def sflvault_service_get_tree(request, authtok, service_id, with_groups):
-    return vault.service_get_tree(service_id, with_groups)
+    return request['vault'].service_get_tree(service_id, with_groups)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.service_put')
 @authenticated_user
@@ -324,108 +373,115 @@ def sflvault_service_put(request, authtok, service_id, data):
                     ServiceGroup.group_id==UserGroup.group_id) \
                 .join(users_table, User.id==UserGroup.user_id) \
                 .select() \
-                .where(User.id==sess['user_id']) \
+                .where(User.id==sess.user_id) \
                 .where(ServiceGroup.service_id==service_id)
     res = list(meta.Session.execute(req))
     if not res:
         return vaultMsg(False, "You don't have access to that service.")
     else:
-        return vault.service_put(service_id, data)
+        return request['vault'].service_put(service_id, data)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.search')
 @authenticated_user
-def sflvault_search(request, authtok, search_query, group_ids, verbose, filters):
+def sflvault_search(request, authtok, search_query, group_ids, verbose, filters,
+                    limit=0, cursor='', accessible_only=False):
     if group_ids and not filters:
         filters = {'groups': group_ids}
     if group_ids and isinstance(filters, dict) and 'groups' not in filters:
         # Please don't do that, use filters instead.
         filters['groups'] = group_ids
 
-    return vault.search(search_query, filters, verbose)
+    return request['vault'].search(search_query, filters, verbose, limit,
+                                   cursor, accessible_only)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.service_add')
 @authenticated_user
 def sflvault_service_add(request, authtok, machine_id, parent_service_id, url, group_ids, secret,
         notes, metadata):
-    return vault.service_add(machine_id, parent_service_id, url, group_ids, secret, notes,
+    return request['vault'].service_add(machine_id, parent_service_id, url, group_ids, secret, notes,
         metadata)
 
+@xmlrpc_method(endpoint='sflvault', method='sflvault.bulk_import')
+@authenticated_user
+def sflvault_bulk_import(request, authtok, records):
+    return request['vault'].bulk_import(records)
+
 @xmlrpc_method(endpoint='sflvault', method='sflvault.service_del')
 @authenticated_admin
 def sflvault_service_del(request, authtok, service_id):
-    return vault.service_del(service_id)
+    return request['vault'].service_del(service_id)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.service_list')
 @authenticated_user
 def sflvault_service_list(request, authtok, machine_id=None, customer_id=None):
-    return vault.service_list(machine_id, customer_id)
+    return request['vault'].service_list(machine_id, customer_id)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.machine_add')
 @authenticated_user
 def sflvault_machine_add(request, authtok, customer_id, name, fqdn, ip, location, notes):
-    return vault.machine_add(customer_id, name, fqdn, ip, location, notes)
+    return request['vault'].machine_add(customer_id, name, fqdn, ip, location, notes)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.machine_del')
 @authenticated_admin
 def sflvault_machine_del(request, authtok, machine_id):
-    return vault.machine_del(machine_id)
+    return request['vault'].machine_del(machine_id)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.machine_list')
 @authenticated_user
 def sflvault_machine_list(request, authtok, customer_id=None):
-    return vault.machine_list(customer_id)
+    return request['vault'].machine_list(customer_id)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.customer_get')
 @xmlrpc_method(endpoint='sflvault', method='sflvault.customer.get')
 @authenticated_user
 def sflvault_customer_get(request, authtok, customer_id):
-    return vault.customer_get(customer_id)
+    return request['vault'].customer_get(customer_id)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.customer_put')
 @authenticated_user
 def sflvault_customer_put(request, authtok, customer_id, data):
-    return vault.customer_put(customer_id, data)
+    return request['vault'].customer_put(customer_id, data)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.customer_add')
 @authenticated_user
 def sflvault_customer_add(request, authtok, customer_name):
-    return vault.customer_add(customer_name)
+    return request['vault'].customer_add(customer_name)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.customer_del')
 @authenticated_admin
 def sflvault_customer_del(request, authtok, customer_id):
-    return vault.customer_del(customer_id)
+    return request['vault'].customer_del(customer_id)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.customer_list')
 @authenticated_user
 def sflvault_customer_list(request, authtok):
-    return vault.customer_list()
+    return request['vault'].customer_list()
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.group_get')
 @authenticated_user
 def sflvault_group_get(request, authtok, group_id):
-    return vault.group_get(group_id)
+    return request['vault'].group_get(group_id)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.group_put')
 @authenticated_user
 def sflvault_group_put(request, authtok, group_id, data):
-    return vault.group_put(group_id, data)
+    return request['vault'].group_put(group_id, data)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.group_add')
 @authenticated_user
 def sflvault_group_add(request, authtok, group_name):
-    return vault.group_add(group_name)
+    return request['vault'].group_add(group_name)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.group_del')
 @authenticated_admin
 def sflvault_group_del(request, authtok, group_id, delete_cascade):
-    return vault.group_del(group_id,
+    return request['vault'].group_del(group_id,
                            delete_cascade=delete_cascade)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.group_add_service')
 @authenticated_user
 def sflvault_group_add_service(request, authtok, group_id, service_id, symkey):
-    return vault.group_add_service(group_id, service_id, symkey)
+    return request['vault'].group_add_service(group_id, service_id, symkey)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.group_del_service')
 @authenticated_user
@@ -433,12 +489,22 @@ def sflvault_group_del_service(request, authtok, group_id, service_id):
     fail = test_group_admin(request, group_id)
     if fail:
         return fail
-    return vault.group_del_service(group_id, service_id)
+    return request['vault'].group_del_service(group_id, service_id)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.group_add_user')
 @authenticated_user
 def sflvault_group_add_user(request, authtok, group_id, user, is_admin=False, cryptgroupkey=None):
-    return vault.group_add_user(group_id, user, is_admin, cryptgroupkey)
+    return request['vault'].group_add_user(group_id, user, is_admin, cryptgroupkey)
+
+@xmlrpc_method(endpoint='sflvault', method='sflvault.rewrap_list')
+@authenticated_user
+def sflvault_rewrap_list(request, authtok):
+    return request['vault'].rewrap_list()
+
+@xmlrpc_method(endpoint='sflvault', method='sflvault.rewrap_store')
+@authenticated_user
+def sflvault_rewrap_store(request, authtok, groupkeys, symkeys):
+    return request['vault'].rewrap_store(groupkeys, symkeys)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.group_del_user')
 @authenticated_user
@@ -446,54 +512,42 @@ def sflvault_group_del_user(request, authtok, group_id, user):
     fail = test_group_admin(request, group_id)
     if fail:
         return fail
-    return vault.group_del_user(group_id, user)
+    return request['vault'].group_del_user(group_id, user)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.group_list')
 @xmlrpc_method(endpoint='sflvault', method='sflvault.group.list')
 @authenticated_user
 def sflvault_group_list(request, authtok, list_users=False):
-    return vault.group_list(False, list_users)
+    return request['vault'].group_list(False, list_users)
 
 @xmlrpc_method(endpoint='sflvault', method='sflvault.service_passwd')
 @authenticated_user
 def sflvault_service_passwd(request, authtok, service_id, newsecret):
-    return vault.service_passwd(service_id, newsecret)
+    return request['vault'].service_passwd(service_id, newsecret)
 
-#def _setup_sessions():
-#    """DRY out set_session and get_session"""
-#    if not hasattr(, 'vaultSessions'):
-#        .vaultSessions = {}
 def set_session(authtok, value):
-    """Sets in 'g.vaultSessions':
-    {authtok1: {'username':  , 'timeout': datetime}, authtok2: {}..}
-    
-    """
- #   _setup_sessions();
-    vaultSessions[authtok] = value;
+    """Stores the VaultSession `value` in 'vaultSessions'"""
+    vaultSessions.set(authtok, value)
 
 def get_session(authtok, request):
     """Return the values associated with a session"""
-    #_setup_sessions();
-    
-    if not vaultSessions.has_key(authtok):
+    sess = vaultSessions.get(authtok)
+
+    if sess is None:
         raise SessionNotFoundError
         return None
 
-    # XXX: where does the SESSION_TIMEOUT come from?
-    if not vaultSessions[authtok].has_key('timeout'):
-        vaultSessions[authtok]['timeout'] = datetime.now() + timedelta(0, SESSION_TIMEOUT)
-
-    if vaultSessions[authtok]['timeout'] < datetime.now():
-        del(vaultSessions[authtok])
+    if sess.timeout < datetime.now():
+        vaultSessions.delete(authtok)
         raise SessionExpiredError
         return None
 
-    if vaultSessions[authtok]['remote_addr'] != request.get('REMOTE_ADDR', 'gibberish'):
-        del(vaultSessions[authtok])
+    if sess.remote_addr != request.get('REMOTE_ADDR', 'gibberish'):
+        vaultSessions.delete(authtok)
         SessionSourceAddressMismatchError
         return None
 
-    return vaultSessions[authtok]
+    return sess
 
 class SessionNotFoundError(Exception):
     pass